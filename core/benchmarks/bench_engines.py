@@ -0,0 +1,166 @@
+"""
+Compare the thread and asyncio forwarding engines of core.forward.
+
+An echo server and the forwarder each run in their own process on loopback.
+For each engine the benchmark:
+  - opens <connections> idle connections through the forwarder and records the
+    forwarder's resident memory and thread count,
+  - measures request/response round trips over those connections.
+
+Usage:
+  python core/benchmarks/bench_engines.py --connections 1000
+"""
+
+from typing import Any
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import resource
+import socket
+import time
+
+from click import command, option, Choice
+
+from core import forward, aio_forward
+from core.forward_config import ENGINES, ENGINE_ASYNCIO
+
+
+def raise_fd_limit() -> None:
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def listen_loopback(backlog: int = 4096) -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(("127.0.0.1", 0))
+    s.listen(backlog)
+    return s
+
+
+def run_echo_server(server_socket: socket.socket) -> None:
+    raise_fd_limit()
+
+    async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    async def serve() -> None:
+        server = await asyncio.start_server(echo, sock=server_socket)
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def run_forwarder(server_socket: socket.socket, engine: str, echo_port: int) -> None:
+    raise_fd_limit()
+    # Silence the per-connection logging
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+         contextlib.redirect_stdout(devnull):
+        if engine == ENGINE_ASYNCIO:
+            asyncio.run(aio_forward.forward_connections_to_ip(
+                server_socket, "127.0.0.1", echo_port))
+        else:
+            forward.forward_connections_to_ip(server_socket, "127.0.0.1", echo_port)
+
+
+def proc_status(pid: int) -> dict[str, int]:
+    status = {}
+    with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ("VmRSS", "Threads"):
+                status[key] = int(value.split()[0])
+    return status
+
+
+async def open_connections(port: int, count: int) -> list[tuple[Any, Any]]:
+    conns = []
+    for _ in range(count):
+        conns.append(await asyncio.open_connection("127.0.0.1", port))
+    return conns
+
+
+async def round_trips(
+        conns: list[tuple[Any, Any]],
+        rounds: int,
+        message: bytes) -> float:
+    """
+    Send <rounds> messages on every connection concurrently, waiting for each
+    echo.  Returns elapsed seconds.
+    """
+    async def one(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        for _ in range(rounds):
+            writer.write(message)
+            await writer.drain()
+            await reader.readexactly(len(message))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(r, w) for r, w in conns))
+    return time.perf_counter() - start
+
+
+def bench_engine(engine: str, connections: int, rounds: int, size: int) -> dict[str, Any]:
+    ctx = multiprocessing.get_context("fork")
+    echo_socket = listen_loopback()
+    fwd_socket = listen_loopback()
+    echo_proc = ctx.Process(target=run_echo_server, args=[echo_socket], daemon=True)
+    fwd_proc = ctx.Process(
+        target=run_forwarder,
+        args=[fwd_socket, engine, echo_socket.getsockname()[1]],
+        daemon=True)
+    echo_proc.start()
+    fwd_proc.start()
+    assert fwd_proc.pid is not None
+
+    async def run() -> dict[str, Any]:
+        base = proc_status(fwd_proc.pid)
+        conns = await open_connections(fwd_socket.getsockname()[1], connections)
+        # Make sure every connection is established end-to-end
+        await round_trips(conns, 1, b"x")
+        idle = proc_status(fwd_proc.pid)
+        elapsed = await round_trips(conns, rounds, b"x" * size)
+        for _, w in conns:
+            w.close()
+        messages = connections * rounds
+        return {
+            "engine": engine,
+            "connections": connections,
+            "threads": idle["Threads"],
+            "rss_kb": idle["VmRSS"],
+            "rss_per_conn_kb": (idle["VmRSS"] - base["VmRSS"]) / connections,
+            "round_trips_per_s": messages / elapsed,
+            "mb_per_s": 2 * messages * size / elapsed / 1e6,
+        }
+
+    try:
+        return asyncio.run(run())
+    finally:
+        fwd_proc.kill()
+        echo_proc.kill()
+        fwd_socket.close()
+        echo_socket.close()
+
+
+@command()
+@option("--engine", "-e", type = Choice(ENGINES), multiple = True)
+@option("--connections", "-c", type = int, default = 1000)
+@option("--rounds", "-r", type = int, default = 10)
+@option("--size", "-s", type = int, default = 1024, help="Message size")
+def main(engine: tuple[str, ...], connections: int, rounds: int, size: int) -> None:
+    raise_fd_limit()
+    for e in engine or ENGINES:
+        r = bench_engine(e, connections, rounds, size)
+        print(
+            f"{r['engine']:>8}: {r['connections']} conns"
+            f"  threads={r['threads']}"
+            f"  rss={r['rss_kb'] / 1024:.1f}MB ({r['rss_per_conn_kb']:.1f}KB/conn)"
+            f"  {r['round_trips_per_s']:.0f} round-trips/s"
+            f"  {r['mb_per_s']:.1f}MB/s")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,320 @@
+"""
+Benchmark suite for core.forward, for comparing changes to socket_forward,
+connect_sockets and determine_https_destination between commits.  Everything
+runs on socketpairs or loopback, with no network access.
+
+Suites:
+  throughput    - bulk transfer through connect_sockets between two
+                  socketpairs, for each relay mode and relay chunk size
+  setup         - connections per second through a forwarder process
+                  (connect, one round trip, close), and their latency
+  concurrency   - 100 / 1k / 10k concurrent connections through a forwarder
+                  process: round trips per second, threads and memory
+                  (see bench_engines.py)
+  client_hello  - determine_https_destination on a socketpair, for a typical
+                  and a large ClientHello, and for an unknown host
+
+Results are written as JSON.  With --compare, the change in each metric
+against an earlier run is reported on stderr.
+
+Usage:
+  python core/benchmarks/bench_forward.py --output before.json
+  (change core.forward)
+  python core/benchmarks/bench_forward.py --output after.json --compare before.json
+"""
+
+from typing import Any, Callable, Optional
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+from click import command, option, Choice
+
+from core import relay
+from core.destinations import HostTable
+from core.forward import connect_sockets, determine_https_destination
+from core.forward_config import ENGINES, ENGINE_THREAD
+
+from bench_engines import bench_engine, listen_loopback, raise_fd_limit, run_echo_server, \
+    run_forwarder
+from tls_samples import client_hello, large_client_hello
+
+SUITES = ["throughput", "setup", "concurrency", "client_hello"]
+CHUNK_SIZES = [1024, 4096, 16384, 65536, 262144]
+CONCURRENCY_LEVELS = [100, 1000, 10000]
+
+# Metrics where a smaller value is better (for --compare)
+LOWER_IS_BETTER = ("_us", "_ms", "_kb", "threads", "cpu_s")
+
+
+def set_chunk_size(mode: str, chunk_size: int) -> None:
+    if mode == relay.RELAY_COPY:
+        relay.COPY_CHUNK_SIZE = chunk_size
+    else:
+        relay.RELAY_CHUNK_SIZE = chunk_size
+
+
+def transfer(mode: str, size: int) -> tuple[float, float]: # pylint: disable=too-many-locals
+    """
+    Send size bytes through connect_sockets.  Returns the elapsed and CPU
+    seconds.
+    """
+    client, s_a = socket.socketpair()
+    s_b, server = socket.socketpair()
+    data = b"x" * 65536
+
+    def produce() -> None:
+        sent = 0
+        while sent < size:
+            client.sendall(data)
+            sent += len(data)
+
+    def consume() -> None:
+        buf = bytearray(1 << 20)
+        received = 0
+        while received < size:
+            received += server.recv_into(buf)
+        # Ends the other direction, so that connect_sockets returns
+        server.close()
+
+    threads = [
+        threading.Thread(target=produce),
+        threading.Thread(target=consume),
+        threading.Thread(target=connect_sockets, args=(s_a, s_b, mode)),
+    ]
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    threads[1].join()
+    elapsed = time.perf_counter() - start
+    client.close()
+    for thread in threads:
+        thread.join()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage.ru_utime - usage_start.ru_utime) + (usage.ru_stime - usage_start.ru_stime)
+    return elapsed, cpu
+
+
+def bench_throughput(size: int, repeat: int) -> list[dict[str, Any]]:
+    results = []
+    defaults = (relay.COPY_CHUNK_SIZE, relay.RELAY_CHUNK_SIZE)
+    try:
+        for mode in relay.RELAYS:
+            for chunk_size in CHUNK_SIZES:
+                set_chunk_size(mode, chunk_size)
+                elapsed, cpu = min(transfer(mode, size) for _ in range(repeat))
+                results.append({
+                    "name": f"{mode}/{chunk_size}",
+                    "relay": mode,
+                    "chunk_size": chunk_size,
+                    "mb_per_s": size / elapsed / 1e6,
+                    "cpu_s_per_gb": cpu / size * 1e9,
+                })
+    finally:
+        relay.COPY_CHUNK_SIZE, relay.RELAY_CHUNK_SIZE = defaults
+    return results
+
+
+def bench_setup(engine: str, connections: int) -> dict[str, Any]:
+    ctx = multiprocessing.get_context("fork")
+    echo_socket = listen_loopback()
+    fwd_socket = listen_loopback()
+    procs = [
+        ctx.Process(target=run_echo_server, args=[echo_socket], daemon=True),
+        ctx.Process(
+            target=run_forwarder,
+            args=[fwd_socket, engine, echo_socket.getsockname()[1]],
+            daemon=True),
+    ]
+    for proc in procs:
+        proc.start()
+
+    address = fwd_socket.getsockname()
+    latencies = []
+    try:
+        for _ in range(connections):
+            start = time.perf_counter()
+            with socket.create_connection(address) as s:
+                s.sendall(b"x")
+                s.recv(1)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        for proc in procs:
+            proc.kill()
+        fwd_socket.close()
+        echo_socket.close()
+
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "name": engine,
+        "engine": engine,
+        "connections_per_s": connections / sum(latencies),
+        "p50_ms": cuts[49] * 1000,
+        "p99_ms": cuts[98] * 1000,
+    }
+
+
+def bench_concurrency(engine: str, connections: int, rounds: int) -> dict[str, Any]:
+    name = f"{engine}/{connections}"
+    try:
+        result = bench_engine(engine, connections, rounds, 1024)
+    except (OSError, EOFError) as e:
+        # The forwarder ran out of threads or file descriptors
+        return {"name": name, "engine": engine, "connections": connections, "error": str(e)}
+    return {"name": name, **result}
+
+
+def time_hello(hello: bytes, hosts: HostTable, number: int) -> tuple[float, Optional[str]]:
+    """
+    Seconds per determine_https_destination call reading hello from a
+    socketpair, and the destination.
+    """
+    client, server = socket.socketpair()
+    result: list[Optional[str]] = [None]
+
+    def route() -> None:
+        client.sendall(hello)
+        result[0] = determine_https_destination(server, hosts)[0]
+
+    try:
+        # Unknown hosts are reported on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = min(timeit.repeat(route, number=number, repeat=5)) / number
+    finally:
+        client.close()
+        server.close()
+    return seconds, result[0]
+
+
+def bench_client_hello(number: int) -> list[dict[str, Any]]:
+    hosts = HostTable()
+    samples = {
+        "typical": client_hello("api.together.xyz"),
+        "large": large_client_hello("api.together.xyz", 9000, 1200),
+        "unknown_host": client_hello("example.com"),
+    }
+    results = []
+    for name, hello in samples.items():
+        seconds, dest = time_hello(hello, hosts, number)
+        results.append({
+            "name": name,
+            "bytes": len(hello),
+            "destination": dest,
+            "per_call_us": seconds * 1e6,
+        })
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metrics(results: dict[str, Any]) -> dict[str, float]:
+    """
+    The numeric metrics of a run, by "<suite>/<name>/<metric>".
+    """
+    flat = {}
+    for suite in SUITES:
+        for entry in results.get(suite, []):
+            for key, value in entry.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    flat[f"{suite}/{entry['name']}/{key}"] = float(value)
+    return flat
+
+
+def compare(baseline: dict[str, Any], results: dict[str, Any]) -> None:
+    before, after = metrics(baseline), metrics(results)
+    print(f"Compared with {baseline['meta'].get('commit')}:", file=sys.stderr)
+    for key, value in after.items():
+        old = before.get(key)
+        if not old or key.endswith(("/chunk_size", "/connections", "/bytes")):
+            continue
+        change = (value - old) / old * 100
+        better = change < 0 if key.endswith(LOWER_IS_BETTER) else change > 0
+        flag = "" if abs(change) < 5 else " (better)" if better else " (WORSE)"
+        print(f"  {key:<48} {old:>12.2f} -> {value:>12.2f}  {change:+6.1f}%{flag}",
+              file=sys.stderr)
+
+
+@command()
+@option("--suite", "-s", type = Choice(SUITES), multiple = True, help = "Default: all")
+@option("--engine", "-e", type = Choice(ENGINES), multiple = True,
+        help = f"Engines for setup and concurrency (default: {ENGINE_THREAD})")
+@option("--size", type = int, default = 64, help = "MB per throughput run")
+@option("--repeat", type = int, default = 3, help = "Throughput runs (the best is kept)")
+@option("--connections", type = int, default = 2000, help = "Connections for setup")
+@option("--level", "levels", type = int, multiple = True,
+        help = "Concurrent connections (default: 100, 1000, 10000)")
+@option("--rounds", type = int, default = 10, help = "Round trips per connection for concurrency")
+@option("--number", type = int, default = 2000, help = "Calls per ClientHello timing")
+@option("--output", "-o", help = "Write the JSON results to this file (default: stdout)")
+@option("--compare", "baseline", help = "JSON results of an earlier run to compare with")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def main(
+        suite: tuple[str, ...],
+        engine: tuple[str, ...],
+        size: int,
+        repeat: int,
+        connections: int,
+        levels: tuple[int, ...],
+        rounds: int,
+        number: int,
+        output: Optional[str],
+        baseline: Optional[str],
+) -> None:
+    raise_fd_limit()
+    engines = engine or (ENGINE_THREAD,)
+    runs: dict[str, Callable[[], list[dict[str, Any]]]] = {
+        "throughput": lambda: bench_throughput(size * 1000000, repeat),
+        "setup": lambda: [bench_setup(e, connections) for e in engines],
+        "concurrency": lambda: [
+            bench_concurrency(e, n, rounds) for e in engines for n in levels or CONCURRENCY_LEVELS],
+        "client_hello": lambda: bench_client_hello(number),
+    }
+
+    results: dict[str, Any] = {
+        "meta": {
+            "commit": git_commit(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            # 10k concurrent connections need over 20k descriptors in the forwarder
+            "fd_limit": resource.getrlimit(resource.RLIMIT_NOFILE)[1],
+        },
+    }
+    for name in suite or SUITES:
+        print(f"{name} ...", file=sys.stderr)
+        results[name] = runs[name]()
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if baseline:
+        with open(baseline, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,87 @@
+"""
+Throughput of the core.relay modes for a large streamed response.
+
+A producer streams <size> MB into a loopback TCP connection, one relay thread
+moves it to a second loopback TCP connection (as socket_forward does for one
+direction of a forwarded connection), and a consumer drains it.
+
+Usage:
+  python core/benchmarks/bench_relay.py --size 512
+"""
+
+from typing import Any
+import resource
+import threading
+import time
+
+from click import command, option, Choice
+
+from core import relay
+from core.loopback import tcp_pair
+
+
+def bench_relay(mode: str, size: int, chunk_size: int) -> dict[str, Any]:
+    src_w, src = tcp_pair()
+    dst, dst_r = tcp_pair()
+    chunk = b"x" * chunk_size
+    received = 0
+
+    def produce() -> None:
+        sent = 0
+        while sent < size:
+            src_w.sendall(chunk)
+            sent += len(chunk)
+        src_w.close()
+
+    def consume() -> None:
+        nonlocal received
+        buf = bytearray(1 << 20)
+        while n := dst_r.recv_into(buf):
+            received += n
+
+    producer = threading.Thread(target=produce)
+    consumer = threading.Thread(target=consume)
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    producer.start()
+    consumer.start()
+    relay.relay(src, dst, mode)
+    dst.close()
+    producer.join()
+    consumer.join()
+    elapsed = time.perf_counter() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    src.close()
+    dst_r.close()
+    assert received >= size
+
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + \
+        (usage_end.ru_stime - usage_start.ru_stime)
+    return {
+        "mode": mode,
+        "bytes": received,
+        "seconds": elapsed,
+        "mb_per_s": received / elapsed / 1e6,
+        "cpu_seconds": cpu,
+    }
+
+
+@command()
+@option("--mode", "-m", type = Choice(relay.RELAYS), multiple = True)
+@option("--size", "-s", type = int, default = 512, help="MB to stream")
+@option("--chunk-size", "-c", type = int, default = 16384, help="Producer write size")
+@option("--repeat", "-r", type = int, default = 3)
+def main(mode: tuple[str, ...], size: int, chunk_size: int, repeat: int) -> None:
+    for m in mode or relay.RELAYS:
+        results = [bench_relay(m, size << 20, chunk_size) for _ in range(repeat)]
+        best = max(results, key=lambda r: float(r["mb_per_s"]))
+        print(
+            f"{m:>7}: {best['mb_per_s']:8.1f} MB/s"
+            f"  ({best['bytes'] >> 20} MB in {best['seconds']:.2f}s,"
+            f" cpu {best['cpu_seconds']:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,69 @@
+"""
+Latency of routing an https connection from its ClientHello.
+
+Compares the previous routing (substring scan of the known hosts over the
+first 4KB) with ClientHelloReader + HostTable, for a typical ClientHello and
+for a large multi-record one.
+
+Usage:
+  python core/benchmarks/bench_tls.py
+"""
+
+from typing import Callable, Optional
+import timeit
+
+from click import command, option
+
+from core.destinations import KNOWN_HOSTS, HostTable
+from core.tls import ClientHelloReader
+
+from tls_samples import client_hello, large_client_hello
+
+KNOWN_HOSTS_BYTES = [host.encode("ascii") for host in KNOWN_HOSTS]
+
+
+def substring_scan(data: bytes) -> Optional[str]:
+    leading_bytes = data[:4096]
+    for dest in KNOWN_HOSTS_BYTES:
+        if dest in leading_bytes:
+            return dest.decode("ascii")
+    return None
+
+
+def make_parse(hosts: HostTable, segment_size: int) -> Callable[[bytes], Optional[str]]:
+
+    def parse(data: bytes) -> Optional[str]:
+        reader = ClientHelloReader()
+        for i in range(0, len(data), segment_size):
+            reader.feed(data[i:i + segment_size])
+        return hosts.lookup(reader.server_name)
+
+    return parse
+
+
+def time_us(fn: Callable[[bytes], Optional[str]], data: bytes, number: int) -> float:
+    return min(timeit.repeat(lambda: fn(data), number=number, repeat=5)) / number * 1e6
+
+
+@command()
+@option("--number", "-n", type = int, default = 5000)
+def main(number: int) -> None:
+    hosts = HostTable()
+    samples = {
+        "typical": client_hello("api.together.xyz"),
+        "large (8 records)": large_client_hello("api.together.xyz", 9000, 1200),
+    }
+    parsers = {
+        "substring scan": substring_scan,
+        "reader, 1 segment": make_parse(hosts, 1 << 20),
+        "reader, 1460B segments": make_parse(hosts, 1460),
+    }
+    for sample_name, data in samples.items():
+        print(f"{sample_name} ClientHello ({len(data)} bytes):")
+        for parser_name, parser in parsers.items():
+            dest = parser(data)
+            print(f"  {parser_name:>24}: {time_us(parser, data, number):7.2f} us  -> {dest}")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
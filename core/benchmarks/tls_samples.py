@@ -0,0 +1,44 @@
+"""
+Sample ClientHello messages for the benchmarks.
+"""
+
+import ssl
+import struct
+
+
+def client_hello(server_name: str) -> bytes:
+    """
+    A real ClientHello (single TLS record) generated by the ssl module.
+    """
+    ctx = ssl.create_default_context()
+    conn = ctx.wrap_bio(ssl.MemoryBIO(), outgoing := ssl.MemoryBIO(),
+                        server_hostname=server_name)
+    try:
+        conn.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def large_client_hello(server_name: str, padding_length: int, record_size: int) -> bytes:
+    """
+    A ClientHello padded (extension 21) to the size of one carrying
+    post-quantum key shares, split into records of at most record_size bytes.
+    """
+    body = client_hello(server_name)[9:]
+    # legacy_version, random, session_id, cipher_suites, compression
+    offset = 2 + 32
+    offset += 1 + body[offset]
+    offset += 2 + int.from_bytes(body[offset:offset + 2], "big")
+    offset += 1 + body[offset]
+    extensions_length = int.from_bytes(body[offset:offset + 2], "big")
+    extensions = body[offset + 2:offset + 2 + extensions_length]
+    extensions += struct.pack(">HH", 21, padding_length) + b"\0" * padding_length
+    body = body[:offset] + struct.pack(">H", len(extensions)) + extensions
+    handshake = b"\x01" + len(body).to_bytes(3, "big") + body
+
+    records = b""
+    for i in range(0, len(handshake), record_size):
+        fragment = handshake[i:i + record_size]
+        records += struct.pack(">BBBH", 0x16, 3, 1, len(fragment)) + fragment
+    return records
@@ -0,0 +1,209 @@
+from typing import Any, Callable, Coroutine, Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import asyncio
+import socket
+import threading
+import time
+
+ConnectionHandler = Callable[[socket.socket], Coroutine[Any, Any, None]]
+
+# What to do with a new connection when max_connections are being handled and
+# queue_size connections are already waiting:
+#   queue  - stop accepting until a slot frees (clients wait in the listen
+#            backlog)
+#   reject - close the new connection immediately
+POLICY_QUEUE = "queue"
+POLICY_REJECT = "reject"
+POLICIES = [POLICY_QUEUE, POLICY_REJECT]
+
+DEFAULT_BACKLOG = socket.SOMAXCONN
+
+
+@dataclass
+class AdmissionConfig:
+    """
+    Limits applied to the connections accepted by a forwarder.  With the
+    default max_connections=None, every connection is handled immediately.
+    """
+    backlog: int = DEFAULT_BACKLOG
+    max_connections: Optional[int] = None
+    queue_size: int = 0
+    policy: str = POLICY_QUEUE
+
+    # Seconds between reports of the admission state, printed if it changed
+    # (0 to disable)
+    report_interval: float = 60.0
+
+    def __post_init__(self) -> None:
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown admission policy: {self.policy}")
+        if self.max_connections is not None and self.max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        if self.backlog < 1 or self.queue_size < 0:
+            raise ValueError("invalid backlog or queue size")
+
+
+@dataclass
+class AdmissionStats:
+    active: int = 0
+    queued: int = 0
+    accepted: int = 0
+    rejected: int = 0
+
+
+class Admission:
+    """
+    Counting and reporting shared by the thread and asyncio admission
+    controllers.
+    """
+
+    def __init__(self, config: AdmissionConfig, name: str) -> None:
+        self.config = config
+        self.name = name
+        self._stats = AdmissionStats()
+        self._lock = threading.Lock()
+        self._reported: Optional[AdmissionStats] = None
+        self._reporter: Optional[threading.Thread] = None
+
+    def stats(self) -> AdmissionStats:
+        with self._lock:
+            return AdmissionStats(**vars(self._stats))
+
+    def report(self, force: bool = False) -> None:
+        """
+        Print the admission state, if it changed since the last report.
+        """
+        stats = self.stats()
+        if not force and stats == self._reported:
+            return
+        self._reported = stats
+        print(
+            f"[{self.name}] active={stats.active} queued={stats.queued}"
+            f" accepted={stats.accepted} rejected={stats.rejected}")
+
+    def _report_loop(self) -> None:
+        # On a timer rather than on new connections, so that a queue is
+        # seen to drain once they stop
+        while True:
+            time.sleep(self.config.report_interval)
+            self.report()
+
+    def _on_admit(self) -> None:
+        with self._lock:
+            self._stats.accepted += 1
+            self._stats.queued += 1
+            if self._reporter is None and self.config.report_interval > 0:
+                self._reporter = threading.Thread(
+                    target=self._report_loop, name=f"{self.name}-report", daemon=True)
+                self._reporter.start()
+
+    def _on_start(self) -> None:
+        with self._lock:
+            self._stats.queued -= 1
+            self._stats.active += 1
+
+    def _on_finish(self) -> None:
+        with self._lock:
+            self._stats.active -= 1
+
+    def _on_reject(self, s: socket.socket) -> None:
+        with self._lock:
+            self._stats.rejected += 1
+            first = self._stats.rejected == 1
+        s.close()
+        if first:
+            self.report(force=True)
+
+
+class ThreadAdmission(Admission):
+    """
+    Runs connection handlers on a bounded pool of max_connections worker
+    threads, holding at most queue_size further connections waiting for a
+    worker.  If max_connections is None, each connection gets its own thread.
+    """
+
+    def __init__(self, config: AdmissionConfig, name: str) -> None:
+        super().__init__(config, name)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[threading.Semaphore] = None
+        if config.max_connections is not None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=config.max_connections,
+                thread_name_prefix=name)
+            self._slots = threading.Semaphore(config.max_connections + config.queue_size)
+
+    def submit(self, handler: Callable[[socket.socket], None], s: socket.socket) -> None:
+        """
+        Called from the accept loop for each new connection.  May block (queue
+        policy) until there is room for the connection.
+        """
+        if self._slots is not None:
+            blocking = self.config.policy == POLICY_QUEUE
+            # Released when the handler completes
+            # pylint: disable=consider-using-with
+            if not self._slots.acquire(blocking=blocking):
+                self._on_reject(s)
+                return
+
+        self._on_admit()
+
+        def run() -> None:
+            self._on_start()
+            try:
+                handler(s)
+            finally:
+                self._on_finish()
+                if self._slots is not None:
+                    self._slots.release()
+
+        if self._executor is not None:
+            self._executor.submit(run)
+        else:
+            threading.Thread(target=run).start()
+
+
+class AsyncAdmission(Admission):
+    """
+    Admission control for the asyncio engine: at most max_connections
+    handlers run at once, and at most queue_size more wait for a slot.
+    """
+
+    def __init__(self, config: AdmissionConfig, name: str) -> None:
+        super().__init__(config, name)
+        self._active: Optional[asyncio.Semaphore] = None
+        self._held: Optional[asyncio.Semaphore] = None
+        if config.max_connections is not None:
+            self._active = asyncio.Semaphore(config.max_connections)
+            self._held = asyncio.Semaphore(config.max_connections + config.queue_size)
+
+    async def admit(self, s: socket.socket) -> bool:
+        """
+        Called from the accept loop for each new connection.  Returns False if
+        the connection was rejected.
+        """
+        if self._held is not None:
+            if self._held.locked() and self.config.policy == POLICY_REJECT:
+                self._on_reject(s)
+                return False
+            await self._held.acquire()
+        self._on_admit()
+        return True
+
+    async def run(self, handler: ConnectionHandler, s: socket.socket) -> None:
+        """
+        Run the handler for an admitted connection once a slot is free.
+        """
+        try:
+            if self._active is not None:
+                await self._active.acquire()
+            self._on_start()
+            try:
+                await handler(s)
+            finally:
+                self._on_finish()
+                if self._active is not None:
+                    self._active.release()
+        finally:
+            if self._held is not None:
+                self._held.release()
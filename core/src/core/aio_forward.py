@@ -0,0 +1,256 @@
+from typing import Any, Awaitable, Callable, Coroutine, Optional
+import asyncio
+import socket
+
+from .admission import AsyncAdmission, ConnectionHandler
+from .balancer import Backend, Balancer
+from .destinations import HostTable, route_client_hello
+from .forward_config import ForwardConfig
+from .tls import ClientHelloReader, TlsParseError, CLIENT_HELLO_TIMEOUT
+from .upstream import aconnect_upstream, warm_upstream
+
+BUFFER_SIZE = 4096
+
+
+async def socket_forward(
+        src: socket.socket,
+        dst: socket.socket) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # sock_recv only allocates once data is available, so a waiting
+            # connection costs no buffer memory.
+            data = await loop.sock_recv(src, BUFFER_SIZE)
+            if not data:
+                break
+            await loop.sock_sendall(dst, data)
+    except Exception: # pylint: disable = broad-exception-caught
+        pass
+
+
+async def connect_sockets(
+        s_a: socket.socket,
+        s_b: socket.socket
+) -> None:
+    try:
+        await asyncio.gather(
+            socket_forward(s_a, s_b),
+            socket_forward(s_b, s_a),
+        )
+    finally:
+        s_a.close()
+        s_b.close()
+
+
+async def determine_https_destination(
+        s: socket.socket,
+        hosts: HostTable) -> tuple[Optional[str], bytes]:
+    loop = asyncio.get_running_loop()
+    return await route_https(lambda size: loop.sock_recv(s, size), hosts)
+
+
+async def route_https(
+        recv: Callable[[int], Awaitable[bytes]],
+        hosts: HostTable) -> tuple[Optional[str], bytes]:
+    """
+    Read a TLS ClientHello using recv(max_bytes) and look up the requested
+    server name in hosts.  Returns the destination host (or None) and the bytes
+    read.
+    """
+    reader = ClientHelloReader()
+
+    async def read_client_hello() -> None:
+        while not reader.done:
+            data = await recv(reader.wanted())
+            if not data:
+                break
+            reader.feed(data)
+
+    try:
+        await asyncio.wait_for(read_client_hello(), CLIENT_HELLO_TIMEOUT)
+    except (TlsParseError, asyncio.TimeoutError) as e:
+        print(f"!! invalid ClientHello: {e!r}")
+
+    return (route_client_hello(reader, hosts), reader.data)
+
+
+async def open_socket(family: int, address: tuple[object, ...]) -> socket.socket:
+    """
+    Create a non-blocking stream socket of the given family and connect it.
+    """
+    loop = asyncio.get_running_loop()
+    r = socket.socket(family, socket.SOCK_STREAM)
+    r.setblocking(False)
+    try:
+        await loop.sock_connect(r, address)
+    except BaseException:
+        r.close()
+        raise
+    return r
+
+
+async def forward_socket_to_ip(
+        s: socket.socket,
+        remote_host: str,
+        remote_port: int,
+        leading_bytes: Optional[bytes] = None,
+        config: Optional[ForwardConfig] = None) -> None:
+    config = config or ForwardConfig()
+    r = await aconnect_upstream(remote_host, remote_port, config.upstream)
+    if leading_bytes:
+        await asyncio.get_running_loop().sock_sendall(r, leading_bytes)
+    await connect_sockets(s, r)
+
+
+async def serve_connections(
+        server_socket: socket.socket,
+        handle_connection: ConnectionHandler,
+        admission: AsyncAdmission,
+) -> None:
+    """
+    Accept connections on server_socket forever, running handle_connection as
+    a task for each connection admitted.
+    """
+    loop = asyncio.get_running_loop()
+    server_socket.setblocking(False)
+
+    # Keep references to running tasks so they are not garbage collected.
+    tasks: set[asyncio.Task[None]] = set()
+    while True:
+        client_socket, _ = await loop.sock_accept(server_socket)
+        client_socket.setblocking(False)
+        if not await admission.admit(client_socket):
+            continue
+        task = loop.create_task(admission.run(handle_connection, client_socket))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+async def log_connection(
+        s: socket.socket,
+        destination: str,
+        forward_connection: Callable[[], Coroutine[Any, Any, None]],
+) -> None:
+    """
+    Run forward_connection for the client socket s, logging the connection
+    and any error.
+    """
+    peername = s.getpeername()
+    print(f" connection from {peername} -> ({destination})")
+    try:
+        await forward_connection()
+    except Exception as e: # pylint: disable = broad-exception-caught
+        print(f" error handling {peername}: {e}")
+    finally:
+        # Closing an already closed socket is a no-op
+        s.close()
+        print(f" closed {peername}")
+
+
+async def forward_connections_to_ip(
+        server_socket: socket.socket,
+        remote_host: str,
+        remote_port: int,
+        config: Optional[ForwardConfig] = None) -> None:
+    config = config or ForwardConfig()
+    destination = f"{remote_host}:{remote_port}"
+
+    async def handle_connection(s: socket.socket) -> None:
+        await log_connection(
+            s,
+            destination,
+            lambda: forward_socket_to_ip(s, remote_host, remote_port, config=config))
+
+    admission = AsyncAdmission(config.admission, destination)
+    await serve_connections(server_socket, handle_connection, admission)
+
+
+async def forward_connections_to_vsock(
+        server_socket: socket.socket,
+        vsock_addr: Optional[int],
+        vsock_port: int,
+        config: Optional[ForwardConfig] = None,
+) -> None:
+    config = config or ForwardConfig()
+    destination = f"{vsock_addr}:{vsock_port}"
+
+    async def connect_vsock(s: socket.socket) -> None:
+        # pylint: disable=no-member
+        vsock = await open_socket(
+            socket.AF_VSOCK,  # type: ignore
+            (vsock_addr, vsock_port))
+        await connect_sockets(s, vsock)
+
+    async def handle_connection(s: socket.socket) -> None:
+        await log_connection(s, destination, lambda: connect_vsock(s))
+
+    admission = AsyncAdmission(config.admission, destination)
+    await serve_connections(server_socket, handle_connection, admission)
+
+
+async def connect_backend(balancer: Balancer) -> tuple[Backend, socket.socket]:
+    """
+    As Balancer.connect, on the event loop.
+    """
+    tried: frozenset[Backend] = frozenset()
+    while True:
+        backend = balancer.acquire(tried)
+        if backend is None:
+            raise ConnectionError("no healthy backend")
+        try:
+            r = await asyncio.wait_for(
+                open_socket(backend.family, backend.address),
+                balancer.config.health_timeout)
+            return backend, r
+        except (OSError, asyncio.TimeoutError) as e:
+            balancer.connect_failed(backend, e)
+            tried |= {backend}
+
+
+async def forward_connections_to_backends(
+        server_socket: socket.socket,
+        balancer: Balancer,
+        config: Optional[ForwardConfig] = None,
+) -> None:
+    config = config or ForwardConfig()
+
+    async def forward_connection(s: socket.socket) -> None:
+        backend, r = await connect_backend(balancer)
+        try:
+            await connect_sockets(s, r)
+        finally:
+            balancer.release(backend)
+
+    async def handle_connection(s: socket.socket) -> None:
+        await log_connection(s, "backends", lambda: forward_connection(s))
+
+    admission = AsyncAdmission(config.admission, "backends")
+    await serve_connections(server_socket, handle_connection, admission)
+
+
+async def forward_https_connections_to_ip(
+        server_socket: socket.socket,
+        remote_port: int,
+        config: Optional[ForwardConfig] = None,
+) -> None:
+    config = config or ForwardConfig()
+    hosts = config.known_hosts
+
+    async def handle_connection(s: socket.socket) -> None:
+        try:
+            print(f" connection from {s.getpeername()}")
+            (dest_host, leading_bytes) = await determine_https_destination(s, hosts)
+            if dest_host:
+                print(f" (https) connection from {s.getpeername()} -> {dest_host}:{remote_port}")
+                await forward_socket_to_ip(
+                    s, dest_host, remote_port, leading_bytes, config)
+            else:
+                print(f"!! dropping connection ({len(leading_bytes)} bytes read)")
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f" error handling https connection: {e}")
+        finally:
+            s.close()
+
+    warm_upstream(hosts, remote_port, config.upstream)
+    admission = AsyncAdmission(config.admission, f"https:{remote_port}")
+    await serve_connections(server_socket, handle_connection, admission)
@@ -0,0 +1,291 @@
+from typing import Any, Callable, Optional
+from dataclasses import dataclass
+import random
+import socket
+import threading
+
+# How a backend is chosen for each connection
+#   least-connections - the healthy backend with the fewest open connections
+#   two-choices       - the less loaded of two healthy backends picked at
+#                       random (power of two choices)
+POLICY_LEAST_CONNECTIONS = "least-connections"
+POLICY_TWO_CHOICES = "two-choices"
+BALANCE_POLICIES = [POLICY_LEAST_CONNECTIONS, POLICY_TWO_CHOICES]
+
+# Backends given as "<cid>" or "vsock:<cid>[:<port>]" are enclaves; others
+# ("<host>:<port>") are TCP servers, for testing without Nitro
+VSOCK_PREFIX = "vsock:"
+
+
+@dataclass(frozen=True)
+class Backend:
+    """
+    A server that connections can be forwarded to: an enclave (vsock CID and
+    port) or a TCP host and port.
+    """
+    family: int
+    host: Any
+    port: int
+
+    @classmethod
+    def vsock(cls, cid: int, port: int) -> "Backend":
+        return cls(socket.AF_VSOCK, cid, port)  # type: ignore # pylint: disable=no-member
+
+    @classmethod
+    def tcp(cls, host: str, port: int) -> "Backend":
+        return cls(socket.AF_INET, host, port)
+
+    @property
+    def address(self) -> tuple[Any, int]:
+        return (self.host, self.port)
+
+    def __str__(self) -> str:
+        if self.family == socket.AF_INET:
+            return f"{self.host}:{self.port}"
+        return f"{VSOCK_PREFIX}{self.host}:{self.port}"
+
+    def connect(self, timeout: Optional[float] = None) -> socket.socket:
+        """
+        A blocking socket connected to the backend.
+        """
+        s = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            s.settimeout(timeout)
+            s.connect(self.address)
+            s.settimeout(None)
+        except BaseException:
+            s.close()
+            raise
+        return s
+
+
+def parse_backend(spec: str, default_port: int) -> Backend:
+    """
+    Parse "<cid>", "vsock:<cid>[:<port>]" or "<host>:<port>".
+    """
+    spec = spec.strip()
+    if spec.isdigit():
+        return Backend.vsock(int(spec), default_port)
+    if spec.startswith(VSOCK_PREFIX):
+        cid, _, port = spec[len(VSOCK_PREFIX):].partition(":")
+        return Backend.vsock(int(cid), int(port) if port else default_port)
+    host, sep, port = spec.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError(f"Invalid backend (expected <cid> or <host>:<port>): {spec}")
+    return Backend.tcp(host, int(port))
+
+
+@dataclass(frozen=True)
+class BalancerConfig:
+    """
+    Spreading connections across several backends.
+    """
+    policy: str = POLICY_LEAST_CONNECTIONS
+
+    # Seconds between health checks of each backend, and allowed for each
+    health_interval: float = 5.0
+    health_timeout: float = 2.0
+
+    # A backend is healthy if a GET of this path returns 200
+    health_path: str = "/enclave/address"
+
+    # Consecutive failed checks (or connections) before a backend is
+    # ejected, and passed checks before it is re-admitted
+    fall: int = 2
+    rise: int = 2
+
+    # Seconds between discoveries of the set of backends
+    discover_interval: float = 30.0
+
+    def __post_init__(self) -> None:
+        if self.policy not in BALANCE_POLICIES:
+            raise ValueError(f"Unknown balancing policy: {self.policy}")
+        if self.health_interval <= 0 or self.health_timeout <= 0 or self.discover_interval <= 0:
+            raise ValueError("intervals and timeouts must be positive")
+        if self.fall < 1 or self.rise < 1:
+            raise ValueError("fall and rise must be at least 1")
+
+
+@dataclass
+class BackendState:
+    backend: Backend
+    healthy: bool = True
+    # Open forwarded connections
+    active: int = 0
+    connections: int = 0
+    # Consecutive failures while healthy, or passes while ejected
+    failures: int = 0
+    passes: int = 0
+
+
+def check_health(backend: Backend, path: str, timeout: float) -> bool:
+    """
+    True if the backend answers a GET of path with status 200.
+    """
+    try:
+        with backend.connect(timeout) as s:
+            s.settimeout(timeout)
+            s.sendall(
+                f"GET {path} HTTP/1.1\r\nHost: enclave\r\nConnection: close\r\n\r\n".encode())
+            status_line = s.makefile("rb").readline()
+    except OSError:
+        return False
+    parts = status_line.split()
+    return len(parts) >= 2 and parts[1] == b"200"
+
+
+class Balancer: # pylint: disable=too-many-instance-attributes
+    """
+    The backends returned by discover(), with their health and open
+    connections.  A background thread re-runs discover() and health checks
+    every backend, ejecting those that fail config.fall checks in a row and
+    re-admitting them after config.rise passes.  A newly discovered backend
+    is admitted once it passes a check.
+    """
+
+    def __init__(
+            self,
+            discover: Callable[[], list[Backend]],
+            config: Optional[BalancerConfig] = None,
+            check: Callable[[Backend, str, float], bool] = check_health,
+    ) -> None:
+        self.discover = discover
+        self.config = config or BalancerConfig()
+        self.check = check
+        self._states: dict[Backend, BackendState] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._random = random.Random()
+
+    def refresh(self) -> None:
+        """
+        Update the set of backends from discover().  Backends that are gone
+        are dropped (their open connections are left alone).
+        """
+        try:
+            backends = self.discover()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f"!! discovering backends: {e}")
+            return
+        with self._lock:
+            for backend in set(self._states) - set(backends):
+                print(f"backend removed: {backend}")
+                del self._states[backend]
+            for backend in backends:
+                if backend not in self._states:
+                    print(f"backend added: {backend}")
+                    # Admitted by its first passing check
+                    self._states[backend] = BackendState(
+                        backend, healthy=False, passes=self.config.rise - 1)
+
+    def check_all(self) -> None:
+        with self._lock:
+            backends = list(self._states)
+        for backend in backends:
+            ok = self.check(backend, self.config.health_path, self.config.health_timeout)
+            self.record(backend, ok)
+
+    def record(self, backend: Backend, ok: bool) -> None:
+        """
+        Record the result of a health check (or connection attempt).
+        """
+        with self._lock:
+            state = self._states.get(backend)
+            if state is None:
+                return
+            if state.healthy:
+                state.failures = 0 if ok else state.failures + 1
+                if state.failures >= self.config.fall:
+                    state.healthy = False
+                    state.passes = 0
+                    print(f"!! backend ejected: {backend}")
+            else:
+                state.passes = state.passes + 1 if ok else 0
+                if state.passes >= self.config.rise:
+                    state.healthy = True
+                    state.failures = 0
+                    print(f"backend admitted: {backend}")
+
+    def acquire(self, exclude: frozenset[Backend] = frozenset()) -> Optional[Backend]:
+        """
+        Choose a healthy backend by the configured policy, and count a
+        connection to it as open until release().  None if there is no
+        healthy backend.
+        """
+        with self._lock:
+            candidates = [
+                state for state in self._states.values()
+                if state.healthy and state.backend not in exclude]
+            if not candidates:
+                return None
+            if self.config.policy == POLICY_TWO_CHOICES and len(candidates) > 2:
+                candidates = self._random.sample(candidates, 2)
+            state = min(candidates, key=lambda state: state.active)
+            state.active += 1
+            state.connections += 1
+            return state.backend
+
+    def release(self, backend: Backend) -> None:
+        with self._lock:
+            state = self._states.get(backend)
+            if state is not None:
+                state.active -= 1
+
+    def connect(self) -> tuple[Backend, socket.socket]:
+        """
+        Acquire a backend and connect to it, trying the others if it
+        refuses.  The caller releases the backend.
+        """
+        tried: frozenset[Backend] = frozenset()
+        while True:
+            backend = self.acquire(tried)
+            if backend is None:
+                raise ConnectionError("no healthy backend")
+            try:
+                return backend, backend.connect(self.config.health_timeout)
+            except OSError as e:
+                self.connect_failed(backend, e)
+                tried |= {backend}
+
+    def connect_failed(self, backend: Backend, error: Exception) -> None:
+        print(f"!! connecting to {backend}: {error}")
+        self.release(backend)
+        self.record(backend, False)
+
+    def stats(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "backend": str(state.backend),
+                    "healthy": state.healthy,
+                    "active": state.active,
+                    "connections": state.connections,
+                }
+                for state in self._states.values()
+            ]
+
+    def start(self) -> None:
+        """
+        Discover and check the backends, then keep doing so in a background
+        thread.
+        """
+        self.refresh()
+        self.check_all()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._monitor, name="balancer", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _monitor(self) -> None:
+        since_discovery = 0.0
+        while not self._stop.wait(self.config.health_interval):
+            since_discovery += self.config.health_interval
+            if since_discovery >= self.config.discover_interval:
+                since_discovery = 0.0
+                self.refresh()
+            self.check_all()
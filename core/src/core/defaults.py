@@ -8,6 +8,9 @@ DEFAULT_VSOCK_PROXY_PORT=5002
 
 DEFAULT_VSOCK_PROXY_ADDR=3
 
+# The enclave accepts multiplexed tunnel channels from the host on this port
+DEFAULT_TUNNEL_PORT=5003
+
 DEFAULT_REMOTE_HOST = "localhost"
 
 DEFAULT_REMOTE_PORT = 443
@@ -0,0 +1,68 @@
+from typing import Iterable, Iterator, Optional
+import json
+
+from .tls import ClientHelloReader
+
+# Match the values in Dockerfile-enclave
+KNOWN_HOSTS = (
+    'api.openai.com',
+    'api.anthropic.com',
+    'api.together.xyz',
+)
+
+
+class HostTable:
+    """
+    Hashed allow-list of https destinations, keyed by server name.
+    """
+
+    def __init__(self, hosts: Iterable[str] = KNOWN_HOSTS) -> None:
+        self._hosts = frozenset(host.strip().lower().rstrip(".") for host in hosts)
+
+    def __contains__(self, host: str) -> bool:
+        return host in self._hosts
+
+    def __len__(self) -> int:
+        return len(self._hosts)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(sorted(self._hosts))
+
+    def lookup(self, server_name: Optional[str]) -> Optional[str]:
+        """
+        Return the allowed destination host for a server name, or None.
+        """
+        if server_name is None:
+            return None
+        server_name = server_name.lower().rstrip(".")
+        return server_name if server_name in self._hosts else None
+
+
+def load_host_table(path: str) -> HostTable:
+    """
+    Load a HostTable from a file containing either a JSON list of host names,
+    or one host name per line ('#' starts a comment).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        contents = f.read()
+
+    if contents.lstrip().startswith("["):
+        hosts = json.loads(contents)
+        if not all(isinstance(host, str) for host in hosts):
+            raise ValueError(f"{path}: expected a list of host names")
+        return HostTable(hosts)
+
+    lines = (line.split("#", 1)[0].strip() for line in contents.splitlines())
+    return HostTable(line for line in lines if line)
+
+
+def route_client_hello(reader: ClientHelloReader, hosts: HostTable) -> Optional[str]:
+    """
+    Destination host for a completely read ClientHello, or None.
+    """
+    if not reader.done:
+        return None
+    dest_host = hosts.lookup(reader.server_name)
+    if dest_host is None:
+        print(f"!! host not allowed: {reader.server_name}")
+    return dest_host
@@ -1,35 +1,57 @@
 from typing import Optional
+import asyncio
 import socket
 import threading
+import time
+
+from . import aio_forward
+from .admission import ThreadAdmission
+from .balancer import Balancer
+from .destinations import HostTable, route_client_hello
+from .forward_config import ForwardConfig, ENGINE_ASYNCIO
+from .relay import relay, RELAY_COPY
+from .tls import ClientHelloReader, TlsParseError, CLIENT_HELLO_TIMEOUT
+from .upstream import connect_upstream, warm_upstream
+
+def determine_https_destination(
+        s: socket.socket,
+        hosts: Optional[HostTable] = None) -> tuple[Optional[str], bytes]:
+    """
+    Read the TLS ClientHello from s (and nothing beyond it), and look up the
+    requested server name in hosts.  Returns the destination host (None if the
+    hello is malformed, incomplete or for an unknown host), and the bytes read.
+    """
+    if hosts is None:
+        hosts = HostTable()
 
-# Match the values in Dockerfile-enclave
-KNOWN_HOSTS = [
-    b'api.openai.com',
-    b'api.anthropic.com',
-    b'api.together.xyz',
-]
-
-BUFFER_SIZE = 4096
-
-
-def determine_https_destination(s: socket.socket) -> tuple[Optional[str], bytes]:
-    leading_bytes = s.recv(BUFFER_SIZE)
-    for dest in KNOWN_HOSTS:
-        if dest in leading_bytes:
-            return (dest.decode('ascii'), leading_bytes)
+    reader = ClientHelloReader()
+    timeout = s.gettimeout()
+    # The limit is on the whole hello, not on each read
+    deadline = time.monotonic() + CLIENT_HELLO_TIMEOUT
+    try:
+        while not reader.done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("timed out")
+            s.settimeout(remaining)
+            data = s.recv(reader.wanted())
+            if not data:
+                break
+            reader.feed(data)
+    except (TlsParseError, TimeoutError) as e:
+        print(f"!! invalid ClientHello: {e}")
+    finally:
+        s.settimeout(timeout)
 
-    return (None, leading_bytes)
+    return (route_client_hello(reader, hosts), reader.data)
 
 
 def socket_forward(
         src: socket.socket,
-        dst: socket.socket) -> None:
+        dst: socket.socket,
+        relay_mode: str = RELAY_COPY) -> None:
     try:
-        while True:
-            data = src.recv(BUFFER_SIZE)
-            if not data:
-                break
-            dst.sendall(data)
+        relay(src, dst, relay_mode)
     except Exception: # pylint: disable = broad-exception-caught
         # print(f"  Data forwarding error ({src} -> {dst}): {e}")
         pass
@@ -37,13 +59,14 @@ def socket_forward(
 
 def connect_sockets(
         s_a: socket.socket,
-        s_b: socket.socket
+        s_b: socket.socket,
+        relay_mode: str = RELAY_COPY,
 ) -> None:
 
     try:
         # Start two threads to forward data in both directions
-        t_a = threading.Thread(target=socket_forward, args=(s_a, s_b))
-        t_b = threading.Thread(target=socket_forward, args=(s_b, s_a))
+        t_a = threading.Thread(target=socket_forward, args=(s_a, s_b, relay_mode))
+        t_b = threading.Thread(target=socket_forward, args=(s_b, s_a, relay_mode))
         t_a.start()
         t_b.start()
         t_a.join()
@@ -57,24 +80,27 @@ def forward_socket_to_ip(
         s: socket.socket,
         remote_host: str,
         remote_port: int,
-        leading_bytes: Optional[bytes] = None) -> None:
-    r = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    r.connect((remote_host, remote_port))
+        leading_bytes: Optional[bytes] = None,
+        config: Optional[ForwardConfig] = None) -> None:
+    config = config or ForwardConfig()
+    r = connect_upstream(remote_host, remote_port, config.upstream)
     if leading_bytes:
         r.sendall(leading_bytes)
-    connect_sockets(s, r)
+    connect_sockets(s, r, config.relay)
 
 
 def forward_connections_to_ip(
         server_socket: socket.socket,
         remote_host: str,
-        remote_port: int) -> None:
+        remote_port: int,
+        config: Optional[ForwardConfig] = None) -> None:
+    config = config or ForwardConfig()
 
     def handle_connection(s: socket.socket) -> None:
         peername = s.getpeername()
         print(f" connection from {peername} -> ({remote_host}:{remote_port})")
         try:
-            forward_socket_to_ip(s, remote_host, remote_port)
+            forward_socket_to_ip(s, remote_host, remote_port, config=config)
         except Exception as e: # pylint: disable = broad-exception-caught
             print(f" error handling {peername}: {e}")
             s.close()
@@ -82,21 +108,21 @@ def forward_connections_to_ip(
         finally:
             print(f" closed {peername}")
 
+    admission = ThreadAdmission(config.admission, f"{remote_host}:{remote_port}")
     while True:
         # Accept a new client connection
         client_socket, _ = server_socket.accept()
-        # Handle the client connection in a new thread
-        threading.Thread(
-            target=handle_connection,
-            args=[client_socket],
-        ).start()
+        # Handle the client connection on a worker thread
+        admission.submit(handle_connection, client_socket)
 
 
 def forward_connections_to_vsock(
         server_socket: socket.socket,
         vsock_addr: Optional[int],
         vsock_port: int,
+        config: Optional[ForwardConfig] = None,
 ) -> None:
+    config = config or ForwardConfig()
 
     def handle_connection(s: socket.socket) -> None:
         peername = s.getpeername()
@@ -106,7 +132,7 @@ def forward_connections_to_vsock(
             vsock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)  # type: ignore
 
             vsock.connect((vsock_addr, vsock_port))
-            connect_sockets(s, vsock)
+            connect_sockets(s, vsock, config.relay)
 
         except Exception as e: # pylint: disable=broad-exception-caught
             print(f" error handling {peername}: {e}")
@@ -115,60 +141,213 @@ def forward_connections_to_vsock(
         finally:
             print(f" closed {peername}")
 
+    admission = ThreadAdmission(config.admission, f"{vsock_addr}:{vsock_port}")
     while True:
         # Accept a new client connection
         client_socket, _ = server_socket.accept()
-        # Handle the client connection in a new thread
-        threading.Thread(
-            target=handle_connection,
-            args=[client_socket],
-        ).start()
+        # Handle the client connection on a worker thread
+        admission.submit(handle_connection, client_socket)
+
+
+def forward_connections_to_backends(
+        server_socket: socket.socket,
+        balancer: Balancer,
+        config: Optional[ForwardConfig] = None,
+) -> None:
+    """
+    Forward each connection accepted on server_socket to a backend chosen by
+    balancer.
+    """
+    config = config or ForwardConfig()
+
+    def handle_connection(s: socket.socket) -> None:
+        peername = s.getpeername()
+        try:
+            backend, r = balancer.connect()
+            print(f" connection from {peername} -> ({backend})")
+            try:
+                connect_sockets(s, r, config.relay)
+            finally:
+                balancer.release(backend)
+
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f" error handling {peername}: {e}")
+            s.close()
+
+        finally:
+            print(f" closed {peername}")
+
+    admission = ThreadAdmission(config.admission, "backends")
+    while True:
+        client_socket, _ = server_socket.accept()
+        admission.submit(handle_connection, client_socket)
 
 
 def forward_https_connections_to_ip(
         server_socket: socket.socket,
         remote_port: int,
+        config: Optional[ForwardConfig] = None,
 ) -> None:
+    config = config or ForwardConfig()
 
     def handle_connection(s: socket.socket) -> None:
         try:
-            (dest_host, leading_bytes) = determine_https_destination(s)
+            print(f" connection from {s.getpeername()}")
+            (dest_host, leading_bytes) = determine_https_destination(s, config.known_hosts)
             if dest_host:
                 print(f" (https) connection from {s.getpeername()} -> {dest_host}:{remote_port}")
-                forward_socket_to_ip(s, dest_host, remote_port, leading_bytes)
+                forward_socket_to_ip(s, dest_host, remote_port, leading_bytes, config)
             else:
-                print(f"!! no known host in leading bytes: {leading_bytes!r}")
-
+                print(f"!! dropping connection ({len(leading_bytes)} bytes read)")
+        except OSError as e:
+            # e.g. reset by the client, or the upstream refusing the connection
+            print(f" error handling https connection: {e}")
         finally:
             s.close()
 
+    warm_upstream(config.known_hosts, remote_port, config.upstream)
+    admission = ThreadAdmission(config.admission, f"https:{remote_port}")
     while True:
         client_socket, _ = server_socket.accept()
-        peername = client_socket.getpeername()
-        print(f" connection from {peername}")
-        threading.Thread(
-            target=handle_connection,
-            args=[client_socket],
-        ).start()
+        admission.submit(handle_connection, client_socket)
+
+
+def serve_connections_to_ip(
+        server_socket: socket.socket,
+        remote_host: str,
+        remote_port: int,
+        config: ForwardConfig,
+) -> None:
+    """
+    Forward connections accepted on server_socket to <remote_host>:<remote_port>
+    using the configured engine.
+    """
+    if config.engine == ENGINE_ASYNCIO:
+        asyncio.run(aio_forward.forward_connections_to_ip(
+            server_socket, remote_host, remote_port, config))
+    else:
+        forward_connections_to_ip(server_socket, remote_host, remote_port, config)
+
+
+def serve_connections_to_vsock(
+        server_socket: socket.socket,
+        vsock_addr: Optional[int],
+        vsock_port: int,
+        config: ForwardConfig,
+) -> None:
+    """
+    Forward connections accepted on server_socket to vsock
+    <vsock_addr>:<vsock_port> using the configured engine.
+    """
+    if config.engine == ENGINE_ASYNCIO:
+        asyncio.run(aio_forward.forward_connections_to_vsock(
+            server_socket, vsock_addr, vsock_port, config))
+    else:
+        forward_connections_to_vsock(server_socket, vsock_addr, vsock_port, config)
+
+
+def serve_connections_to_backends(
+        server_socket: socket.socket,
+        balancer: Balancer,
+        config: ForwardConfig,
+) -> None:
+    """
+    Forward connections accepted on server_socket across the backends of
+    balancer, using the configured engine.
+    """
+    if config.engine == ENGINE_ASYNCIO:
+        asyncio.run(aio_forward.forward_connections_to_backends(
+            server_socket, balancer, config))
+    else:
+        forward_connections_to_backends(server_socket, balancer, config)
+
+
+def serve_https_connections_to_ip(
+        server_socket: socket.socket,
+        remote_port: int,
+        config: ForwardConfig,
+) -> None:
+    """
+    Forward https connections accepted on server_socket to <host>:<remote_port>,
+    where host is determined from the TLS ClientHello, using the configured
+    engine.
+    """
+    if config.engine == ENGINE_ASYNCIO:
+        asyncio.run(aio_forward.forward_https_connections_to_ip(
+            server_socket, remote_port, config))
+    else:
+        forward_https_connections_to_ip(server_socket, remote_port, config)
+
+
+def listen_ip(
+        local_host: str,
+        local_port: int,
+        config: ForwardConfig,
+) -> socket.socket:
+    """
+    Create a TCP listening socket.  If config.reuse_port is set, several
+    processes may listen on the same port, and the kernel spreads incoming
+    connections across them.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if config.reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((local_host, local_port))
+    server_socket.listen(config.admission.backlog)
+    return server_socket
+
+
+def listen_vsock(
+        vsock_port: int,
+        config: ForwardConfig,
+) -> socket.socket:
+    """
+    Create a vsock listening socket on any CID.  (vsock has no SO_REUSEPORT.
+    To accept in several processes, create the socket before forking.)
+    """
+    # pylint: disable=no-member
+    server_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM) # type: ignore
+    server_socket.bind((socket.VMADDR_CID_ANY, vsock_port)) # type: ignore
+    server_socket.listen(config.admission.backlog)
+    return server_socket
 
 
 def forward_ip_to_vsock(
         local_port: int,
         vsock_port: int,
         vsock_addr: Optional[int],
+        config: Optional[ForwardConfig] = None,
 ) -> None:
     # cid = vsock_addr or get_enclave_cid()
+    config = config or ForwardConfig()
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(("0.0.0.0", local_port))
-    server_socket.listen(5)
+    server_socket = listen_ip("0.0.0.0", local_port, config)
 
     print(
         f"Forward 0.0.0.0:{local_port} -> vsock {vsock_addr}:{vsock_port}"
     )
 
-    forward_connections_to_vsock(server_socket, vsock_addr, vsock_port)
+    serve_connections_to_vsock(server_socket, vsock_addr, vsock_port, config)
+
+
+def forward_ip_to_backends(
+        local_port: int,
+        balancer: Balancer,
+        config: Optional[ForwardConfig] = None,
+) -> None:
+    """
+    As forward_ip_to_vsock, spreading connections across the enclaves (or
+    other backends) of balancer.  Starts the balancer's health checks.
+    """
+    config = config or ForwardConfig()
+
+    server_socket = listen_ip("0.0.0.0", local_port, config)
+    balancer.start()
+
+    print(f"Forward 0.0.0.0:{local_port} -> {len(balancer.stats())} backends")
+
+    serve_connections_to_backends(server_socket, balancer, config)
 
 
 def forward_ip_to_ip(
@@ -176,75 +355,70 @@ def forward_ip_to_ip(
         local_port: int,
         remote_host: str,
         remote_port: int,
+        config: Optional[ForwardConfig] = None,
 ) -> None:
     # cid = vsock_addr or get_enclave_cid()
 
     local_host = local_host or "0.0.0.0"
+    config = config or ForwardConfig()
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((local_host, local_port))
-    server_socket.listen(5)
+    server_socket = listen_ip(local_host, local_port, config)
 
     print(
         f"Forward 0.0.0.0:{local_port} -> {remote_host}:{remote_port}"
     )
 
-    forward_connections_to_ip(server_socket, remote_host, remote_port)
+    serve_connections_to_ip(server_socket, remote_host, remote_port, config)
 
 
 def forward_vsock_to_ip(
         vsock_port: int,
         remote_host: str,
         remote_port: int,
+        config: Optional[ForwardConfig] = None,
 ) -> None:
+    config = config or ForwardConfig()
 
-    # pylint: disable=no-member
-    server_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM) # type: ignore
-    # pylint: disable=no-member
-    server_socket.bind((socket.VMADDR_CID_ANY, vsock_port)) # type: ignore
-    server_socket.listen(5)
+    server_socket = listen_vsock(vsock_port, config)
 
     print(f"Forward (vsock):{vsock_port} -> {remote_host}:{remote_port}")
 
-    forward_connections_to_ip(server_socket, remote_host, remote_port)
+    serve_connections_to_ip(server_socket, remote_host, remote_port, config)
 
 
 def forward_vsock_https(
         listen_port: int,
         dest_port: int,
+        config: Optional[ForwardConfig] = None,
 ) -> None:
     """
     Listen on vsock <listen_port>.  Attempt to determine the intended
-    destination of incoming https connections from the list of KNOWN_HOSTS, and
-    forward to the appropriate server.
+    destination of incoming https connections from the server name in the TLS
+    ClientHello, and forward to the appropriate server if it is one of the
+    config.known_hosts (by default KNOWN_HOSTS).
     """
+    config = config or ForwardConfig()
 
-    # pylint: disable=no-member
-    server_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)  # type: ignore
-    server_socket.bind((socket.VMADDR_CID_ANY, listen_port))  # type: ignore
+    server_socket = listen_vsock(listen_port, config)
     print(f"Forward (https) (vsock):{listen_port} -> <host>:{dest_port}")
 
-    server_socket.listen(5)
-
-    forward_https_connections_to_ip(server_socket, dest_port)
+    serve_https_connections_to_ip(server_socket, dest_port, config)
 
 
 def forward_ip_https(
         listen_port: int,
         dest_port: int,
+        config: Optional[ForwardConfig] = None,
 ) -> None:
     """
     Listen on <listen_port>.  Attempt to determine the intended destination of
-    incoming https connections from the list of KNOWN_HOSTS, and forward to the
-    appropriate server.
+    incoming https connections from the server name in the TLS ClientHello,
+    and forward to the appropriate server if it is one of the
+    config.known_hosts (by default KNOWN_HOSTS).
     """
+    config = config or ForwardConfig()
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(("0.0.0.0", listen_port))
+    server_socket = listen_ip("0.0.0.0", listen_port, config)
     print(f"Forward 0.0.0.0:{listen_port} -> <host>:{dest_port}")
 
-    server_socket.listen(5)
-
-    forward_https_connections_to_ip(server_socket, dest_port)
+    serve_https_connections_to_ip(server_socket, dest_port, config)
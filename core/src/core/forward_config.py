@@ -0,0 +1,44 @@
+from dataclasses import dataclass, field
+
+from .admission import AdmissionConfig
+from .destinations import HostTable
+from .relay import RELAYS, RELAY_COPY
+from .upstream import UpstreamConfig
+
+# Forwarding engines
+#   thread  - one handler thread per connection, plus one thread per direction
+#   asyncio - all connections multiplexed on a single event loop
+ENGINE_THREAD = "thread"
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = [ENGINE_THREAD, ENGINE_ASYNCIO]
+
+
+@dataclass
+class ForwardConfig:
+    """
+    Options shared by the forward_* entry points in core.forward.
+    """
+    engine: str = ENGINE_THREAD
+
+    # How the thread engine moves bytes between sockets (see core.relay).  The
+    # asyncio engine always uses non-blocking recv/send on the event loop.
+    relay: str = RELAY_COPY
+
+    # Allowed destinations for the https forwarders
+    known_hosts: HostTable = field(default_factory=HostTable)
+
+    # Listen backlog and limits on concurrent connections
+    admission: AdmissionConfig = field(default_factory=AdmissionConfig)
+
+    # Set SO_REUSEPORT on TCP listeners, so that several worker processes can
+    # each accept on the same port
+    reuse_port: bool = False
+
+    # Pool of ready connections and DNS caching for remote hosts
+    upstream: UpstreamConfig = field(default_factory=UpstreamConfig)
+
+    def __post_init__(self) -> None:
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown forwarding engine: {self.engine}")
+        if self.relay not in RELAYS:
+            raise ValueError(f"Unknown relay mode: {self.relay}")
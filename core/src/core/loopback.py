@@ -0,0 +1,24 @@
+import socket
+
+
+def tcp_pair() -> tuple[socket.socket, socket.socket]:
+    """
+    The two ends of a new TCP connection on loopback (unlike
+    socket.socketpair, which gives Unix sockets).  For tests and benchmarks.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        server_socket.bind(("127.0.0.1", 0))
+        server_socket.listen(1)
+        a = socket.create_connection(server_socket.getsockname())
+        b, _ = server_socket.accept()
+        return a, b
+
+
+def free_port() -> int:
+    """
+    A TCP port on loopback that is free (as of now).  For tests and
+    benchmarks.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
@@ -0,0 +1,128 @@
+from typing import Callable, Optional
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+# Minimum seconds between restarts of the same worker slot, so that a worker
+# which fails immediately does not spin the supervisor.
+DEFAULT_RESTART_DELAY = 1.0
+
+# Seconds to wait for a worker to exit after SIGTERM before killing it
+STOP_TIMEOUT = 5.0
+
+_FORK = multiprocessing.get_context("fork")
+
+
+class Supervisor:
+    """
+    Run <num_workers> forked copies of <target>, restarting any that exit.
+
+    Workers are forked (not spawned), so sockets created before start() are
+    shared by every worker.
+    """
+
+    def __init__(
+            self,
+            num_workers: int,
+            target: Callable[[], None],
+            restart_delay: float = DEFAULT_RESTART_DELAY,
+    ) -> None:
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+        self.num_workers = num_workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self._workers: list[Optional[multiprocessing.process.BaseProcess]] = \
+            [None] * num_workers
+        self._started_at = [0.0] * num_workers
+        self._stopping = False
+
+    @property
+    def pids(self) -> list[Optional[int]]:
+        return [w.pid if w is not None else None for w in self._workers]
+
+    def start(self) -> None:
+        for i in range(self.num_workers):
+            self._start_worker(i)
+
+    def run(self, max_restarts: Optional[int] = None) -> None:
+        """
+        Start the workers (if necessary) and restart them as they exit, until
+        stop() is called, SIGTERM/SIGINT is received, or max_restarts have
+        been performed.
+        """
+        if all(w is None for w in self._workers):
+            self.start()
+
+        previous = signal.signal(signal.SIGTERM, lambda *_: self._request_stop())
+        try:
+            while not self._stopping:
+                if max_restarts is not None and self.restarts >= max_restarts:
+                    break
+                sentinels = [w.sentinel for w in self._workers if w is not None]
+                multiprocessing.connection.wait(sentinels, timeout=1.0)
+                self._restart_dead_workers()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self.stop()
+
+    def stop(self) -> None:
+        self._stopping = True
+        for w in self._workers:
+            if w is not None and w.is_alive():
+                w.terminate()
+        for w in self._workers:
+            if w is not None:
+                w.join(STOP_TIMEOUT)
+                if w.is_alive():
+                    w.kill()
+                    w.join()
+
+    def _request_stop(self) -> None:
+        self._stopping = True
+
+    def _start_worker(self, i: int) -> None:
+        worker = _FORK.Process(target=self._worker_main, name=f"worker-{i}", daemon=True)
+        # Hold SIGTERM until the worker has restored the default handler
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            worker.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        self._workers[i] = worker
+        self._started_at[i] = time.monotonic()
+        print(f"worker {i} started (pid {worker.pid})")
+
+    def _worker_main(self) -> None:
+        # Leave shutdown to the supervisor
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        self.target()
+
+    def _restart_dead_workers(self) -> None:
+        for i, w in enumerate(self._workers):
+            if w is None or w.is_alive() or self._stopping:
+                continue
+            print(f"!! worker {i} (pid {w.pid}) exited with code {w.exitcode}")
+            w.close()
+            delay = self._started_at[i] + self.restart_delay - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.restarts += 1
+            self._start_worker(i)
+
+
+def run_workers(num_workers: int, target: Callable[[], None]) -> None:
+    """
+    Run <target> in <num_workers> supervised processes (or directly in this
+    process if num_workers is 1).
+    """
+    if num_workers == 1:
+        target()
+    else:
+        Supervisor(num_workers, target).run()
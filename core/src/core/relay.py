@@ -0,0 +1,107 @@
+import errno
+import os
+import socket
+
+# Relay modes for moving data from one blocking socket to another
+#   copy   - recv() a new bytes object per chunk and sendall() it
+#   buffer - recv_into() a reusable, preallocated buffer
+#   splice - move data socket -> pipe -> socket in the kernel with os.splice,
+#            falling back to "buffer" where splice is not supported
+RELAY_COPY = "copy"
+RELAY_BUFFER = "buffer"
+RELAY_SPLICE = "splice"
+RELAYS = [RELAY_COPY, RELAY_BUFFER, RELAY_SPLICE]
+
+COPY_CHUNK_SIZE = 4096
+RELAY_CHUNK_SIZE = 65536
+
+HAS_SPLICE = hasattr(os, "splice")
+
+# Errors indicating that splice is not implemented for a given fd type.
+_SPLICE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+def relay_copy(src: socket.socket, dst: socket.socket) -> None:
+    while True:
+        data = src.recv(COPY_CHUNK_SIZE)
+        if not data:
+            break
+        dst.sendall(data)
+
+
+def relay_buffer(src: socket.socket, dst: socket.socket) -> None:
+    buf = bytearray(RELAY_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = src.recv_into(buf)
+        if n == 0:
+            break
+        dst.sendall(view[:n])
+
+
+def relay_splice(src: socket.socket, dst: socket.socket) -> None:
+    """
+    Relay using os.splice.  Falls back to relay_buffer for sockets with a
+    timeout (which are non-blocking underneath, so splice would not wait for
+    them), and where the kernel does not support splicing from src or into
+    dst (e.g. AF_VSOCK), once any data in the pipe has been passed on.
+    """
+    if not HAS_SPLICE or src.gettimeout() is not None or dst.gettimeout() is not None:
+        relay_buffer(src, dst)
+        return
+
+    pipe_r, pipe_w = os.pipe()
+    try:
+        if _splice_until_eof(src, dst, pipe_r, pipe_w):
+            return
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+    relay_buffer(src, dst)
+
+
+def _splice_until_eof(src: socket.socket, dst: socket.socket, pipe_r: int, pipe_w: int) -> bool:
+    """
+    Move data src -> pipe -> dst until src reaches EOF (returning True), or
+    until splice turns out not to be supported for src or dst (returning
+    False, with the pipe drained into dst).
+    """
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    while True:
+        try:
+            n = os.splice(src_fd, pipe_w, RELAY_CHUNK_SIZE, flags=os.SPLICE_F_MOVE)
+        except OSError as e:
+            if e.errno not in _SPLICE_UNSUPPORTED:
+                raise
+            return False
+        if n == 0:
+            return True
+
+        # Drain the pipe into dst.  The socket may accept fewer bytes than
+        # are in the pipe.
+        while n > 0:
+            try:
+                n -= os.splice(pipe_r, dst_fd, n, flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                if e.errno not in _SPLICE_UNSUPPORTED:
+                    raise
+                while n > 0:
+                    data = os.read(pipe_r, n)
+                    dst.sendall(data)
+                    n -= len(data)
+                return False
+
+
+def relay(src: socket.socket, dst: socket.socket, mode: str = RELAY_COPY) -> None:
+    """
+    Move data from src to dst until src reaches EOF.
+    """
+    if mode == RELAY_SPLICE:
+        relay_splice(src, dst)
+    elif mode == RELAY_BUFFER:
+        relay_buffer(src, dst)
+    elif mode == RELAY_COPY:
+        relay_copy(src, dst)
+    else:
+        raise ValueError(f"Unknown relay mode: {mode}")
@@ -0,0 +1,175 @@
+from typing import Optional
+import struct
+
+# TLS record layer
+RECORD_HEADER_LENGTH = 5
+CONTENT_TYPE_HANDSHAKE = 0x16
+MAX_RECORD_LENGTH = (1 << 14) + 2048
+
+# Handshake layer
+HANDSHAKE_HEADER_LENGTH = 4
+HANDSHAKE_CLIENT_HELLO = 0x01
+EXTENSION_SERVER_NAME = 0x0000
+SERVER_NAME_HOST_NAME = 0x00
+
+# Upper bound on the size of ClientHello we are prepared to buffer.  Hellos
+# carrying post-quantum key shares are a few KB.
+MAX_CLIENT_HELLO_LENGTH = 65536
+
+# Seconds a client has to send its complete ClientHello
+CLIENT_HELLO_TIMEOUT = 10.0
+
+
+class TlsParseError(ValueError):
+    """
+    The data is not a well-formed TLS ClientHello.
+    """
+
+
+class ClientHelloReader:
+    """
+    Incrementally reassemble a ClientHello handshake message from TLS records,
+    which may arrive split across any number of reads and records, and extract
+    the server_name (SNI) extension.
+
+    Use wanted() to determine how many bytes to read next, so that nothing
+    beyond the ClientHello records is consumed from the socket.
+    """
+
+    def __init__(self, max_length: int = MAX_CLIENT_HELLO_LENGTH) -> None:
+        self.max_length = max_length
+        self.server_name: Optional[str] = None
+        self.done = False
+        # All bytes fed so far (to be forwarded to the real server)
+        self._data = bytearray()
+        # Offset in _data of the start of the current record
+        self._record_start = 0
+        # Handshake message bytes reassembled from record payloads
+        self._handshake = bytearray()
+
+    @property
+    def data(self) -> bytes:
+        return bytes(self._data)
+
+    def wanted(self) -> int:
+        """
+        Number of bytes required to complete the current record header or
+        payload, or 0 when the ClientHello is complete.
+        """
+        if self.done:
+            return 0
+        available = len(self._data) - self._record_start
+        if available < RECORD_HEADER_LENGTH:
+            return RECORD_HEADER_LENGTH - available
+        return RECORD_HEADER_LENGTH + self._record_length() - available
+
+    def feed(self, data: bytes) -> None:
+        """
+        Add data received from the client.  Raises TlsParseError as soon as the
+        data cannot be the start of a valid ClientHello.
+        """
+        if self.done:
+            raise TlsParseError("data after complete ClientHello")
+        self._data.extend(data)
+
+        while not self.done:
+            available = len(self._data) - self._record_start
+            if available < RECORD_HEADER_LENGTH:
+                return
+            record_length = self._record_length()
+            if available < RECORD_HEADER_LENGTH + record_length:
+                return
+
+            payload_start = self._record_start + RECORD_HEADER_LENGTH
+            self._handshake.extend(
+                self._data[payload_start:payload_start + record_length])
+            self._record_start = payload_start + record_length
+            if len(self._handshake) > self.max_length + HANDSHAKE_HEADER_LENGTH:
+                raise TlsParseError("ClientHello too large")
+            self._check_handshake()
+
+    def _record_length(self) -> int:
+        content_type, major, _minor, length = struct.unpack_from(
+            ">BBBH", self._data, self._record_start)
+        if content_type != CONTENT_TYPE_HANDSHAKE:
+            raise TlsParseError(f"not a handshake record (type {content_type})")
+        if major != 3:
+            raise TlsParseError(f"unsupported record version {major}")
+        if length == 0 or length > MAX_RECORD_LENGTH:
+            raise TlsParseError(f"invalid record length {length}")
+        return int(length)
+
+    def _check_handshake(self) -> None:
+        if len(self._handshake) < HANDSHAKE_HEADER_LENGTH:
+            return
+        if self._handshake[0] != HANDSHAKE_CLIENT_HELLO:
+            raise TlsParseError(f"not a ClientHello (type {self._handshake[0]})")
+        length = int.from_bytes(self._handshake[1:4], "big")
+        if length > self.max_length:
+            raise TlsParseError("ClientHello too large")
+        end = HANDSHAKE_HEADER_LENGTH + length
+        if len(self._handshake) < end:
+            return
+        self.server_name = parse_client_hello_sni(
+            bytes(self._handshake[HANDSHAKE_HEADER_LENGTH:end]))
+        self.done = True
+
+
+class _Cursor:
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.offset = 0
+
+    def take(self, length: int) -> bytes:
+        end = self.offset + length
+        if end > len(self.data):
+            raise TlsParseError("truncated ClientHello")
+        value = self.data[self.offset:end]
+        self.offset = end
+        return value
+
+    def uint(self, size: int) -> int:
+        return int.from_bytes(self.take(size), "big")
+
+    def vector(self, length_size: int) -> bytes:
+        return self.take(self.uint(length_size))
+
+    def remaining(self) -> int:
+        return len(self.data) - self.offset
+
+
+def parse_client_hello_sni(body: bytes) -> Optional[str]:
+    """
+    Given the body of a ClientHello handshake message (without the 4-byte
+    handshake header), return the host_name from the server_name extension,
+    or None if there is no such extension.
+    """
+    c = _Cursor(body)
+    c.take(2)       # legacy_version
+    c.take(32)      # random
+    c.vector(1)     # legacy_session_id
+    c.vector(2)     # cipher_suites
+    c.vector(1)     # legacy_compression_methods
+    if c.remaining() == 0:
+        return None
+
+    extensions = _Cursor(c.vector(2))
+    while extensions.remaining() > 0:
+        ext_type = extensions.uint(2)
+        ext_data = extensions.vector(2)
+        if ext_type != EXTENSION_SERVER_NAME:
+            continue
+
+        names = _Cursor(_Cursor(ext_data).vector(2))
+        while names.remaining() > 0:
+            name_type = names.uint(1)
+            name = names.vector(2)
+            if name_type == SERVER_NAME_HOST_NAME:
+                try:
+                    return name.decode("ascii").lower()
+                except UnicodeDecodeError as e:
+                    raise TlsParseError("invalid server name") from e
+        return None
+
+    return None
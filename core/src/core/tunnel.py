@@ -0,0 +1,486 @@
+from typing import Any, Callable, Coroutine, Mapping, Optional, Union
+from dataclasses import dataclass
+import asyncio
+import socket
+import struct
+
+from .admission import AsyncAdmission
+from .aio_forward import log_connection, serve_connections
+from .defaults import DEFAULT_APP_SERVER_PORT, DEFAULT_TUNNEL_PORT
+from .forward_config import ForwardConfig
+
+# A tunnel multiplexes many logical streams (each carrying what would
+# otherwise be a separate TCP or vsock connection) over a small number of
+# long-lived channels between host and enclave.  Every frame on a channel is:
+#
+#   type (1 byte) | stream id (4 bytes) | payload length (4 bytes) | payload
+#
+# OPEN    open stream <id> to the service (a port number, 2 byte payload)
+# DATA    stream data
+# WINDOW  grant the sender <n> more bytes of DATA (4 byte payload)
+# CLOSE   the sender will send no more DATA on the stream (half close)
+# RESET   abort the stream in both directions
+FRAME_OPEN = 0
+FRAME_DATA = 1
+FRAME_WINDOW = 2
+FRAME_CLOSE = 3
+FRAME_RESET = 4
+
+FRAME_HEADER = struct.Struct(">BII")
+SERVICE = struct.Struct(">H")
+WINDOW = struct.Struct(">I")
+
+MAX_FRAME_PAYLOAD = 16384
+
+# Bytes a sender may have in flight on one stream before the receiver grants
+# more with a WINDOW frame.  This bounds the memory buffered per stream.
+DEFAULT_WINDOW = 262144
+
+# Seconds between attempts to (re)connect a channel
+RECONNECT_DELAY = 1.0
+
+# Seconds to wait for a channel when opening a stream
+OPEN_TIMEOUT = 5.0
+
+StreamHandler = Callable[["TunnelStream"], Coroutine[Any, Any, None]]
+ChannelConnector = Callable[[], Coroutine[Any, Any, socket.socket]]
+
+
+@dataclass
+class TunnelConfig:
+    """
+    Settings shared by the host and enclave ends of the tunnel.
+    """
+    # vsock port on which the enclave accepts channels
+    port: int = DEFAULT_TUNNEL_PORT
+    # Service (port) of the enclave app, for connections accepted by the host
+    app_port: int = DEFAULT_APP_SERVER_PORT
+    # Channels connected by the host
+    num_channels: int = 4
+    window: int = DEFAULT_WINDOW
+
+    def __post_init__(self) -> None:
+        if self.num_channels < 1:
+            raise ValueError("num_channels must be at least 1")
+        if self.window < MAX_FRAME_PAYLOAD:
+            raise ValueError(f"window must be at least {MAX_FRAME_PAYLOAD}")
+
+
+class TunnelError(ConnectionError):
+    """
+    A stream was reset, or could not be opened.
+    """
+
+
+class TunnelStream: # pylint: disable=too-many-instance-attributes
+    """
+    One logical connection over a TunnelChannel.  Data written is sent in
+    DATA frames, at most window bytes ahead of what the peer has read.
+    """
+
+    def __init__(
+            self,
+            channel: "TunnelChannel",
+            stream_id: int,
+            service: int,
+    ) -> None:
+        self.channel = channel
+        self.id = stream_id
+        self.service = service
+        self._send_window = channel.window
+        self._writable = asyncio.Event()
+        self._buffer = bytearray()
+        self._readable = asyncio.Event()
+        self._unacknowledged = 0
+        # CLOSE sent, CLOSE received, RESET sent or received
+        self._closed = False
+        self._eof = False
+        self._reset = False
+
+    @property
+    def done(self) -> bool:
+        return self._reset or (self._closed and self._eof)
+
+    async def read(self, max_bytes: int = -1) -> bytes:
+        """
+        Read up to max_bytes (or all buffered data if max_bytes is negative).
+        Returns b"" once the peer has closed the stream.
+        """
+        while not self._buffer and not self._eof and not self._reset:
+            self._readable.clear()
+            await self._readable.wait()
+        if self._reset:
+            raise TunnelError(f"stream {self.id} reset")
+
+        if max_bytes < 0 or max_bytes >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:max_bytes])
+            del self._buffer[:max_bytes]
+
+        # Grant the peer more window once half of it has been consumed
+        self._unacknowledged += len(data)
+        if self._unacknowledged >= self.channel.window // 2 and not self._eof:
+            self.channel.send_frame(
+                FRAME_WINDOW, self.id, WINDOW.pack(self._unacknowledged))
+            self._unacknowledged = 0
+        return data
+
+    async def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            while self._send_window <= 0 and not self._reset:
+                self._writable.clear()
+                await self._writable.wait()
+            if self._reset or self._closed:
+                raise TunnelError(f"stream {self.id} closed")
+            length = min(len(view), self._send_window, MAX_FRAME_PAYLOAD)
+            self._send_window -= length
+            self.channel.send_frame(FRAME_DATA, self.id, view[:length])
+            view = view[length:]
+            await self.channel.drain()
+
+    def close(self) -> None:
+        """
+        Half close: signal the end of the data written to the stream.
+        """
+        if not self._closed and not self._reset:
+            self._closed = True
+            self.channel.send_frame(FRAME_CLOSE, self.id)
+            self.channel.stream_finished(self)
+
+    def reset(self) -> None:
+        if not self.done:
+            self.channel.send_frame(FRAME_RESET, self.id)
+        self._on_reset()
+
+    def _on_data(self, data: bytes) -> None:
+        if self._eof:
+            raise TunnelError(f"data after close on stream {self.id}")
+        if len(self._buffer) + len(data) > self.channel.window:
+            raise TunnelError(f"stream {self.id} exceeded its window")
+        self._buffer.extend(data)
+        self._readable.set()
+
+    def _on_window(self, increment: int) -> None:
+        self._send_window += increment
+        self._writable.set()
+
+    def _on_close(self) -> None:
+        self._eof = True
+        self._readable.set()
+        self.channel.stream_finished(self)
+
+    def _on_reset(self) -> None:
+        self._reset = True
+        self._readable.set()
+        self._writable.set()
+        self.channel.stream_finished(self)
+
+
+class TunnelChannel: # pylint: disable=too-many-instance-attributes
+    """
+    Multiplexes TunnelStreams over one connected socket.  Either end may open
+    streams; the end that connected the socket uses odd stream ids and the
+    end that accepted it uses even ids.  Streams opened by the peer are passed
+    to the handler registered for their service.
+    """
+
+    def __init__( # pylint: disable=too-many-arguments,too-many-positional-arguments
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            handlers: Mapping[int, StreamHandler],
+            initiator: bool,
+            window: int = DEFAULT_WINDOW,
+    ) -> None:
+        self.handlers = handlers
+        self.window = window
+        self.streams: dict[int, TunnelStream] = {}
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 1 if initiator else 2
+        self._drain_lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    @property
+    def closed(self) -> bool:
+        return self._writer.is_closing()
+
+    def open_stream(self, service: int) -> TunnelStream:
+        if self.closed:
+            raise TunnelError("channel closed")
+        stream = TunnelStream(self, self._next_id, service)
+        self._next_id += 2
+        self.streams[stream.id] = stream
+        self.send_frame(FRAME_OPEN, stream.id, SERVICE.pack(service))
+        return stream
+
+    def send_frame(
+            self,
+            frame_type: int,
+            stream_id: int,
+            payload: Union[bytes, memoryview] = b"",
+    ) -> None:
+        if self.closed:
+            return
+        self._writer.write(FRAME_HEADER.pack(frame_type, stream_id, len(payload)))
+        if payload:
+            self._writer.write(payload)
+
+    async def drain(self) -> None:
+        async with self._drain_lock:
+            await self._writer.drain()
+
+    def stream_finished(self, stream: TunnelStream) -> None:
+        if stream.done:
+            self.streams.pop(stream.id, None)
+
+    async def run(self) -> None:
+        """
+        Read and dispatch frames until the channel is closed.  All streams are
+        reset when the channel ends.
+        """
+        try:
+            while True:
+                header = await self._reader.readexactly(FRAME_HEADER.size)
+                frame_type, stream_id, length = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_PAYLOAD:
+                    raise TunnelError(f"frame too large ({length} bytes)")
+                payload = await self._reader.readexactly(length) if length else b""
+                self._dispatch(frame_type, stream_id, payload)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                print("!! tunnel channel closed mid-frame")
+        except (struct.error, OSError) as e:
+            # OSError includes TunnelError and connection errors
+            print(f"!! tunnel channel error: {e!r}")
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        for stream in list(self.streams.values()):
+            stream._on_reset() # pylint: disable=protected-access
+        self._writer.close()
+
+    def _dispatch(self, frame_type: int, stream_id: int, payload: bytes) -> None:
+        # pylint: disable=protected-access
+        if frame_type == FRAME_OPEN:
+            self._on_open(stream_id, SERVICE.unpack(payload)[0])
+            return
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # Frames may still arrive for a stream that was reset locally
+            return
+        try:
+            if frame_type == FRAME_DATA:
+                stream._on_data(payload)
+            elif frame_type == FRAME_WINDOW:
+                stream._on_window(WINDOW.unpack(payload)[0])
+            elif frame_type == FRAME_CLOSE:
+                stream._on_close()
+            elif frame_type == FRAME_RESET:
+                stream._on_reset()
+            else:
+                raise TunnelError(f"unknown frame type {frame_type}")
+        except TunnelError as e:
+            print(f"!! {e}")
+            stream.reset()
+
+    def _on_open(self, stream_id: int, service: int) -> None:
+        handler = self.handlers.get(service)
+        if handler is None or stream_id in self.streams:
+            print(f"!! tunnel: no service {service} (stream {stream_id})")
+            self.send_frame(FRAME_RESET, stream_id)
+            return
+        stream = TunnelStream(self, stream_id, service)
+        self.streams[stream_id] = stream
+
+        async def run_handler() -> None:
+            try:
+                await handler(stream)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                print(f" error handling tunnel stream {stream_id}: {e}")
+                stream.reset()
+            else:
+                stream.close()
+
+        # Keep references to running tasks so they are not garbage collected.
+        task = asyncio.get_running_loop().create_task(run_handler())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class ChannelPool:
+    """
+    The channels currently connected to the peer.  New streams are opened on
+    the channel with the fewest open streams.
+    """
+
+    def __init__(self) -> None:
+        self.channels: list[TunnelChannel] = []
+        self._available = asyncio.Event()
+
+    def add(self, channel: TunnelChannel) -> None:
+        self.channels.append(channel)
+        self._available.set()
+
+    def remove(self, channel: TunnelChannel) -> None:
+        self.channels.remove(channel)
+        if not self.channels:
+            self._available.clear()
+
+    async def open_stream(self, service: int, timeout: float = OPEN_TIMEOUT) -> TunnelStream:
+        """
+        Open a stream to service, waiting up to timeout seconds for a channel
+        to be connected.
+        """
+        try:
+            await asyncio.wait_for(self._available.wait(), timeout)
+        except asyncio.TimeoutError as e:
+            raise TunnelError("no tunnel channel connected") from e
+        channel = min(
+            (c for c in self.channels if not c.closed),
+            key=lambda c: len(c.streams),
+            default=None)
+        if channel is None:
+            raise TunnelError("no tunnel channel connected")
+        return channel.open_stream(service)
+
+    async def run_channel(
+            self,
+            s: socket.socket,
+            handlers: Mapping[int, StreamHandler],
+            initiator: bool,
+            window: int = DEFAULT_WINDOW,
+    ) -> None:
+        """
+        Run a channel over the connected socket s, making it available for new
+        streams until it closes.
+        """
+        reader, writer = await asyncio.open_connection(sock=s, limit=MAX_FRAME_PAYLOAD * 4)
+        channel = TunnelChannel(reader, writer, handlers, initiator, window)
+        self.add(channel)
+        try:
+            await channel.run()
+        finally:
+            self.remove(channel)
+            writer.close()
+
+
+async def relay_socket_to_stream(s: socket.socket, stream: TunnelStream) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.sock_recv(s, MAX_FRAME_PAYLOAD)
+        if not data:
+            break
+        await stream.write(data)
+    stream.close()
+
+
+async def relay_stream_to_socket(stream: TunnelStream, s: socket.socket) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await stream.read()
+        if not data:
+            break
+        await loop.sock_sendall(s, data)
+    s.shutdown(socket.SHUT_WR)
+
+
+async def connect_socket_to_stream(
+        s: socket.socket,
+        stream: TunnelStream,
+        leading_bytes: Optional[bytes] = None,
+) -> None:
+    """
+    Relay data in both directions between a connected socket and a stream
+    until both directions are closed.  The stream is reset and the socket
+    closed if either fails.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [
+        loop.create_task(relay_socket_to_stream(s, stream)),
+        loop.create_task(relay_stream_to_socket(stream, s)),
+    ]
+    try:
+        if leading_bytes:
+            await loop.sock_sendall(s, leading_bytes)
+        await asyncio.gather(*tasks)
+    except OSError:
+        stream.reset()
+    finally:
+        for task in tasks:
+            task.cancel()
+        s.close()
+
+
+async def forward_connections_to_tunnel(
+        server_socket: socket.socket,
+        pool: ChannelPool,
+        service: int,
+        config: ForwardConfig,
+) -> None:
+    """
+    Forward connections accepted on server_socket to <service> at the other
+    end of the tunnel.
+    """
+    destination = f"tunnel:{service}"
+
+    async def forward_connection(s: socket.socket) -> None:
+        stream = await pool.open_stream(service)
+        await connect_socket_to_stream(s, stream)
+
+    async def handle_connection(s: socket.socket) -> None:
+        await log_connection(s, destination, lambda: forward_connection(s))
+
+    admission = AsyncAdmission(config.admission, destination)
+    await serve_connections(server_socket, handle_connection, admission)
+
+
+async def connect_channels(
+        pool: ChannelPool,
+        connect: ChannelConnector,
+        handlers: Mapping[int, StreamHandler],
+        tunnel: TunnelConfig,
+) -> None:
+    """
+    Keep tunnel.num_channels channels connected, reconnecting any that close.
+    """
+
+    async def maintain_channel(i: int) -> None:
+        while True:
+            try:
+                s = await connect()
+                print(f" tunnel channel {i} connected")
+                await pool.run_channel(s, handlers, True, tunnel.window)
+                print(f"!! tunnel channel {i} closed")
+            except OSError as e:
+                print(f"!! tunnel channel {i}: {e}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    await asyncio.gather(*(maintain_channel(i) for i in range(tunnel.num_channels)))
+
+
+async def accept_channels(
+        server_socket: socket.socket,
+        pool: ChannelPool,
+        handlers: Mapping[int, StreamHandler],
+        tunnel: TunnelConfig,
+) -> None:
+    """
+    Accept channels on server_socket forever, running each until it closes.
+    """
+    loop = asyncio.get_running_loop()
+    server_socket.setblocking(False)
+
+    # Keep references to running tasks so they are not garbage collected.
+    tasks: set[asyncio.Task[None]] = set()
+    while True:
+        s, _ = await loop.sock_accept(server_socket)
+        print(f" tunnel channel from {s.getpeername()}")
+        task = loop.create_task(pool.run_channel(s, handlers, False, tunnel.window))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
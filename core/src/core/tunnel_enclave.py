@@ -0,0 +1,70 @@
+from typing import Mapping, Optional
+import asyncio
+import socket
+
+from .aio_forward import open_socket
+from .forward import listen_ip, listen_vsock
+from .forward_config import ForwardConfig
+from .tunnel import ChannelPool, StreamHandler, TunnelConfig, TunnelStream, \
+    accept_channels, connect_socket_to_stream, forward_connections_to_tunnel
+
+LOCALHOST = "127.0.0.1"
+
+
+def enclave_handlers(app_host: str, app_port: int) -> dict[int, StreamHandler]:
+    """
+    Handlers for the streams opened by the host: connections to the app.
+    """
+
+    async def handle_app(stream: TunnelStream) -> None:
+        s = await open_socket(socket.AF_INET, (app_host, app_port))
+        await connect_socket_to_stream(s, stream)
+
+    return {app_port: handle_app}
+
+
+async def run_enclave_tunnel(
+        server_socket: socket.socket,
+        listeners: Mapping[int, socket.socket],
+        handlers: Mapping[int, StreamHandler],
+        config: ForwardConfig,
+        tunnel: TunnelConfig,
+) -> None:
+    """
+    Accept tunnel channels on server_socket and serve the streams opened by
+    the host with handlers.  Connections accepted on listeners[service] are
+    forwarded to <service> on the host.
+    """
+    pool = ChannelPool()
+    await asyncio.gather(
+        accept_channels(server_socket, pool, handlers, tunnel),
+        *(forward_connections_to_tunnel(listener, pool, service, config)
+          for service, listener in listeners.items()),
+    )
+
+
+def forward_tunnel_enclave(
+        services: list[int],
+        config: Optional[ForwardConfig] = None,
+        tunnel: Optional[TunnelConfig] = None,
+) -> None:
+    """
+    Enclave end of the tunnel.  Accepts channels from the host on vsock
+    <tunnel.port>, and:
+      - connects streams opened by the host to the app on localhost:<app_port>
+      - forwards connections to localhost:<service>, for each of services, to
+        <service> on the host (replacing host_to_vsock)
+    """
+    config = config or ForwardConfig()
+    tunnel = tunnel or TunnelConfig()
+
+    server_socket = listen_vsock(tunnel.port, config)
+    print(f"Tunnel (vsock):{tunnel.port} -> {LOCALHOST}:{tunnel.app_port}")
+
+    listeners = {}
+    for service in services:
+        listeners[service] = listen_ip(LOCALHOST, service, config)
+        print(f"Forward {LOCALHOST}:{service} -> tunnel:{service}")
+
+    handlers = enclave_handlers(LOCALHOST, tunnel.app_port)
+    asyncio.run(run_enclave_tunnel(server_socket, listeners, handlers, config, tunnel))
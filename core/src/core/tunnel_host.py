@@ -0,0 +1,96 @@
+from typing import Optional
+import asyncio
+import socket
+
+from .aio_forward import open_socket, route_https
+from .forward import listen_ip
+from .forward_config import ForwardConfig
+from .upstream import aconnect_upstream, warm_upstream
+from .tunnel import ChannelConnector, ChannelPool, StreamHandler, TunnelConfig, \
+    TunnelStream, connect_channels, connect_socket_to_stream, \
+    forward_connections_to_tunnel
+
+HTTPS_PORT = 443
+
+
+def host_handlers(
+        proxy_dest_host: str,
+        proxy_port: int,
+        config: ForwardConfig,
+) -> dict[int, StreamHandler]:
+    """
+    Handlers for the streams opened by the enclave, replacing the vsock
+    forwarders of host.forward:
+      443          -> <host>:443, host determined from the TLS ClientHello
+      <proxy_port> -> <proxy_dest_host>:<proxy_port>
+    """
+
+    async def handle_https(stream: TunnelStream) -> None:
+        (dest_host, leading_bytes) = await route_https(stream.read, config.known_hosts)
+        if not dest_host:
+            print(f"!! dropping tunnel stream ({len(leading_bytes)} bytes read)")
+            stream.reset()
+            return
+        print(f" (https) tunnel stream {stream.id} -> {dest_host}:{HTTPS_PORT}")
+        s = await aconnect_upstream(dest_host, HTTPS_PORT, config.upstream)
+        await connect_socket_to_stream(s, stream, leading_bytes)
+
+    async def handle_proxy(stream: TunnelStream) -> None:
+        print(f" tunnel stream {stream.id} -> {proxy_dest_host}:{proxy_port}")
+        s = await aconnect_upstream(proxy_dest_host, proxy_port, config.upstream)
+        await connect_socket_to_stream(s, stream)
+
+    return {HTTPS_PORT: handle_https, proxy_port: handle_proxy}
+
+
+async def run_host_tunnel(
+        server_socket: socket.socket,
+        connect: ChannelConnector,
+        handlers: dict[int, StreamHandler],
+        config: ForwardConfig,
+        tunnel: TunnelConfig,
+) -> None:
+    """
+    Connect the tunnel channels using connect, serve the streams opened by
+    the enclave with handlers, and forward connections accepted on
+    server_socket to the enclave app.
+    """
+    pool = ChannelPool()
+    await asyncio.gather(
+        connect_channels(pool, connect, handlers, tunnel),
+        forward_connections_to_tunnel(server_socket, pool, tunnel.app_port, config),
+    )
+
+
+def forward_tunnel_host(
+        enclave_cid: Optional[int],
+        proxy_dest_host: str,
+        proxy_port: int,
+        config: Optional[ForwardConfig] = None,
+        tunnel: Optional[TunnelConfig] = None,
+) -> None:
+    """
+    Host end of the tunnel.  Performs all forwarding for the enclave (as
+    host.forward does) over tunnel.num_channels vsock connections to the
+    enclave:
+      0:<app_port> -> enclave app               (incoming connections)
+      enclave 443 -> <external>:443             (https connections from enclave)
+      enclave <proxy_port> -> <proxy_dest_host>:<proxy_port>
+    """
+    config = config or ForwardConfig()
+    tunnel = tunnel or TunnelConfig()
+
+    server_socket = listen_ip("0.0.0.0", tunnel.app_port, config)
+    print(
+        f"Forward 0.0.0.0:{tunnel.app_port} -> tunnel vsock {enclave_cid}:{tunnel.port}"
+        f" ({tunnel.num_channels} channels)")
+
+    async def connect() -> socket.socket:
+        # pylint: disable=no-member
+        return await open_socket(
+            socket.AF_VSOCK,  # type: ignore
+            (enclave_cid, tunnel.port))
+
+    handlers = host_handlers(proxy_dest_host, proxy_port, config)
+    warm_upstream(config.known_hosts, HTTPS_PORT, config.upstream)
+    asyncio.run(run_host_tunnel(server_socket, connect, handlers, config, tunnel))
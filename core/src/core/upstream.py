@@ -0,0 +1,335 @@
+from typing import Any, Iterable, Optional
+from collections import deque
+from dataclasses import dataclass
+import asyncio
+import os
+import socket
+import threading
+import time
+
+# (family, sockaddr) pairs for a destination, in getaddrinfo order
+Addresses = list[tuple[int, tuple[Any, ...]]]
+Destination = tuple[str, int]
+
+# Seconds allowed to connect a socket for the pool
+CONNECT_TIMEOUT = 10.0
+
+
+@dataclass(frozen=True)
+class UpstreamConfig:
+    """
+    Connections from the forwarders to remote hosts.  With the defaults,
+    every connection resolves the host and connects on demand.
+    """
+    # Connected sockets kept ready for each destination (0 to disable)
+    pool_size: int = 0
+
+    # Upper bound on ready sockets across all destinations
+    max_sockets: int = 64
+
+    # Seconds a ready socket may wait before it is replaced.  Servers drop
+    # connections that send nothing, so keep this below their idle timeout.
+    max_idle: float = 20.0
+
+    # Seconds to cache DNS results (0 to resolve on every connection)
+    dns_ttl: float = 0.0
+
+    def __post_init__(self) -> None:
+        if self.pool_size < 0 or self.max_sockets < 0:
+            raise ValueError("pool sizes must not be negative")
+        if self.max_idle <= 0 or self.dns_ttl < 0:
+            raise ValueError("invalid max_idle or dns_ttl")
+
+    @property
+    def enabled(self) -> bool:
+        return self.pool_size > 0 or self.dns_ttl > 0
+
+
+@dataclass
+class UpstreamStats:
+    # Connections served by a ready socket, or connected on demand
+    hits: int = 0
+    misses: int = 0
+    # Ready sockets discarded because they were closed or too old
+    evicted: int = 0
+
+
+class Resolver:
+    """
+    getaddrinfo with results cached for ttl seconds.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._cache: dict[Destination, tuple[float, Addresses]] = {}
+        self._lock = threading.Lock()
+
+    def cached(self, host: str, port: int) -> Optional[Addresses]:
+        with self._lock:
+            entry = self._cache.get((host, port))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def store(self, host: str, port: int, infos: Iterable[tuple[Any, ...]]) -> Addresses:
+        addresses = [(info[0], info[4]) for info in infos]
+        if self.ttl > 0:
+            with self._lock:
+                self._cache[(host, port)] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def resolve(self, host: str, port: int) -> Addresses:
+        addresses = self.cached(host, port)
+        if addresses is None:
+            addresses = self.store(
+                host, port, socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        return addresses
+
+    async def aresolve(self, host: str, port: int) -> Addresses:
+        addresses = self.cached(host, port)
+        if addresses is None:
+            loop = asyncio.get_running_loop()
+            addresses = self.store(
+                host, port, await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        return addresses
+
+
+def connect_addresses(addresses: Addresses, timeout: Optional[float] = None) -> socket.socket:
+    """
+    Connect a blocking socket to the first of addresses that accepts.
+    """
+    error: Optional[OSError] = None
+    for family, address in addresses:
+        s = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            s.settimeout(timeout)
+            s.connect(address)
+            s.settimeout(None)
+            return s
+        except OSError as e:
+            s.close()
+            error = e
+    raise error or OSError("no addresses")
+
+
+def is_usable(s: socket.socket) -> bool:
+    """
+    True if a ready socket is still open with nothing received.  (A server
+    that gives up on an idle connection closes it, or sends an alert.)
+    """
+    try:
+        s.setblocking(False)
+        try:
+            # Either EOF, or data the client did not ask for
+            s.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            s.setblocking(True)
+    except OSError:
+        return False
+
+
+class UpstreamPool:
+    """
+    Connected sockets kept ready for each destination that has been used (or
+    warmed), so that a forwarded connection need not wait for DNS or the TCP
+    handshake.  Sockets are single use: take() hands one over and a
+    background thread connects its replacement.
+    """
+
+    def __init__(self, config: UpstreamConfig) -> None:
+        self.config = config
+        self.resolver = Resolver(config.dns_ttl)
+        self.stats = UpstreamStats()
+        self._ready: dict[Destination, deque[tuple[float, socket.socket]]] = {}
+        self._cond = threading.Condition()
+        self._filler: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    def warm(self, host: str, port: int) -> None:
+        """
+        Keep sockets ready for <host>:<port>.
+        """
+        if self.config.pool_size == 0 or self._closed.is_set():
+            return
+        with self._cond:
+            self._ready.setdefault((host, port), deque())
+            if self._filler is None:
+                self._filler = threading.Thread(
+                    target=self._fill, name="upstream-pool", daemon=True)
+                self._filler.start()
+            self._cond.notify()
+
+    def take(self, host: str, port: int) -> Optional[socket.socket]:
+        """
+        A ready (blocking) socket connected to <host>:<port>, or None.
+        """
+        self.warm(host, port)
+        deadline = time.monotonic() - self.config.max_idle
+        with self._cond:
+            ready = self._ready.get((host, port))
+            while ready:
+                connected_at, s = ready.popleft()
+                if connected_at > deadline and is_usable(s):
+                    self.stats.hits += 1
+                    self._cond.notify()
+                    return s
+                self.stats.evicted += 1
+                s.close()
+            self.stats.misses += 1
+            return None
+
+    def connect(self, host: str, port: int) -> socket.socket:
+        s = self.take(host, port)
+        if s is None:
+            s = connect_addresses(self.resolver.resolve(host, port))
+        return s
+
+    async def aconnect(self, host: str, port: int) -> socket.socket:
+        s = self.take(host, port)
+        if s is not None:
+            s.setblocking(False)
+            return s
+        loop = asyncio.get_running_loop()
+        error: Optional[OSError] = None
+        for family, address in await self.resolver.aresolve(host, port):
+            s = socket.socket(family, socket.SOCK_STREAM)
+            s.setblocking(False)
+            try:
+                await loop.sock_connect(s, address)
+                return s
+            except OSError as e:
+                s.close()
+                error = e
+        raise error or OSError("no addresses")
+
+    def close(self) -> None:
+        """
+        Close the ready sockets and stop connecting new ones.
+        """
+        with self._cond:
+            self._closed.set()
+            for ready in self._ready.values():
+                for _, s in ready:
+                    s.close()
+                ready.clear()
+            self._cond.notify()
+
+    def ready_count(self) -> int:
+        with self._cond:
+            return self._count()
+
+    def _fill(self) -> None:
+        while not self._closed.is_set():
+            with self._cond:
+                self._evict()
+                wanted = self._wanted()
+                if wanted is None:
+                    self._cond.wait(self.config.max_idle / 4)
+                    continue
+
+            host, port = wanted
+            try:
+                s = connect_addresses(self.resolver.resolve(host, port), CONNECT_TIMEOUT)
+            except OSError as e:
+                print(f"!! upstream pool: connecting to {host}:{port}: {e}")
+                # Try again on the next round
+                with self._cond:
+                    self._cond.wait(self.config.max_idle / 4)
+                continue
+
+            with self._cond:
+                if self._closed.is_set():
+                    s.close()
+                else:
+                    self._ready[wanted].append((time.monotonic(), s))
+
+    def _wanted(self) -> Optional[Destination]:
+        """
+        The destination with the fewest ready sockets, if it has fewer than
+        pool_size and there is room in the pool.
+        """
+        if self._closed.is_set() or not self._ready or self._count() >= self.config.max_sockets:
+            return None
+        destination = min(self._ready, key=lambda d: len(self._ready[d]))
+        if len(self._ready[destination]) >= self.config.pool_size:
+            return None
+        return destination
+
+    def _count(self) -> int:
+        return sum(len(ready) for ready in self._ready.values())
+
+    def _evict(self) -> None:
+        deadline = time.monotonic() - self.config.max_idle
+        for ready in self._ready.values():
+            for item in list(ready):
+                if item[0] <= deadline or not is_usable(item[1]):
+                    ready.remove(item)
+                    item[1].close()
+                    self.stats.evicted += 1
+
+
+# One pool per configuration in each process.  Worker processes forked by
+# core.prefork start with no pools, since the filler threads do not survive
+# the fork.
+_POOLS: dict[UpstreamConfig, UpstreamPool] = {}
+_POOLS_LOCK = threading.Lock()
+os.register_at_fork(after_in_child=_POOLS.clear)
+
+
+def get_pool(config: UpstreamConfig) -> Optional[UpstreamPool]:
+    if not config.enabled:
+        return None
+    with _POOLS_LOCK:
+        pool = _POOLS.get(config)
+        if pool is None:
+            pool = _POOLS[config] = UpstreamPool(config)
+        return pool
+
+
+def connect_upstream(host: str, port: int, config: UpstreamConfig) -> socket.socket:
+    """
+    A blocking socket connected to <host>:<port>, from the pool for config if
+    it is enabled.
+    """
+    pool = get_pool(config)
+    if pool is None:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect((host, port))
+        except BaseException:
+            s.close()
+            raise
+        return s
+    return pool.connect(host, port)
+
+
+async def aconnect_upstream(host: str, port: int, config: UpstreamConfig) -> socket.socket:
+    """
+    A non-blocking socket connected to <host>:<port>, from the pool for config
+    if it is enabled.
+    """
+    pool = get_pool(config)
+    if pool is None:
+        loop = asyncio.get_running_loop()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        try:
+            await loop.sock_connect(s, (host, port))
+        except BaseException:
+            s.close()
+            raise
+        return s
+    return await pool.aconnect(host, port)
+
+
+def warm_upstream(hosts: Iterable[str], port: int, config: UpstreamConfig) -> None:
+    """
+    Start keeping sockets ready for each of hosts, before they are first used.
+    """
+    pool = get_pool(config)
+    if pool is not None:
+        for host in hosts:
+            pool.warm(host, port)
@@ -0,0 +1,137 @@
+from unittest import TestCase
+import asyncio
+import contextlib
+import io
+import socket
+import threading
+import time
+
+from core.admission import AdmissionConfig, AsyncAdmission, ThreadAdmission, \
+    POLICY_REJECT
+
+
+def is_closed(s: socket.socket) -> bool:
+    return s.fileno() == -1
+
+
+class TestAdmission(TestCase):
+
+    def test_config(self) -> None:
+        with self.assertRaises(ValueError):
+            AdmissionConfig(policy="drop")
+        with self.assertRaises(ValueError):
+            AdmissionConfig(max_connections=0)
+
+    def test_report(self) -> None:
+        """
+        The state is reported on a timer, so that the connections are seen
+        to finish when no new ones arrive, and only when it changes.
+        """
+        admission = ThreadAdmission(AdmissionConfig(report_interval=0.05), "test")
+        release = threading.Event()
+        done = threading.Event()
+
+        def handler(s: socket.socket) -> None:
+            release.wait()
+            s.close()
+            done.set()
+
+        a, b = socket.socketpair()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            admission.submit(handler, b)
+            time.sleep(0.2)
+            release.set()
+            done.wait(5)
+            time.sleep(0.2)
+        a.close()
+        self.assertEqual(
+            ["[test] active=1 queued=0 accepted=1 rejected=0",
+             "[test] active=0 queued=0 accepted=1 rejected=0"],
+            out.getvalue().splitlines())
+
+    def test_thread_reject(self) -> None:
+        config = AdmissionConfig(max_connections=2, queue_size=1, policy=POLICY_REJECT)
+        admission = ThreadAdmission(config, "test")
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def handler(s: socket.socket) -> None:
+            started.release()
+            release.wait()
+            s.close()
+
+        pairs = [socket.socketpair() for _ in range(5)]
+        for _, s in pairs:
+            admission.submit(handler, s)
+        started.acquire()
+        started.acquire()
+
+        stats = admission.stats()
+        self.assertEqual(2, stats.active)
+        self.assertEqual(1, stats.queued)
+        self.assertEqual(3, stats.accepted)
+        self.assertEqual(2, stats.rejected)
+        self.assertTrue(is_closed(pairs[3][1]))
+        self.assertTrue(is_closed(pairs[4][1]))
+
+        release.set()
+        started.acquire()
+        for a, _ in pairs:
+            a.close()
+
+    def test_thread_queue_blocks(self) -> None:
+        config = AdmissionConfig(max_connections=1)
+        admission = ThreadAdmission(config, "test")
+        release = threading.Event()
+
+        def handler(s: socket.socket) -> None:
+            release.wait()
+            s.close()
+
+        pairs = [socket.socketpair() for _ in range(2)]
+        admission.submit(handler, pairs[0][1])
+
+        # The second submit blocks the accept loop until the first completes
+        second = threading.Thread(target=admission.submit, args=[handler, pairs[1][1]])
+        second.start()
+        second.join(0.1)
+        self.assertTrue(second.is_alive())
+        release.set()
+        second.join(5)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(2, admission.stats().accepted)
+        for a, _ in pairs:
+            a.close()
+
+    def test_async_reject(self) -> None:
+
+        async def run() -> None:
+            config = AdmissionConfig(max_connections=1, queue_size=1, policy=POLICY_REJECT)
+            admission = AsyncAdmission(config, "test")
+            release = asyncio.Event()
+
+            async def handler(s: socket.socket) -> None:
+                await release.wait()
+                s.close()
+
+            pairs = [socket.socketpair() for _ in range(3)]
+            tasks = []
+            for _, s in pairs:
+                if await admission.admit(s):
+                    tasks.append(asyncio.create_task(admission.run(handler, s)))
+            await asyncio.sleep(0)
+
+            stats = admission.stats()
+            self.assertEqual(1, stats.active)
+            self.assertEqual(1, stats.queued)
+            self.assertEqual(1, stats.rejected)
+            self.assertTrue(is_closed(pairs[2][1]))
+
+            release.set()
+            await asyncio.gather(*tasks)
+            self.assertEqual(0, admission.stats().active)
+            for a, _ in pairs:
+                a.close()
+
+        asyncio.run(run())
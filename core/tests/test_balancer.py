@@ -0,0 +1,162 @@
+from unittest import TestCase
+import asyncio
+import socket
+import threading
+
+from core import forward, aio_forward
+from core.balancer import POLICY_TWO_CHOICES, Backend, Balancer, BalancerConfig, \
+    check_health, parse_backend
+
+from .test_forward import listen_loopback, start_daemon
+
+
+class StandIn:
+    """
+    TCP stand-in for an enclave: answers the health check with 200 (or 503
+    once failed), and answers anything else with its name.
+    """
+
+    def __init__(self, name: bytes) -> None:
+        self.name = name
+        self.healthy = True
+        self.server_socket = listen_loopback()
+        self.backend = Backend.tcp("127.0.0.1", self.server_socket.getsockname()[1])
+        start_daemon(self._serve)
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                s, _ = self.server_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=[s], daemon=True).start()
+
+    def stop(self) -> None:
+        # Wakes the accept, and refuses further connections
+        self.server_socket.shutdown(socket.SHUT_RDWR)
+        self.server_socket.close()
+
+    def _handle(self, s: socket.socket) -> None:
+        with s:
+            request = s.recv(4096)
+            if request.startswith(b"GET /enclave/address"):
+                status = b"200 OK" if self.healthy else b"503 Unavailable"
+                s.sendall(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\n\r\n")
+            else:
+                s.sendall(self.name)
+
+
+def ask(port: int) -> bytes:
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as c:
+        c.sendall(b"hello")
+        return c.recv(64)
+
+
+class TestBalancer(TestCase):
+
+    def test_parse_backend(self) -> None:
+        self.assertEqual(Backend.vsock(16, 5001), parse_backend("16", 5001))
+        self.assertEqual(Backend.vsock(16, 6000), parse_backend("vsock:16:6000", 5001))
+        self.assertEqual(Backend.tcp("127.0.0.1", 6000), parse_backend("127.0.0.1:6000", 5001))
+        with self.assertRaises(ValueError):
+            parse_backend("localhost", 5001)
+
+    def test_least_connections(self) -> None:
+        backends = [Backend.tcp("127.0.0.1", port) for port in range(3)]
+        balancer = Balancer(lambda: backends, check=lambda *_: True)
+        balancer.refresh()
+        self.assertIsNone(balancer.acquire())
+        balancer.check_all()
+
+        acquired = [balancer.acquire() for _ in range(3)]
+        self.assertEqual(set(backends), set(acquired))
+        balancer.release(backends[1])
+        self.assertEqual(backends[1], balancer.acquire())
+
+    def test_two_choices(self) -> None:
+        backends = [Backend.tcp("127.0.0.1", port) for port in range(8)]
+        balancer = Balancer(
+            lambda: backends, BalancerConfig(policy=POLICY_TWO_CHOICES), check=lambda *_: True)
+        balancer.refresh()
+        balancer.check_all()
+        for _ in range(800):
+            balancer.acquire()
+        active = [stats["active"] for stats in balancer.stats()]
+        self.assertEqual(800, sum(active))
+        self.assertLess(max(active) - min(active), 20)
+
+    def test_eject_and_readmit(self) -> None:
+        backend = Backend.tcp("127.0.0.1", 1)
+        healthy = [True]
+        balancer = Balancer(
+            lambda: [backend], BalancerConfig(fall=2, rise=2), check=lambda *_: healthy[0])
+        balancer.refresh()
+        balancer.check_all()
+        self.assertTrue(balancer.stats()[0]["healthy"])
+
+        healthy[0] = False
+        balancer.check_all()
+        self.assertTrue(balancer.stats()[0]["healthy"])
+        balancer.check_all()
+        self.assertFalse(balancer.stats()[0]["healthy"])
+        self.assertIsNone(balancer.acquire())
+
+        healthy[0] = True
+        balancer.check_all()
+        self.assertFalse(balancer.stats()[0]["healthy"])
+        balancer.check_all()
+        self.assertEqual(backend, balancer.acquire())
+
+    def test_check_health(self) -> None:
+        stand_in = StandIn(b"a")
+        self.assertTrue(check_health(stand_in.backend, "/enclave/address", 5))
+        stand_in.healthy = False
+        self.assertFalse(check_health(stand_in.backend, "/enclave/address", 5))
+        # Nothing listening
+        closed = listen_loopback()
+        closed_backend = Backend.tcp("127.0.0.1", closed.getsockname()[1])
+        closed.close()
+        self.assertFalse(check_health(closed_backend, "/enclave/address", 5))
+
+    def _check_forwarder(self, start: str) -> None:
+        stand_ins = [StandIn(b"a"), StandIn(b"b")]
+        balancer = Balancer(
+            lambda: [stand_in.backend for stand_in in stand_ins],
+            BalancerConfig(fall=1, rise=1))
+        balancer.refresh()
+        balancer.check_all()
+        server_socket = listen_loopback()
+        port = server_socket.getsockname()[1]
+        if start == "thread":
+            start_daemon(lambda: forward.forward_connections_to_backends(
+                server_socket, balancer))
+        else:
+            start_daemon(lambda: asyncio.run(aio_forward.forward_connections_to_backends(
+                server_socket, balancer)))
+
+        # Sequential connections all see the same (idle) backends, so hold
+        # them open to spread them
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as held:
+            held.sendall(b"hello")
+            first = held.recv(64)
+            self.assertNotEqual(first, ask(port))
+
+        stand_ins[0].healthy = False
+        balancer.check_all()
+        self.assertEqual({b"b"}, {ask(port) for _ in range(5)})
+
+        stand_ins[0].healthy = True
+        balancer.check_all()
+        self.assertEqual(2, sum(stats["healthy"] for stats in balancer.stats()))
+
+        # A backend that refuses connections is skipped, and ejected
+        stand_ins[1].stop()
+        self.assertEqual({b"a"}, {ask(port) for _ in range(5)})
+        self.assertEqual(
+            [True, False], [stats["healthy"] for stats in balancer.stats()])
+
+    def test_thread_engine(self) -> None:
+        self._check_forwarder("thread")
+
+    def test_asyncio_engine(self) -> None:
+        self._check_forwarder("asyncio")
@@ -0,0 +1,130 @@
+from typing import Callable
+from unittest import TestCase
+import asyncio
+import contextlib
+import io
+import socket
+import struct
+import threading
+import time
+
+from core import forward, aio_forward
+
+
+def listen_loopback() -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    s.listen(128)
+    return s
+
+
+def start_daemon(target: Callable[[], None]) -> None:
+    threading.Thread(target=target, daemon=True).start()
+
+
+def start_echo_server() -> int:
+    """
+    Start an echo server on loopback, returning its port.
+    """
+    server_socket = listen_loopback()
+
+    def echo(s: socket.socket) -> None:
+        with s:
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                s.sendall(data)
+
+    def serve() -> None:
+        while True:
+            s, _ = server_socket.accept()
+            threading.Thread(target=echo, args=[s], daemon=True).start()
+
+    start_daemon(serve)
+    return int(server_socket.getsockname()[1])
+
+
+def recv_exactly(s: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = s.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class TestForward(TestCase):
+
+    def _check_forwarder(self, port: int) -> None:
+        payload = bytes(range(256)) * 1024
+        for _ in range(3):
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as c:
+                c.sendall(payload)
+                self.assertEqual(payload, recv_exactly(c, len(payload)))
+
+    def test_thread_engine(self) -> None:
+        echo_port = start_echo_server()
+        server_socket = listen_loopback()
+        start_daemon(lambda: forward.forward_connections_to_ip(
+            server_socket, "127.0.0.1", echo_port))
+        self._check_forwarder(server_socket.getsockname()[1])
+
+    def test_asyncio_engine(self) -> None:
+        echo_port = start_echo_server()
+        server_socket = listen_loopback()
+        start_daemon(lambda: asyncio.run(aio_forward.forward_connections_to_ip(
+            server_socket, "127.0.0.1", echo_port)))
+        self._check_forwarder(server_socket.getsockname()[1])
+
+    def test_asyncio_engine_concurrent(self) -> None:
+        echo_port = start_echo_server()
+        server_socket = listen_loopback()
+        start_daemon(lambda: asyncio.run(aio_forward.forward_connections_to_ip(
+            server_socket, "127.0.0.1", echo_port)))
+        port = server_socket.getsockname()[1]
+
+        # Hold many idle connections open, then use each one.
+        clients = [
+            socket.create_connection(("127.0.0.1", port), timeout=5)
+            for _ in range(100)
+        ]
+        try:
+            for i, c in enumerate(clients):
+                c.sendall(f"hello {i}".encode())
+            for i, c in enumerate(clients):
+                expect = f"hello {i}".encode()
+                self.assertEqual(expect, recv_exactly(c, len(expect)))
+        finally:
+            for c in clients:
+                c.close()
+
+    def test_thread_engine_https_reset(self) -> None:
+        """
+        A client resetting its connection is logged, and the forwarder
+        carries on.
+        """
+        server_socket = listen_loopback()
+        port = server_socket.getsockname()[1]
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            start_daemon(lambda: forward.forward_https_connections_to_ip(server_socket, 443))
+            for _ in range(2):
+                c = socket.create_connection(("127.0.0.1", port), timeout=5)
+                # Part of a TLS record header, then a reset (RST)
+                c.sendall(b"\x16\x03\x01")
+                time.sleep(0.05)
+                c.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                c.close()
+            deadline = time.monotonic() + 5
+            while out.getvalue().count("error handling https connection") < 2 and \
+                    time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(2, out.getvalue().count("error handling https connection"))
+        self.assertEqual("", err.getvalue())
+
+    def test_config(self) -> None:
+        self.assertEqual("thread", forward.ForwardConfig().engine)
+        with self.assertRaises(ValueError):
+            forward.ForwardConfig(engine="fibers")
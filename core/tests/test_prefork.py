@@ -0,0 +1,57 @@
+from unittest import TestCase
+import os
+import signal
+import socket
+import threading
+import time
+
+from core.forward import listen_ip
+from core.forward_config import ForwardConfig
+from core.prefork import Supervisor
+
+
+def accept_forever(server_socket: socket.socket) -> None:
+    while True:
+        s, _ = server_socket.accept()
+        with s:
+            s.sendall(str(os.getpid()).encode())
+
+
+class TestPrefork(TestCase):
+
+    def test_reuse_port(self) -> None:
+        config = ForwardConfig(reuse_port=True)
+        a = listen_ip("127.0.0.1", 0, config)
+        port = a.getsockname()[1]
+        b = listen_ip("127.0.0.1", port, config)
+        a.close()
+        b.close()
+
+    def test_shared_listener(self) -> None:
+        server_socket = listen_ip("127.0.0.1", 0, ForwardConfig())
+        port = server_socket.getsockname()[1]
+        supervisor = Supervisor(2, lambda: accept_forever(server_socket))
+        supervisor.start()
+        try:
+            pids = set()
+            for _ in range(20):
+                with socket.create_connection(("127.0.0.1", port), timeout=5) as c:
+                    pids.add(int(c.recv(16)))
+            self.assertTrue(pids <= set(supervisor.pids))
+        finally:
+            supervisor.stop()
+            server_socket.close()
+
+    def test_restart(self) -> None:
+        supervisor = Supervisor(2, lambda: time.sleep(60), restart_delay=0.0)
+        supervisor.start()
+        first_pids = supervisor.pids
+
+        pid = first_pids[0]
+        assert pid is not None
+        threading.Timer(0.2, os.kill, [pid, signal.SIGKILL]).start()
+        supervisor.run(max_restarts=1)
+
+        self.assertEqual(1, supervisor.restarts)
+        self.assertNotEqual(first_pids[0], supervisor.pids[0])
+        self.assertEqual(first_pids[1], supervisor.pids[1])
@@ -0,0 +1,88 @@
+from typing import Any, Optional
+from unittest import TestCase
+from unittest.mock import patch
+import errno
+import os
+import socket
+import threading
+import time
+
+from core import relay
+from core.loopback import tcp_pair
+
+
+class TestRelay(TestCase):
+
+    def _check_relay(
+            self,
+            mode: str,
+            payload: bytes,
+            timeout: Optional[float] = None,
+            delay: float = 0.0) -> None:
+        # producer -> (src_w, src) -> relay -> (dst, dst_r) -> consumer
+        src_w, src = tcp_pair()
+        dst, dst_r = tcp_pair()
+        src.settimeout(timeout)
+        dst.settimeout(timeout)
+        received = bytearray()
+
+        def produce() -> None:
+            time.sleep(delay)
+            src_w.sendall(payload)
+            src_w.close()
+
+        def consume() -> None:
+            while data := dst_r.recv(65536):
+                received.extend(data)
+
+        producer = threading.Thread(target=produce)
+        consumer = threading.Thread(target=consume)
+        producer.start()
+        consumer.start()
+        relay.relay(src, dst, mode)
+        dst.close()
+        producer.join()
+        consumer.join()
+        src.close()
+        dst_r.close()
+
+        self.assertEqual(payload, bytes(received))
+
+    def test_relay_modes(self) -> None:
+        payload = bytes(range(256)) * 4096 + b"tail"
+        for mode in relay.RELAYS:
+            with self.subTest(mode=mode):
+                self._check_relay(mode, payload)
+
+    def test_splice_unavailable(self) -> None:
+        with patch.object(relay, "HAS_SPLICE", False):
+            self._check_relay(relay.RELAY_SPLICE, b"no splice" * 10000)
+
+    def test_splice_timeout(self) -> None:
+        # Sockets with a timeout are non-blocking underneath, so the relay
+        # must still wait for data that is late
+        self._check_relay(relay.RELAY_SPLICE, b"timeout" * 100000, timeout=10.0, delay=0.1)
+
+    def test_splice_unsupported_dst(self) -> None:
+        """
+        If splicing into dst fails, the data already in the pipe is still
+        relayed.
+        """
+        splice = os.splice
+        spliced: list[int] = []
+
+        def splice_to_pipe_only(src: int, dst: int, count: int, *args: Any, **kwargs: Any) -> int:
+            if spliced:
+                raise OSError(errno.EINVAL, "splice into a socket")
+            n = splice(src, dst, count, *args, **kwargs)
+            spliced.append(n)
+            return n
+
+        with patch.object(relay.os, "splice", splice_to_pipe_only):
+            self._check_relay(relay.RELAY_SPLICE, bytes(range(256)) * 4096)
+        self.assertGreater(spliced[0], 0)
+
+    def test_unknown_mode(self) -> None:
+        a, b = socket.socketpair()
+        with a, b, self.assertRaises(ValueError):
+            relay.relay(a, b, "carrier-pigeon")
@@ -0,0 +1,210 @@
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+import socket
+import ssl
+import struct
+import threading
+import tempfile
+import time
+
+from core import aio_forward, forward, tls
+from core.destinations import HostTable, load_host_table
+
+
+def client_hello(server_name: str) -> bytes:
+    """
+    A real ClientHello generated by the ssl module.
+    """
+    ctx = ssl.create_default_context()
+    incoming = ssl.MemoryBIO()
+    outgoing = ssl.MemoryBIO()
+    conn = ctx.wrap_bio(incoming, outgoing, server_hostname=server_name)
+    try:
+        conn.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def add_padding(hello: bytes, padding_length: int) -> bytes:
+    """
+    Append a padding extension (type 21) to a single-record ClientHello,
+    making it as large as a hello carrying post-quantum key shares.
+    """
+    handshake = hello[5:]
+    body = handshake[4:]
+    # legacy_version, random, session_id, cipher_suites, compression
+    offset = 2 + 32
+    offset += 1 + body[offset]
+    offset += 2 + int.from_bytes(body[offset:offset + 2], "big")
+    offset += 1 + body[offset]
+    extensions_length = int.from_bytes(body[offset:offset + 2], "big")
+    extensions = body[offset + 2:offset + 2 + extensions_length]
+    extensions += struct.pack(">HH", 21, padding_length) + b"\0" * padding_length
+    body = body[:offset] + struct.pack(">H", len(extensions)) + extensions
+    return struct.pack(">B", 1) + len(body).to_bytes(3, "big") + body
+
+
+def to_records(handshake: bytes, record_size: int) -> bytes:
+    """
+    Split a handshake message into TLS records of at most record_size bytes.
+    """
+    records = b""
+    for i in range(0, len(handshake), record_size):
+        fragment = handshake[i:i + record_size]
+        records += struct.pack(">BBBH", 0x16, 3, 1, len(fragment)) + fragment
+    return records
+
+
+def read_all(reader: tls.ClientHelloReader, data: bytes, step: int) -> None:
+    for i in range(0, len(data), step):
+        reader.feed(data[i:i + step])
+
+
+class TestTls(TestCase):
+
+    def test_sni(self) -> None:
+        hello = client_hello("api.openai.com")
+        reader = tls.ClientHelloReader()
+        reader.feed(hello)
+        self.assertTrue(reader.done)
+        self.assertEqual("api.openai.com", reader.server_name)
+        self.assertEqual(hello, reader.data)
+
+    def test_byte_at_a_time(self) -> None:
+        hello = client_hello("api.anthropic.com")
+        reader = tls.ClientHelloReader()
+        read_all(reader, hello, 1)
+        self.assertEqual("api.anthropic.com", reader.server_name)
+
+    def test_large_hello_many_records(self) -> None:
+        handshake = add_padding(client_hello("api.together.xyz"), 20000)
+        data = to_records(handshake, 1000)
+        self.assertGreater(len(data), 4096)
+
+        reader = tls.ClientHelloReader()
+        read_all(reader, data, 1460)
+        self.assertTrue(reader.done)
+        self.assertEqual("api.together.xyz", reader.server_name)
+
+    def test_wanted(self) -> None:
+        # Reading exactly wanted() bytes never consumes past the hello
+        data = to_records(add_padding(client_hello("api.openai.com"), 5000), 700)
+        reader = tls.ClientHelloReader()
+        offset = 0
+        while not reader.done:
+            n = reader.wanted()
+            self.assertGreater(n, 0)
+            reader.feed(data[offset:offset + n])
+            offset += n
+        self.assertEqual(len(data), offset)
+        self.assertEqual(0, reader.wanted())
+
+    def test_malformed(self) -> None:
+        with self.assertRaises(tls.TlsParseError):
+            tls.ClientHelloReader().feed(b"GET / HTTP/1.1\r\n")
+
+        # Handshake record, but not a ClientHello
+        with self.assertRaises(tls.TlsParseError):
+            tls.ClientHelloReader().feed(bytes([0x16, 3, 1, 0, 4, 2, 0, 0, 0]))
+
+        # Body shorter than its fields
+        hello = client_hello("api.openai.com")
+        truncated = b"\x01" + (40).to_bytes(3, "big") + hello[9:49]
+        with self.assertRaises(tls.TlsParseError):
+            tls.ClientHelloReader().feed(to_records(truncated, 1000))
+
+        # Declared length above the limit
+        with self.assertRaises(tls.TlsParseError):
+            tls.ClientHelloReader(max_length=1024).feed(
+                to_records(add_padding(hello, 2000), 1000))
+
+    def test_host_table(self) -> None:
+        hosts = HostTable(["API.openai.com.", "api.anthropic.com"])
+        self.assertEqual("api.openai.com", hosts.lookup("api.openai.com"))
+        self.assertEqual("api.anthropic.com", hosts.lookup("API.Anthropic.com."))
+        self.assertIsNone(hosts.lookup("evil.com"))
+        self.assertIsNone(hosts.lookup(None))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("# providers\napi.openai.com\n\n  example.com  # test\n")
+            f.flush()
+            hosts = load_host_table(f.name)
+        self.assertEqual(2, len(hosts))
+        self.assertIn("example.com", hosts)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            f.write('["api.openai.com"]')
+            f.flush()
+            self.assertIn("api.openai.com", load_host_table(f.name))
+
+    def test_determine_https_destination(self) -> None:
+        data = to_records(add_padding(client_hello("api.openai.com"), 6000), 2000)
+        trailing = b"after the hello"
+        a, b = socket.socketpair()
+        with a, b:
+            def send() -> None:
+                # Deliver in small segments
+                for i in range(0, len(data), 500):
+                    a.sendall(data[i:i + 500])
+                a.sendall(trailing)
+
+            sender = threading.Thread(target=send)
+            sender.start()
+            dest, leading_bytes = forward.determine_https_destination(b)
+            sender.join()
+
+            self.assertEqual("api.openai.com", dest)
+            self.assertEqual(data, leading_bytes)
+            self.assertEqual(trailing, b.recv(len(trailing)))
+
+    def test_determine_https_destination_rejects(self) -> None:
+        for data in [client_hello("evil.com"), b"\x16\x03\x01\xff\xff" + b"x" * 100]:
+            a, b = socket.socketpair()
+            with a, b:
+                a.sendall(data)
+                dest, _ = forward.determine_https_destination(b)
+                self.assertIsNone(dest)
+
+    @patch.object(forward, "CLIENT_HELLO_TIMEOUT", 0.5)
+    def test_determine_https_destination_slow(self) -> None:
+        # A client dripping its hello is dropped once the time for the whole
+        # hello is up, though no one read waits that long
+        data = client_hello("api.openai.com")
+        a, b = socket.socketpair()
+        with a, b:
+            stop = threading.Event()
+
+            def send() -> None:
+                for i in range(len(data)):
+                    if stop.wait(0.05):
+                        break
+                    a.sendall(data[i:i + 1])
+
+            sender = threading.Thread(target=send)
+            sender.start()
+            start = time.monotonic()
+            dest, _ = forward.determine_https_destination(b)
+            elapsed = time.monotonic() - start
+            stop.set()
+            sender.join()
+
+            self.assertIsNone(dest)
+            self.assertLess(elapsed, 1.5)
+
+    def test_aio_determine_https_destination(self) -> None:
+        data = to_records(add_padding(client_hello("api.anthropic.com"), 3000), 1000)
+        a, b = socket.socketpair()
+        with a, b:
+            b.setblocking(False)
+
+            async def run() -> tuple[object, bytes]:
+                loop = asyncio.get_running_loop()
+                for i in range(0, len(data), 700):
+                    loop.call_later(0.001 * i / 700, a.sendall, data[i:i + 700])
+                return await aio_forward.determine_https_destination(b, HostTable())
+
+            dest, leading_bytes = asyncio.run(run())
+            self.assertEqual("api.anthropic.com", dest)
+            self.assertEqual(data, leading_bytes)
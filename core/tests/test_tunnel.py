@@ -0,0 +1,193 @@
+from typing import Any, Coroutine
+from unittest import TestCase
+import asyncio
+import socket
+
+from core import aio_forward, tunnel
+from core.forward_config import ForwardConfig
+from core.tunnel import ChannelPool, TunnelConfig, TunnelError, TunnelStream
+from core.tunnel_enclave import enclave_handlers, run_enclave_tunnel
+from core.tunnel_host import run_host_tunnel
+
+from .test_forward import listen_loopback, start_echo_server
+
+ECHO = 7
+
+
+async def echo(stream: TunnelStream) -> None:
+    while data := await stream.read():
+        await stream.write(data)
+
+
+async def read_all(stream: TunnelStream) -> bytes:
+    data = b""
+    while chunk := await stream.read():
+        data += chunk
+    return data
+
+
+def run(coro: Coroutine[Any, Any, None]) -> None:
+    asyncio.run(asyncio.wait_for(coro, 10))
+
+
+async def channel_pair(
+        handlers: dict[int, tunnel.StreamHandler],
+        window: int = tunnel.DEFAULT_WINDOW,
+) -> tuple[ChannelPool, list[asyncio.Task[None]]]:
+    """
+    Connect a channel over a socketpair.  Returns the pool for the host end.
+    The enclave end serves handlers.
+    """
+    a, b = socket.socketpair()
+    host_pool = ChannelPool()
+    enclave_pool = ChannelPool()
+    loop = asyncio.get_running_loop()
+    tasks = [
+        loop.create_task(host_pool.run_channel(a, {}, True, window)),
+        loop.create_task(enclave_pool.run_channel(b, handlers, False, window)),
+    ]
+    await asyncio.sleep(0)
+    return host_pool, tasks
+
+
+class TestTunnel(TestCase):
+
+    def test_concurrent_streams(self) -> None:
+        async def check() -> None:
+            pool, tasks = await channel_pair({ECHO: echo})
+
+            async def round_trip(i: int) -> None:
+                payload = bytes([i]) * 100000
+                stream = await pool.open_stream(ECHO)
+                await stream.write(payload)
+                stream.close()
+                self.assertEqual(payload, await read_all(stream))
+
+            await asyncio.gather(*(round_trip(i) for i in range(50)))
+            self.assertEqual(0, len(pool.channels[0].streams))
+            for task in tasks:
+                task.cancel()
+
+        run(check())
+
+    def test_flow_control(self) -> None:
+        window = tunnel.MAX_FRAME_PAYLOAD
+        received: list[TunnelStream] = []
+        release = asyncio.Event()
+
+        async def slow_reader(stream: TunnelStream) -> None:
+            received.append(stream)
+            await release.wait()
+            await stream.write(await read_all(stream))
+
+        async def check() -> None:
+            pool, tasks = await channel_pair({ECHO: slow_reader}, window)
+            stream = await pool.open_stream(ECHO)
+            payload = b"x" * (window * 4)
+            writer = asyncio.get_running_loop().create_task(stream.write(payload))
+            await asyncio.sleep(0.1)
+
+            # The writer is blocked once the window is used, and the reader
+            # has buffered no more than the window.
+            self.assertFalse(writer.done())
+            # pylint: disable=protected-access
+            self.assertLessEqual(len(received[0]._buffer), window)
+
+            release.set()
+            await writer
+            stream.close()
+            self.assertEqual(payload, await read_all(stream))
+            for task in tasks:
+                task.cancel()
+
+        run(check())
+
+    def test_unknown_service(self) -> None:
+        async def check() -> None:
+            pool, tasks = await channel_pair({ECHO: echo})
+            stream = await pool.open_stream(ECHO + 1)
+            with self.assertRaises(TunnelError):
+                await stream.read()
+            for task in tasks:
+                task.cancel()
+
+        run(check())
+
+    def test_channel_closed(self) -> None:
+        async def check() -> None:
+            pool, tasks = await channel_pair({ECHO: echo})
+            stream = await pool.open_stream(ECHO)
+            tasks[1].cancel()
+            with self.assertRaises(TunnelError):
+                await stream.read()
+            with self.assertRaises(TunnelError):
+                await pool.open_stream(ECHO, timeout=0.1)
+            tasks[0].cancel()
+
+        run(check())
+
+    def test_config(self) -> None:
+        with self.assertRaises(ValueError):
+            TunnelConfig(num_channels=0)
+        with self.assertRaises(ValueError):
+            TunnelConfig(window=1024)
+
+    def test_host_and_enclave(self) -> None:
+        """
+        Both ends of the tunnel, with TCP in place of vsock, and echo servers
+        in place of the app and the provider.
+        """
+        app_port = start_echo_server()
+        provider_port = start_echo_server()
+        tunnel_config = TunnelConfig(app_port=app_port, num_channels=2)
+        config = ForwardConfig()
+
+        channel_listener = listen_loopback()
+        host_listener = listen_loopback()
+        enclave_listener = listen_loopback()
+
+        async def connect() -> socket.socket:
+            return await aio_forward.open_socket(
+                socket.AF_INET, channel_listener.getsockname())
+
+        async def client(port: int, payload: bytes) -> bytes:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(payload)
+            data = await reader.readexactly(len(payload))
+            writer.close()
+            return data
+
+        async def check() -> None:
+            loop = asyncio.get_running_loop()
+            host_handlers = {provider_port: tunnel_proxy(provider_port)}
+            tasks = [
+                loop.create_task(run_host_tunnel(
+                    host_listener, connect, host_handlers, config, tunnel_config)),
+                loop.create_task(run_enclave_tunnel(
+                    channel_listener,
+                    {provider_port: enclave_listener},
+                    enclave_handlers("127.0.0.1", app_port),
+                    config,
+                    tunnel_config)),
+            ]
+            payload = bytes(range(256)) * 1024
+            inbound = host_listener.getsockname()[1]
+            outbound = enclave_listener.getsockname()[1]
+            results = await asyncio.gather(
+                *(client(inbound, payload) for _ in range(10)),
+                *(client(outbound, payload) for _ in range(10)),
+            )
+            self.assertEqual([payload] * 20, results)
+            for task in tasks:
+                task.cancel()
+
+        run(check())
+        for listener in [channel_listener, host_listener, enclave_listener]:
+            listener.close()
+
+
+def tunnel_proxy(port: int) -> tunnel.StreamHandler:
+    async def handle(stream: TunnelStream) -> None:
+        s = await aio_forward.open_socket(socket.AF_INET, ("127.0.0.1", port))
+        await tunnel.connect_socket_to_stream(s, stream)
+    return handle
@@ -0,0 +1,156 @@
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+import socket
+import threading
+import time
+
+from core import aio_forward, forward, upstream
+from core.forward_config import ForwardConfig, ENGINE_ASYNCIO
+from core.upstream import Resolver, UpstreamConfig, UpstreamPool
+
+from .test_forward import listen_loopback, recv_exactly, start_daemon, start_echo_server
+
+
+class AcceptCounter:
+    """
+    Loopback server that counts and holds accepted connections.
+    """
+
+    def __init__(self) -> None:
+        self.server_socket = listen_loopback()
+        self.port = int(self.server_socket.getsockname()[1])
+        self.accepted: list[socket.socket] = []
+        start_daemon(self._serve)
+
+    def _serve(self) -> None:
+        while True:
+            s, _ = self.server_socket.accept()
+            self.accepted.append(s)
+
+    def close_all(self) -> None:
+        for s in self.accepted:
+            s.close()
+
+    def close(self) -> None:
+        self.close_all()
+        self.server_socket.close()
+
+
+def wait_for(condition: object, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline: # type: ignore
+        time.sleep(0.01)
+
+
+class TestUpstream(TestCase):
+
+    def test_config(self) -> None:
+        self.assertFalse(UpstreamConfig().enabled)
+        with self.assertRaises(ValueError):
+            UpstreamConfig(pool_size=-1)
+        with self.assertRaises(ValueError):
+            UpstreamConfig(max_idle=0)
+
+    def test_resolver_ttl(self) -> None:
+        with patch.object(upstream.socket, "getaddrinfo", wraps=socket.getaddrinfo) as gai:
+            resolver = Resolver(ttl=0.2)
+            first = resolver.resolve("localhost", 4431)
+            self.assertEqual(first, resolver.resolve("localhost", 4431))
+            self.assertEqual(1, gai.call_count)
+            time.sleep(0.3)
+            resolver.resolve("localhost", 4431)
+            self.assertEqual(2, gai.call_count)
+
+            # ttl 0 does not cache
+            resolver = Resolver(ttl=0)
+            resolver.resolve("localhost", 4431)
+            resolver.resolve("localhost", 4431)
+            self.assertEqual(4, gai.call_count)
+
+    def test_pool(self) -> None:
+        server = AcceptCounter()
+        pool = UpstreamPool(UpstreamConfig(pool_size=2))
+        pool.warm("127.0.0.1", server.port)
+        wait_for(lambda: len(server.accepted) == 2)
+        self.assertEqual(2, pool.ready_count())
+
+        # Taking a socket costs no connection, and it is replaced
+        s = pool.connect("127.0.0.1", server.port)
+        self.assertEqual(1, pool.stats.hits)
+        wait_for(lambda: len(server.accepted) == 3)
+        wait_for(lambda: pool.ready_count() == 2)
+        self.assertEqual(3, len(server.accepted))
+        s.sendall(b"ping")
+        self.assertEqual(b"ping", server.accepted[0].recv(4))
+        s.close()
+
+        # Sockets closed by the server are not handed out
+        server.close_all()
+        time.sleep(0.1)
+        s = pool.connect("127.0.0.1", server.port)
+        self.assertEqual(2, pool.stats.evicted)
+        self.assertEqual(1, pool.stats.misses)
+        s.close()
+        pool.close()
+        server.close()
+
+    def test_max_sockets_and_idle(self) -> None:
+        servers = [AcceptCounter() for _ in range(3)]
+        pool = UpstreamPool(UpstreamConfig(pool_size=2, max_sockets=4, max_idle=0.4))
+        for server in servers:
+            pool.warm("127.0.0.1", server.port)
+        wait_for(lambda: pool.ready_count() == 4)
+        time.sleep(0.1)
+        self.assertEqual(4, pool.ready_count())
+
+        # Idle sockets are replaced
+        wait_for(lambda: sum(len(s.accepted) for s in servers) >= 8)
+        self.assertGreaterEqual(pool.stats.evicted, 4)
+        pool.close()
+        for server in servers:
+            server.close()
+
+    def _check_forwarder(self, config: ForwardConfig) -> None:
+        echo_port = start_echo_server()
+        server_socket = listen_loopback()
+        if config.engine == ENGINE_ASYNCIO:
+            start_daemon(lambda: asyncio.run(aio_forward.forward_connections_to_ip(
+                server_socket, "127.0.0.1", echo_port, config)))
+        else:
+            start_daemon(lambda: forward.forward_connections_to_ip(
+                server_socket, "127.0.0.1", echo_port, config))
+
+        port = server_socket.getsockname()[1]
+        for _ in range(5):
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as c:
+                c.sendall(b"hello")
+                self.assertEqual(b"hello", recv_exactly(c, 5))
+            time.sleep(0.05)
+
+        pool = upstream.get_pool(config.upstream)
+        assert pool is not None
+        self.assertGreaterEqual(pool.stats.hits, 3)
+        pool.close()
+
+    def test_forward_thread_engine(self) -> None:
+        self._check_forwarder(ForwardConfig(
+            upstream=UpstreamConfig(pool_size=2, dns_ttl=60, max_sockets=10)))
+
+    def test_forward_asyncio_engine(self) -> None:
+        self._check_forwarder(ForwardConfig(
+            engine=ENGINE_ASYNCIO,
+            upstream=UpstreamConfig(pool_size=2, dns_ttl=60, max_sockets=11)))
+
+    def test_pool_per_process(self) -> None:
+        config = UpstreamConfig(pool_size=1, max_sockets=12)
+        pool = upstream.get_pool(config)
+        self.assertIs(pool, upstream.get_pool(config))
+        self.assertIsNone(upstream.get_pool(UpstreamConfig()))
+
+        result: list[object] = []
+        threading.Thread(target=lambda: result.append(upstream.get_pool(config))).start()
+        wait_for(lambda: result)
+        self.assertIs(pool, result[0])
+        assert pool is not None
+        pool.close()
@@ -0,0 +1,107 @@
+"""
+Per-request latency of provider calls from the /enclave/query handler, with a
+new OpenAI client per request (as before enclave.providers) and with the
+long-lived clients of enclave.providers.ProviderClients.
+
+Requests go to a local mock provider (over https with a self-signed
+certificate, unless --no-tls).  Modes:
+  fresh      - OpenAI(api_key=..., base_url=...) for every request
+  pooled     - ProviderClients: keep-alive connections
+  resumed    - ProviderClients without keep-alive: a new connection per
+               request, resuming the TLS session
+Each request is timed from the handler's point of view, including any client
+construction.
+
+Usage:
+  python enclave/benchmarks/bench_provider_clients.py --requests 200
+"""
+
+from typing import Any, Callable
+import os
+import statistics
+import time
+
+from click import command, option, Choice
+
+# enclave.utils requires the provider keys
+for var in ["OPENAI_API_KEY", "ANTHROPIC_API_KEY", "TOGETHER_API_KEY"]:
+    os.environ.setdefault(var, "unused")
+
+# pylint: disable=wrong-import-position
+from openai import OpenAI
+
+from enclave.providers import ProviderClientConfig, ProviderClients
+
+from mock_provider import MockProvider
+
+MODES = ["fresh", "pooled", "resumed"]
+MESSAGES: Any = [{"role": "user", "content": "Explain prime numbers"}]
+
+
+def query(client: OpenAI) -> None:
+    client.chat.completions.create(model="mock", messages=MESSAGES)
+
+
+def bench_mode(mode: str, provider: MockProvider, requests: int) -> dict[str, Any]:
+    api_keys = {"mock": "mock"}
+    clients = ProviderClients(
+        ProviderClientConfig(max_keepalive_connections=0 if mode == "resumed" else 20),
+        api_keys=api_keys,
+        get_base_url=lambda _: provider.base_url)
+
+    get_client: Callable[[], OpenAI]
+    if mode == "fresh":
+        def get_client() -> OpenAI:
+            return OpenAI(api_key="mock", base_url=provider.base_url)
+    else:
+        def get_client() -> OpenAI:
+            return clients.client("mock")
+
+    # Warm up (first client / connection)
+    query(get_client())
+    connections = provider.connections
+    resumed = provider.resumed
+
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        query(get_client())
+        latencies.append(time.perf_counter() - start)
+    clients.close()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "mean_ms": 1000 * statistics.mean(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p95_ms": 1000 * latencies[int(len(latencies) * 0.95)],
+        "connections": provider.connections - connections,
+        "resumed": provider.resumed - resumed,
+    }
+
+
+@command()
+@option("--mode", "-m", type = Choice(MODES), multiple = True)
+@option("--requests", "-n", type = int, default = 200)
+@option("--no-tls", is_flag = True, help="Use http to the mock provider")
+@option("--latency-ms", type = float, default = 0.0, help="Mock provider processing time")
+def main(mode: tuple[str, ...], requests: int, no_tls: bool, latency_ms: float) -> None:
+    provider = MockProvider(tls=not no_tls, latency=latency_ms / 1000)
+    if provider.cert_path:
+        # Trusted by both the default httpx context and ProviderClients
+        os.environ["SSL_CERT_FILE"] = provider.cert_path
+    try:
+        results = [bench_mode(m, provider, requests) for m in mode or MODES]
+    finally:
+        provider.close()
+
+    baseline = results[0]["mean_ms"]
+    for r in results:
+        print(
+            f"{r['mode']:>8}: mean={r['mean_ms']:.2f}ms p50={r['p50_ms']:.2f}ms"
+            f" p95={r['p95_ms']:.2f}ms  saved={baseline - r['mean_ms']:.2f}ms/request"
+            f"  connections={r['connections']} resumed={r['resumed']}")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
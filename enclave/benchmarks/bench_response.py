@@ -0,0 +1,150 @@
+"""
+Time to encode a signed query response in the enclave, and to check it in
+the verifier, for responses of 1 KB to several MB.  Signing and recovering
+the signature cost the same either way, and are left out.
+
+  enclave  before - serialize query_data to sign it, then return the signed
+                    data for FastAPI to encode (jsonable_encoder and
+                    JSONResponse)
+           after  - serialize query_data to sign it, and build the response
+                    around that text (enclave.query.signed_response)
+  verify   before - parse the response, and serialize query_data again
+                    to check the signature over it
+           after  - split the signed text out of the response, and check it
+                    is in canonical form (split_signed_response and
+                    load_canonical)
+
+Shapes of query_data:
+  text      - one long completion
+  logprobs  - a completion with logprobs: an object per token
+
+Usage:
+  python enclave/benchmarks/bench_response.py --size 100000 --size 1000000
+"""
+
+from typing import Any, Callable
+import json
+import os
+import random
+import timeit
+
+from click import command, option, Choice
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+# enclave.utils requires the provider keys
+for var in ["OPENAI_API_KEY", "ANTHROPIC_API_KEY", "TOGETHER_API_KEY"]:
+    os.environ.setdefault(var, "unused")
+
+# pylint: disable=wrong-import-position
+from enclave.query import load_canonical, serialize, signed_response, split_signed_response
+
+SHAPES = ["text", "logprobs"]
+SIZES = [1000, 100000, 1000000, 4000000]
+WORDS = ["prime", "numbers", "are", "the", "atoms", "of", "arithmetic", "—", "über", "π"]
+SIGNATURE = "0x" + "5a" * 65
+ADDRESS = "0x" + "ad" * 20
+
+
+def query_data(shape: str, size: int) -> dict[str, Any]:
+    """
+    query_data for a completion of about size bytes, serialized.
+    """
+    rng = random.Random(size)
+    tokens: list[str] = []
+    length = 0
+    # A token with logprobs serializes to about 100 bytes
+    while length < size:
+        tokens.append(rng.choice(WORDS) + " ")
+        length += len(tokens[-1]) if shape == "text" else 100
+    choice: dict[str, Any] = {
+        "index": 0,
+        "message": {"role": "assistant", "content": "".join(tokens)},
+        "finish_reason": "stop",
+    }
+    if shape == "logprobs":
+        choice["logprobs"] = {"content": [
+            {"token": token, "logprob": -rng.random(), "bytes": None, "top_logprobs": []}
+            for token in tokens]}
+    return {
+        "request": "Explain the significance of prime numbers in mathematics",
+        "response": {
+            "id": "bench",
+            "object": "chat.completion",
+            "model": "bench",
+            "choices": [choice],
+            "usage": {"prompt_tokens": 10, "completion_tokens": len(tokens)},
+        },
+    }
+
+
+def enclave_before(data: dict[str, Any]) -> bytes:
+    serialize(data)
+    signed = {"query_data": data, "signature": SIGNATURE, "recovered_address": ADDRESS}
+    return bytes(JSONResponse(jsonable_encoder(signed)).body)
+
+
+def enclave_after(data: dict[str, Any]) -> bytes:
+    return signed_response(serialize(data), SIGNATURE, ADDRESS)
+
+
+def verify_before(body: str) -> str:
+    return serialize(json.loads(body)["query_data"])
+
+
+def verify_after(body: str) -> str:
+    parts = split_signed_response(body)
+    assert parts is not None
+    load_canonical(parts[0])
+    return parts[0]
+
+
+def per_call(fn: Callable[[], Any], seconds: float) -> float:
+    """
+    The best of 5 timings of fn, in seconds per call.
+    """
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * seconds / max(elapsed, 1e-9) / 5))
+    return min(timer.repeat(repeat=5, number=number)) / number
+
+
+def bench(data: dict[str, Any], seconds: float) -> dict[str, Any]:
+    body = enclave_after(data).decode()
+    # The response is unchanged, besides the JSON whitespace
+    assert json.loads(body) == json.loads(enclave_before(data))
+    assert verify_after(body) == verify_before(body)
+    return {
+        "bytes": len(body.encode()),
+        "enclave_before_ms": per_call(lambda: enclave_before(data), seconds) * 1000,
+        "enclave_after_ms": per_call(lambda: enclave_after(data), seconds) * 1000,
+        "verify_before_ms": per_call(lambda: verify_before(body), seconds) * 1000,
+        "verify_after_ms": per_call(lambda: verify_after(body), seconds) * 1000,
+    }
+
+
+@command()
+@option("--shape", type = Choice(SHAPES), multiple = True, help = "Default: all")
+@option("--size", "sizes", type = int, multiple = True,
+        help = "Bytes of query_data (default: 1 KB, 100 KB, 1 MB, 4 MB)")
+@option("--seconds", type = float, default = 1.0, help = "Time per measurement")
+@option("--json", "as_json", is_flag = True, help = "Output the results as JSON")
+def main(shape: tuple[str, ...], sizes: tuple[int, ...], seconds: float, as_json: bool) -> None:
+    results = []
+    for name in shape or SHAPES:
+        for size in sizes or SIZES:
+            results.append({"shape": name, **bench(query_data(name, size), seconds)})
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'shape':<10}{'bytes':>10}{'enclave (ms)':>26}{'verify (ms)':>26}")
+    print(f"{'':<20}{'before':>13}{'after':>13}{'before':>13}{'after':>13}")
+    for r in results:
+        print(f"{r['shape']:<10}{r['bytes']:>10}"
+              f"{r['enclave_before_ms']:>13.3f}{r['enclave_after_ms']:>13.3f}"
+              f"{r['verify_before_ms']:>13.3f}{r['verify_after_ms']:>13.3f}")
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
@@ -0,0 +1,74 @@
+"""
+Signatures per second for query_data, signed as before enclave.utils.Signer
+(the hex key passed to w3.eth.account.sign_message, and every signature
+checked by recovering the address), and by Signer with each recovery check
+setting (SIGNATURE_CHECK):
+  baseline   - w3.eth.account.sign_message + recover_message
+  always     - Signer, recovering every signature
+  sampled    - Signer, recovering --sample-rate of the signatures
+  off        - Signer, no recovery
+eth_keys uses coincurve (pip install enclave[signing]) if it is installed, and
+a much slower pure Python implementation otherwise.
+
+Usage:
+  python enclave/benchmarks/bench_signer.py --signatures 2000
+"""
+
+from typing import Callable
+import json
+import os
+import time
+
+from click import command, option, Choice
+from eth_account.messages import encode_defunct
+from eth_keys.backends import get_backend
+
+# enclave.utils requires the provider keys
+for var in ["OPENAI_API_KEY", "ANTHROPIC_API_KEY", "TOGETHER_API_KEY"]:
+    os.environ.setdefault(var, "unused")
+
+# pylint: disable=wrong-import-position
+from web3.auto import w3
+
+from enclave import utils
+
+MODES = ["baseline", *utils.RECOVER_MODES]
+PRIVATE_KEY = "0x" + os.urandom(32).hex()
+QUERY_DATA = json.dumps({
+    "request": "Explain the significance of prime numbers in mathematics",
+    "response": {"choices": [{"message": {"content": "Prime numbers ... " * 50}}]},
+}, sort_keys=True)
+
+
+def baseline_sign(text: str) -> str:
+    message = encode_defunct(text=text)
+    signed_message = w3.eth.account.sign_message(message, PRIVATE_KEY)
+    w3.eth.account.recover_message(message, signature=signed_message.signature)
+    return str(signed_message.signature.hex())
+
+
+def sign_function(mode: str, sample_rate: float) -> Callable[[str], str]:
+    if mode == "baseline":
+        return baseline_sign
+    return utils.Signer(PRIVATE_KEY, mode, sample_rate).sign_text
+
+
+@command()
+@option("--signatures", "-n", type=int, default=2000, help="Signatures per mode")
+@option("--sample-rate", type=float, default=0.01, help="Recovery rate for sampled")
+@option("--mode", "-m", "modes", type=Choice(MODES), multiple=True, help="Modes to run")
+def main(signatures: int, sample_rate: float, modes: tuple[str, ...]) -> None:
+    print(f"eth_keys backend: {type(get_backend()).__name__}")
+    print(f"{'mode':<10} {'signatures/s':>13} {'us/signature':>13}")
+    for mode in modes or MODES:
+        sign = sign_function(mode, sample_rate)
+        sign(QUERY_DATA)
+        start = time.perf_counter()
+        for i in range(signatures):
+            sign(QUERY_DATA + str(i))
+        elapsed = time.perf_counter() - start
+        print(f"{mode:<10} {signatures / elapsed:>13.0f} {elapsed / signatures * 1e6:>13.0f}")
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
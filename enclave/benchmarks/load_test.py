@@ -0,0 +1,267 @@
+"""
+Load test of /enclave/query, end to end on loopback:
+
+  load generator -> forwarder (core.forward.forward_ip_to_ip, as run by
+  host.forward) -> enclave app (uvicorn) -> mock provider (mock_provider.py,
+  in the ollama slot via OLLAMA_BASE_URL)
+
+Each component runs in its own process.  <concurrency> clients send
+<requests> queries in total, each with a distinct prompt (so that no query
+is coalesced or served from the cache).  Reports throughput, and the
+p50/p95/p99 latency of each hop, from the Server-Timing header of the
+enclave's responses:
+  total     - round trip seen by the client
+  forward   - total minus the time in the enclave's handler: the client's
+              HTTP stack and the forwarder (only the client's, with --direct)
+  enclave   - time in the handler, less the provider call and signing
+  sign      - serializing and signing the response
+  provider  - the provider call, as seen by the enclave
+With --stream, the enclave sends no Server-Timing header, so the hops are
+  first_byte - until the first event arrives at the client
+  total      - until the signature event arrives
+
+Usage:
+  python enclave/benchmarks/load_test.py --concurrency 100 --requests 2000 \
+      --latency lognormal:200:0.5 --tokens 256
+"""
+
+from typing import Any, Optional
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from click import command, option, Choice
+import httpx
+
+from core.forward import forward_ip_to_ip
+from core.forward_config import ForwardConfig, ENGINES, ENGINE_THREAD
+from core.loopback import free_port
+
+from mock_provider import Latency, MockProvider
+
+HOPS = ["total", "forward", "enclave", "sign", "provider"]
+STREAM_HOPS = ["first_byte", "total"]
+PERCENTILES = [50, 95, 99]
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_provider(port: int, latency: str, tokens: int, token_interval: str) -> None:
+    provider = MockProvider(
+        tls=False,
+        latency=Latency.parse(latency),
+        tokens=tokens,
+        token_interval=Latency.parse(token_interval),
+        port=port)
+    provider.wait()
+
+
+def run_forwarder(port: int, app_port: int, engine: str) -> None:
+    # Silence the per-connection logging
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+         contextlib.redirect_stdout(devnull):
+        forward_ip_to_ip("127.0.0.1", port, "127.0.0.1", app_port, ForwardConfig(engine=engine))
+
+
+def start_app(port: int, provider_port: int) -> subprocess.Popen[bytes]:
+    env = {
+        **os.environ,
+        "OLLAMA_BASE_URL": f"http://127.0.0.1:{provider_port}/v1",
+        # enclave.utils requires the provider keys
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "unused"),
+        "ANTHROPIC_API_KEY": os.environ.get("ANTHROPIC_API_KEY", "unused"),
+        "TOGETHER_API_KEY": os.environ.get("TOGETHER_API_KEY", "unused"),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "enclave.app:app",
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env)
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    """
+    Durations in seconds from a Server-Timing header value.
+    """
+    timings = {}
+    for metric in header.split(","):
+        name, *params = metric.strip().split(";")
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                timings[name] = float(value) / 1000
+    return timings
+
+
+def hop_timings(elapsed: float, server: dict[str, float]) -> dict[str, float]:
+    handler = server.get("total", 0.0)
+    provider = server.get("provider", 0.0)
+    sign = server.get("sign", 0.0)
+    return {
+        "total": elapsed,
+        "forward": elapsed - handler,
+        "enclave": handler - provider - sign,
+        "sign": sign,
+        "provider": provider,
+    }
+
+
+async def send_query(client: httpx.AsyncClient, i: int, stream: bool) -> dict[str, float]:
+    body = {"provider": "ollama", "model": "mock", "prompt": f"load test {i}", "stream": stream}
+    start = time.perf_counter()
+    if not stream:
+        resp = await client.post("/enclave/query", json=body)
+        elapsed = time.perf_counter() - start
+        resp.raise_for_status()
+        return hop_timings(elapsed, parse_server_timing(resp.headers.get("Server-Timing", "")))
+
+    first_byte: Optional[float] = None
+    async with client.stream("POST", "/enclave/query", json=body) as resp:
+        resp.raise_for_status()
+        async for _ in resp.aiter_bytes():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    return {"first_byte": first_byte or elapsed, "total": elapsed}
+
+
+async def generate_load(
+        port: int,
+        concurrency: int,
+        requests: int,
+        stream: bool) -> tuple[list[dict[str, float]], int, float]:
+    """
+    Send the queries from <concurrency> concurrent clients.  Returns the hop
+    timings of each successful query, the number of failures and the elapsed
+    seconds.
+    """
+    results: list[dict[str, float]] = []
+    errors = 0
+    next_query = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=300) as client:
+
+        async def worker() -> None:
+            nonlocal next_query, errors
+            while next_query < requests:
+                i = next_query
+                next_query += 1
+                try:
+                    results.append(await send_query(client, i, stream))
+                except httpx.HTTPError:
+                    errors += 1
+
+        # Warm up: provider client, signing key and connections
+        await asyncio.gather(*(send_query(client, -1 - i, stream) for i in range(concurrency)))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return results, errors, time.perf_counter() - start
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if len(values) < 2:
+        values = values * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {f"p{p}_ms": cuts[p - 1] * 1000 for p in PERCENTILES}
+
+
+def report(
+        results: list[dict[str, float]],
+        errors: int,
+        elapsed: float,
+        stream: bool) -> dict[str, Any]:
+    hops = STREAM_HOPS if stream else HOPS
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "requests_per_s": len(results) / elapsed,
+        "hops": {hop: percentiles([r[hop] for r in results]) for hop in hops},
+    }
+
+
+@command()
+@option("--concurrency", "-c", type = int, default = 100)
+@option("--requests", "-n", type = int, default = 1000)
+@option("--latency", "-l", default = "lognormal:200:0.5",
+        help = "Provider time to first token (see mock_provider.py)")
+@option("--tokens", "-t", type = int, default = 256, help = "Tokens per completion")
+@option("--token-interval", default = "0", help = "Provider time per further token")
+@option("--stream", is_flag = True, help = "Streaming queries")
+@option("--direct", is_flag = True, help = "Query the enclave app without the forwarder")
+@option("--engine", "-e", type = Choice(ENGINES), default = ENGINE_THREAD,
+        help = "Forwarding engine")
+@option("--json", "as_json", is_flag = True, help = "Output the report as JSON")
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+def main(
+        concurrency: int,
+        requests: int,
+        latency: str,
+        tokens: int,
+        token_interval: str,
+        stream: bool,
+        direct: bool,
+        engine: str,
+        as_json: bool,
+) -> None:
+    Latency.parse(latency)
+    Latency.parse(token_interval)
+
+    ctx = multiprocessing.get_context("fork")
+    provider_port, app_port, forward_port = free_port(), free_port(), free_port()
+    procs = [ctx.Process(
+        target=run_provider,
+        args=[provider_port, latency, tokens, token_interval],
+        daemon=True)]
+    if not direct:
+        procs.append(ctx.Process(
+            target=run_forwarder, args=[forward_port, app_port, engine], daemon=True))
+    for proc in procs:
+        proc.start()
+    app = start_app(app_port, provider_port)
+
+    try:
+        wait_for_port(provider_port)
+        wait_for_port(app_port)
+        port = app_port if direct else forward_port
+        wait_for_port(port)
+        results, errors, elapsed = asyncio.run(
+            generate_load(port, concurrency, requests, stream))
+    finally:
+        app.terminate()
+        app.wait()
+        for proc in procs:
+            proc.kill()
+
+    data = report(results, errors, elapsed, stream)
+    if as_json:
+        print(json.dumps(data, indent=2))
+        return
+
+    path = "direct" if direct else f"forwarder ({engine})"
+    print(f"{data['requests']} queries via {path}, {concurrency} concurrent,"
+          f" {data['errors']} errors: {data['requests_per_s']:.1f} queries/s")
+    print(f"{'hop':<12}" + "".join(f"{f'p{p} (ms)':>12}" for p in PERCENTILES))
+    for hop, values in data["hops"].items():
+        print(f"{hop:<12}" + "".join(f"{values[f'p{p}_ms']:>12.2f}" for p in PERCENTILES))
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
@@ -0,0 +1,311 @@
+"""
+A minimal OpenAI-compatible provider for benchmarks and load tests: answers
+POST /v1/chat/completions over https with a self-signed certificate (or
+plain http), with HTTP/1.1 keep-alive.
+
+The completion has a configurable number of tokens.  Its latency (time to
+the first token) is drawn from a distribution, and each further token takes
+a configurable interval.  With "stream": true in the request, the tokens are
+sent as server-sent events as they are "generated".
+
+Run it standalone, for example in the ollama slot of the enclave
+(OLLAMA_BASE_URL=http://127.0.0.1:11434/v1):
+  python enclave/benchmarks/mock_provider.py --no-tls --port 11434 \
+      --latency lognormal:200:0.5 --tokens 256 --token-interval 5
+"""
+
+from typing import Any, Iterator, Optional, Union
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import datetime
+import ipaddress
+import json
+import math
+import os
+import random
+import ssl
+import tempfile
+import threading
+import time
+
+from click import command, option
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal")
+
+# Completion text is made of these words, one per token
+WORDS = ["Prime", " numbers", " are", " the", " atoms", " of", " arithmetic", "."]
+
+
+@dataclass
+class Latency:
+    """
+    A distribution of delays, in seconds:
+      fixed      - always a
+      uniform    - between a and b
+      normal     - mean a, standard deviation b
+      lognormal  - median a, sigma b (of the underlying normal)
+    Samples are never negative.
+    """
+    distribution: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """
+        Parse "<ms>" or "<distribution>:<ms>[:<ms or sigma>]", for example
+        "50", "uniform:20:80", "normal:50:10" or "lognormal:50:0.5".
+        """
+        parts = spec.split(":")
+        if len(parts) == 1:
+            parts = ["fixed"] + parts
+        distribution, values = parts[0], [float(v) for v in parts[1:]]
+        if distribution not in DISTRIBUTIONS or not 1 <= len(values) <= 2:
+            raise ValueError(f"invalid latency: {spec}")
+        a = values[0] / 1000
+        b = values[1] if len(values) > 1 else 0.0
+        if distribution != "lognormal":
+            b /= 1000
+        return cls(distribution, a, b)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.distribution == "uniform":
+            value = rng.uniform(self.a, self.b)
+        elif self.distribution == "normal":
+            value = rng.gauss(self.a, self.b)
+        elif self.distribution == "lognormal":
+            value = rng.lognormvariate(math.log(self.a), self.b) if self.a > 0 else 0.0
+        else:
+            value = self.a
+        return max(0.0, value)
+
+
+def completion(model: str, tokens: int, prompt_tokens: int) -> dict[str, Any]:
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(token_text(tokens))},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": tokens,
+            "total_tokens": prompt_tokens + tokens,
+        },
+    }
+
+
+def completion_chunk(model: str, delta: dict[str, Any], finish_reason: Optional[str]) -> bytes:
+    chunk = {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n".encode()
+
+
+def token_text(tokens: int) -> Iterator[str]:
+    for i in range(tokens):
+        yield WORDS[i % len(WORDS)]
+
+
+# Kept for existing benchmarks: the default completion
+COMPLETION = completion("mock", len(WORDS), 8)
+
+
+def write_self_signed_cert(directory: str) -> tuple[str, str]:
+    """
+    Write a certificate and key for localhost / 127.0.0.1.  Returns the paths
+    (cert, key).  The certificate is its own CA.
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName("localhost"),
+            x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+        ]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class Server(ThreadingHTTPServer):
+    # Load tests open many connections at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockProvider: # pylint: disable=too-many-instance-attributes
+    """
+    Run the mock provider on a loopback port in a background thread.  Counts
+    TCP connections, requests and resumed TLS sessions.
+
+    latency is the time to the first token: a Latency, or a fixed number of
+    seconds.  token_interval is the time to generate each further token.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-statements
+    def __init__(
+            self,
+            tls: bool = True,
+            latency: Union[float, Latency] = 0.0,
+            tokens: int = len(WORDS),
+            token_interval: Union[float, Latency] = 0.0,
+            port: int = 0,
+            seed: Optional[int] = None,
+    ) -> None:
+        self.latency = latency if isinstance(latency, Latency) else Latency("fixed", latency)
+        self.token_interval = token_interval if isinstance(token_interval, Latency) \
+            else Latency("fixed", token_interval)
+        self.tokens = tokens
+        self.connections = 0
+        self.requests = 0
+        self.resumed = 0
+        self.cert_path: Optional[str] = None
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Send each response in one write, without Nagle delays
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def setup(self) -> None:
+                super().setup()
+                provider.connections += 1
+                if isinstance(self.request, ssl.SSLSocket) and self.request.session_reused:
+                    provider.resumed += 1
+
+            def do_POST(self) -> None:  # pylint: disable=invalid-name
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                provider.requests += 1
+                model = body.get("model", "mock")
+                prompt = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+                time.sleep(provider.sample(provider.latency))
+                if body.get("stream"):
+                    self.stream(model)
+                    return
+                time.sleep(sum(
+                    provider.sample(provider.token_interval)
+                    for _ in range(provider.tokens - 1)))
+                data = json.dumps(completion(model, provider.tokens, len(prompt.split()))).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream(self, model: str) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.write_chunk(completion_chunk(model, {"role": "assistant"}, None))
+                for i, text in enumerate(token_text(provider.tokens)):
+                    if i:
+                        time.sleep(provider.sample(provider.token_interval))
+                    self.write_chunk(completion_chunk(model, {"content": text}, None))
+                self.write_chunk(completion_chunk(model, {}, "stop"))
+                self.write_chunk(b"data: [DONE]\n\n")
+                self.write_chunk(b"")
+
+            def write_chunk(self, data: bytes) -> None:
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.server = Server(("127.0.0.1", port), Handler)
+        scheme = "http"
+        if tls:
+            self.cert_path, key_path = write_self_signed_cert(self._tmp.name)
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(self.cert_path, key_path)
+            self.server.socket = ctx.wrap_socket(self.server.socket, server_side=True)
+            scheme = "https"
+        self.base_url = f"{scheme}://127.0.0.1:{self.server.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def sample(self, latency: Latency) -> float:
+        with self._rng_lock:
+            return latency.sample(self._rng)
+
+    def wait(self) -> None:
+        self._thread.join()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self._tmp.cleanup()
+
+
+@command()
+@option("--port", "-p", type = int, default = 11434)
+@option("--no-tls", is_flag = True, help = "Serve plain http")
+@option("--latency", "-l", default = "0",
+        help = "Time to the first token (ms): <ms> or <distribution>:<ms>[:<param>],"
+        f" with distribution one of {', '.join(DISTRIBUTIONS)}")
+@option("--tokens", "-t", type = int, default = len(WORDS), help = "Tokens per completion")
+@option("--token-interval", default = "0", help = "Time per further token (as --latency)")
+@option("--seed", type = int)
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def main(
+        port: int,
+        no_tls: bool,
+        latency: str,
+        tokens: int,
+        token_interval: str,
+        seed: Optional[int],
+) -> None:
+    """
+    Serve the mock provider until interrupted.
+    """
+    provider = MockProvider(
+        tls=not no_tls,
+        latency=Latency.parse(latency),
+        tokens=tokens,
+        token_interval=Latency.parse(token_interval),
+        port=port,
+        seed=seed)
+    print(f"Mock provider: {provider.base_url}", flush=True)
+    try:
+        provider.wait()
+    except KeyboardInterrupt:
+        provider.close()
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
@@ -8,15 +8,23 @@ if [ -e /dev/nsm ] ; then
     ip addr add 127.0.0.1/32 dev lo
     ip link set dev lo up
 
-    host_to_vsock --port 11434 --vsock-addr 3 --vsock-port 11434 &
-    host_to_vsock --port 443 --vsock-addr 3 --vsock-port 443 &
+    if [ "$TUNNEL" == 1 ] ; then
+        # Connections multiplexed over channels from `forward --tunnel-channels`
+        enclave_tunnel --service 11434 --service 443 &
+    else
+        host_to_vsock --port 11434 --vsock-addr 3 --vsock-port 11434 &
+        host_to_vsock --port 443 --vsock-addr 3 --vsock-port 443 &
+    fi
 
     echo "127.0.0.1	api.openai.com" >> /etc/hosts
     echo "127.0.0.1	api.anthropic.com" >> /etc/hosts
     echo "127.0.0.1	api.together.xyz" >> /etc/hosts
     cat /etc/hosts
 
-    FLAGS="--vsock"
+    # With the tunnel, the app is reached via enclave_tunnel on localhost
+    if [ "$TUNNEL" != 1 ] ; then
+        FLAGS="--vsock"
+    fi
 
 elif [ "$DOCKER" == 1 ] ; then
     echo In Docker
@@ -33,4 +41,4 @@ elif [ "$DOCKER" == 1 ] ; then
 fi
 
 echo APP STARTING ...
-enclave $FLAGS
+enclave $FLAGS --workers ${WORKERS:-1}
@@ -1,15 +1,27 @@
+import asyncio
+import contextlib
 import json
+import math
+import time
 
-from typing import Optional, List, Dict, Any
-from fastapi import FastAPI, HTTPException, Depends, APIRouter
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Any, AsyncIterator
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from web3.auto import w3
-from eth_account import Account
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from eth_account.messages import encode_defunct
+from openai import NOT_GIVEN, AsyncOpenAI
 from pydantic import BaseModel
-from openai import OpenAI
-from core.address import address_to_bytes
-from . import utils
+from . import metrics, utils
+from .attestation import Attestation, get_attestation
+from .cache import ResponseCache, get_response_cache, is_deterministic, request_key
+from .providers import ProviderClients, get_provider_clients
+from .routing import Router, Target, get_router
+from .scheduler import DEFAULT_CALLER, Overloaded, Scheduler, Ticket, get_scheduler
+from .single_flight import SingleFlight, get_single_flight
+from .query import ERROR_EVENT, SIGNATURE_EVENT, BatchData, MerkleTree, QueryData, \
+    SignedBatchItem, StreamQueryData, Transcript, leaf_hash, serialize, signed_response
 
 class LlmRequest(BaseModel):
     model: str
@@ -29,34 +41,68 @@ class LlmRequest(BaseModel):
     keep_alive: Optional[str] = None
     context: Optional[str] = None
 
+    # Serve the response from (and store it in) the enclave's cache.  By
+    # default, only deterministic queries ("temperature": 0 in options) are
+    # cached.
+    cache: Optional[bool] = None
+
+class BatchRequest(BaseModel):
+    model: str
+    provider: str
+    prompts: List[str]
+
+# Upper bound on the prompts in a batch, and on the provider calls in flight
+# for one batch
+MAX_BATCH_SIZE = 10000
+MAX_BATCH_CONCURRENCY = 64
+
 enclave_router = APIRouter(prefix="/enclave")
 
 
 @enclave_router.get("/address")
 async def address(
-        private_key: str = Depends(utils.get_enclave_private_key),
-        nsm: utils.NSM = Depends(utils.get_nsm)
+        nonce: Optional[str] = None,
+        attestation: Attestation = Depends(get_attestation),
 ) -> Any:
     """
     Example usage:
     curl http://localhost:5001/enclave/address
+
+    The attestation document is cached, and refreshed in the background.  A
+    caller supplying ?nonce=<nonce> gets a newly generated document, and the
+    nonce signed by the enclave address.  These requests are rate limited.
     """
-    # pylint: disable=no-value-for-parameter
-    account = Account.from_key(private_key)
-    address_str = account.address
-    address_bytes = address_to_bytes(address_str)
-    attestation_doc = nsm.get_attestation_doc(address_bytes)
+    with metrics.request("address"):
+        return await address_data(nonce, attestation)
 
-    return {
-        "address": address_str,
-        "attestation_doc": attestation_doc,
-    }
+
+async def address_data(nonce: Optional[str], attestation: Attestation) -> Any:
+    if nonce is None:
+        data = attestation.cached()
+        if data is not None:
+            return data
+        # NSM calls block, so keep them off the event loop
+        return await run_in_threadpool(attestation.refresh)
+
+    retry_after = attestation.nonce_limiter.try_acquire()
+    if retry_after is not None:
+        raise HTTPException(
+            status_code = 429,
+            detail = "too many attestation requests",
+            headers = {"Retry-After": str(math.ceil(retry_after))})
+    return await run_in_threadpool(attestation.fresh, nonce)
 
 
 @enclave_router.post("/query")
-async def query(
+async def query( # pylint: disable=too-many-arguments,too-many-positional-arguments
         request_body: LlmRequest,
-        private_key: str = Depends(utils.get_enclave_private_key),
+        request: Request,
+        signer: utils.Signer = Depends(utils.get_signer),
+        clients: ProviderClients = Depends(get_provider_clients),
+        cache: ResponseCache = Depends(get_response_cache),
+        flights: SingleFlight = Depends(get_single_flight),
+        router: Router = Depends(get_router),
+        scheduler: Scheduler = Depends(get_scheduler),
 ) -> Any:
     """
     Example usage:
@@ -69,56 +115,415 @@ async def query(
             "stream": false
             }' \
         http://localhost:5001/enclave/query
+
+    The response body is the signed query_data, signature and recovered
+    address, serialized canonically (enclave.query.serialize) around the
+    exact text that was signed, so that a verifier can check the signature
+    over the body's query_data as it stands
+    (enclave.query.split_signed_response).
+
+    With "stream": true, the response is an event stream relaying the
+    provider's chunks as they arrive, followed by a "signature" event signing
+    the request and a digest of the chunks (see enclave.query.Transcript).
+
+    A response served from the cache (see LlmRequest.cache) is the one
+    signed for the first identical query, and has the header X-Cache: hit.
+    Identical queries that arrive while one is in flight wait for its
+    response, if the query may be served from the cache.
+
+    The Server-Timing header of a non-streaming response gives the time
+    spent in the handler (total), and in the provider call and signing when
+    this query made them.
+
+    A query for a model with a route (see enclave.routing) may be answered
+    by another provider of the model, if the one it names fails or (under
+    the hedge policy) is slow.  The signed query_data of a routed query
+    names the provider that answered.
+
+    Calls to a provider are made within its rate limits (and those of the
+    model), queued in turn across callers (the X-Caller header, or the
+    query's api_key).  A query that would wait too long is rejected with
+    status 429 and a Retry-After header.
+    """
+    with contextlib.ExitStack() as timer:
+        timer.enter_context(metrics.request("query"))
+        return await query_response(
+            request_body, signer, clients, cache, flights, router,
+            Budgets(scheduler, caller_id(request, request_body.api_key)), timer)
+
+
+@dataclass
+class Budgets:
+    """
+    The rate limits that a caller's provider calls are made within.
+    """
+    scheduler: Scheduler
+    caller: str
+
+    async def acquire(self, request_body: LlmRequest) -> Ticket:
+        try:
+            return await self.scheduler.acquire(
+                request_body.provider, request_body.model, request_body.prompt, self.caller)
+        except Overloaded as e:
+            raise HTTPException(
+                status_code = 429,
+                detail = str(e),
+                headers = {"Retry-After": str(math.ceil(e.retry_after))}) from e
+
+
+def caller_id(request: Request, api_key: Optional[str] = None) -> str:
+    """
+    The caller, for fair queuing: the X-Caller header, or the api_key of the
+    query.  Callers naming neither share one turn.
+    """
+    return request.headers.get("X-Caller") or api_key or DEFAULT_CALLER
+
+
+async def query_response( # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+        request_body: LlmRequest,
+        signer: utils.Signer,
+        clients: ProviderClients,
+        cache: ResponseCache,
+        flights: SingleFlight,
+        router: Router,
+        budgets: Budgets,
+        timer: contextlib.ExitStack,
+) -> Response:
+    start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    headers: Dict[str, str] = {}
+    fields = request_body.model_dump()
+    # Whether the response may be shared with identical queries: only that
+    # of a deterministic query, unless the query asks for it ("cache")
+    shared = request_body.cache or request_body.cache is None and is_deterministic(fields)
+    cache_key: Optional[str] = None
+    if cache.enabled and not request_body.stream and shared:
+        cache_key = request_key(fields)
+        signed = cache.get(cache_key)
+        headers["X-Cache"] = "miss" if signed is None else "hit"
+        if signed is not None:
+            timings["total"] = time.perf_counter() - start
+            headers["Server-Timing"] = server_timing(timings)
+            return signed_json_response(signed, headers)
+
+    targets = router.targets(request_body.provider, request_body.model)
+    routed = len(targets) > 1
+
+    async def call(target: Target) -> tuple[LlmRequest, Any, Ticket]:
+        body = request_body.model_copy(update={"provider": target.provider, "model": target.model})
+        ticket = await budgets.acquire(body)
+        try:
+            # Long-lived client, reusing connections to the provider
+            resp = await create_completion(clients.async_client(target.provider), body)
+        except BaseException:
+            # Failed, or cancelled by a winning hedge
+            ticket.cancel()
+            raise
+        if not body.stream:
+            ticket.settle(resp.usage)
+        return body, resp, ticket
+
+    if request_body.stream:
+        # Streams are only failed over: a hedge would only race the
+        # providers to their first chunk, then generate twice
+        _, (body, resp, ticket) = await router.run(targets, call, hedge=False)
+        return StreamingResponse(
+            # Timed until the last event is sent
+            stream_query(body, resp, signer, routed, ticket, timer.pop_all()),
+            media_type="text/event-stream")
+
+    async def complete() -> bytes:
+        provider_start = time.perf_counter()
+        _, (body, resp, _) = await router.run(targets, call)
+        metrics.record_usage(body.provider, body.model, resp.usage)
+        sign_start = time.perf_counter()
+        timings["provider"] = sign_start - provider_start
+        provider = body.provider if routed else None
+        # Serializing and signing are CPU bound, so run them off the event loop
+        signed = await run_in_threadpool(sign_query, body.prompt, resp, signer, provider)
+        timings["sign"] = time.perf_counter() - sign_start
+        return signed
+
+    # Identical queries in flight share one provider call and signature
+    if shared:
+        signed = await flights.run(request_key(fields, flights.config.key_fields), complete)
+    else:
+        signed = await complete()
+    if cache_key is not None:
+        cache.put(cache_key, signed)
+    timings["total"] = time.perf_counter() - start
+    headers["Server-Timing"] = server_timing(timings)
+    return signed_json_response(signed, headers)
+
+
+def signed_json_response(signed: bytes, headers: Dict[str, str]) -> Response:
+    """
+    The serialized signed response, sent as it is (without being encoded
+    again by FastAPI).
     """
+    return Response(signed, media_type="application/json", headers=headers)
 
-    api_key = utils.get_api_key(request_body.provider)
-    base_url = utils.get_base_url(request_body.provider)
-    client = OpenAI(api_key=api_key, base_url=base_url)
 
-    # Send the query to LLM provider
+def server_timing(timings: Dict[str, float]) -> str:
+    """
+    Server-Timing header value for durations in seconds.
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items())
+
+
+async def create_completion(client: AsyncOpenAI, request_body: LlmRequest) -> Any:
+    """
+    Send the query to the LLM provider.
+    """
+    options = request_body.options or {}
     try:
-        resp = client.chat.completions.create(
-            model=request_body.model,
-            messages=[{"role": "user", "content": request_body.prompt}]
-        )
+        with metrics.provider_call(request_body.provider):
+            return await client.chat.completions.create(
+                model=request_body.model,
+                messages=[{"role": "user", "content": request_body.prompt}],
+                stream=bool(request_body.stream),
+                # A stream ends with a chunk reporting the usage, which the
+                # call's rate limits are settled with
+                stream_options={"include_usage": True} if request_body.stream else NOT_GIVEN,
+                temperature=options.get("temperature", NOT_GIVEN),
+            )
     except Exception as e:
         raise HTTPException(
             status_code = 500,
             detail = f"error contacting provider: {e}") from e
 
-    # Get LLM provider's response
+
+@enclave_router.get("/cache")
+async def cache_stats(cache: ResponseCache = Depends(get_response_cache)) -> Any:
+    """
+    Hit and miss counts, and the size, of the cache of signed responses.
+    """
+    return cache.stats_data()
+
+
+@enclave_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_text() -> Any:
+    """
+    Request and stage latencies, requests in flight, provider errors and
+    token counts, in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+async def stream_query( # pylint: disable=too-many-arguments,too-many-positional-arguments
+        request_body: LlmRequest,
+        stream: Any,
+        signer: utils.Signer,
+        routed: bool = False,
+        ticket: Optional[Ticket] = None,
+        timer: Optional[contextlib.ExitStack] = None) -> AsyncIterator[str]:
+    """
+    Relay the chunks of a provider stream as server-sent events, and end with
+    the signed query_data for the stream (naming the provider, if routed).
+    The ticket of the call is settled with the usage the stream reports, and
+    the timer (of the request's metrics) closed once the stream ends.  The
+    provider stream is closed however it ends (say, the client disconnects),
+    releasing its connection.
+    """
     try:
-        llm_response = json.loads(resp.json())
+        transcript = Transcript()
+        try:
+            async with stream:
+                async for chunk in stream:
+                    # Only present (in the last chunk) if the provider was asked for it
+                    metrics.record_usage(request_body.provider, request_body.model, chunk.usage)
+                    if ticket is not None and chunk.usage is not None:
+                        ticket.settle(chunk.usage)
+                    serialized_chunk = serialize(chunk.to_dict())
+                    transcript.update(serialized_chunk)
+                    yield f"data: {serialized_chunk}\n\n"
+        except Exception as e: # pylint: disable=broad-exception-caught
+            metrics.PROVIDER_ERRORS.labels(request_body.provider.lower()).inc()
+            # Too late for an error status, and the transcript is incomplete
+            yield f"event: {ERROR_EVENT}\ndata: {serialize(f'error from provider: {e}')}\n\n"
+            return
+
+        query_data: StreamQueryData = {
+            "request": request_body.prompt,
+            "transcript": transcript.data(),
+        }
+        if routed:
+            query_data["provider"] = request_body.provider
+        signed = await run_in_threadpool(sign_query_data, query_data, signer)
+        yield f"event: {SIGNATURE_EVENT}\ndata: {serialize(signed)}\n\n"
+    finally:
+        if timer is not None:
+            timer.close()
+
+
+@enclave_router.post("/query/batch")
+async def query_batch( # pylint: disable=too-many-arguments,too-many-positional-arguments
+        request_body: BatchRequest,
+        request: Request,
+        signer: utils.Signer = Depends(utils.get_signer),
+        clients: ProviderClients = Depends(get_provider_clients),
+        scheduler: Scheduler = Depends(get_scheduler),
+) -> Any:
+    """
+    Example usage:
+    curl -X POST \
+        -H "Content-Type: application/json" \
+        -d '{
+            "provider": "ollama",
+            "model": "moondream",
+            "prompts": ["What is a prime number?", "What is a Merkle tree?"]
+            }' \
+        http://localhost:5001/enclave/query/batch
+
+    The prompts are queried concurrently, and one signature covers the root
+    of a Merkle tree over the query_data of every successful query.  Each
+    result carries its inclusion proof and the signature, so it can be
+    verified alone (verify_query --batch).  Failed queries have an "error"
+    in place of the query_data (as do queries rejected by the rate limits
+    of the provider).
+    """
+    if not request_body.prompts:
+        raise HTTPException(status_code = 422, detail = "no prompts")
+    if len(request_body.prompts) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code = 413,
+            detail = f"more than {MAX_BATCH_SIZE} prompts")
+
+    client = clients.async_client(request_body.provider)
+    semaphore = asyncio.Semaphore(MAX_BATCH_CONCURRENCY)
+    caller = caller_id(request)
+
+    async def complete(prompt: str) -> Any:
+        async with semaphore:
+            ticket = await scheduler.acquire(
+                request_body.provider, request_body.model, prompt, caller)
+            try:
+                with metrics.provider_call(request_body.provider):
+                    resp = await client.chat.completions.create(
+                        model=request_body.model,
+                        messages=[{"role": "user", "content": prompt}]
+                    )
+            except BaseException:
+                ticket.cancel()
+                raise
+            ticket.settle(resp.usage)
+            metrics.record_usage(request_body.provider, request_body.model, resp.usage)
+            return resp
+
+    with metrics.request("query_batch"):
+        responses = await asyncio.gather(
+            *(complete(prompt) for prompt in request_body.prompts),
+            return_exceptions=True)
+        return await run_in_threadpool(sign_batch, request_body.prompts, responses, signer)
+
+
+def sign_batch(prompts: List[str], responses: List[Any], signer: utils.Signer) -> Any:
+    """
+    Build the query_data for each provider response, and sign the root of the
+    Merkle tree over them.
+    """
+    query_datas: List[QueryData] = []
+    errors = {}
+    for i, (prompt, resp) in enumerate(zip(prompts, responses)):
+        if isinstance(resp, BaseException):
+            errors[i] = {"request": prompt, "error": f"error contacting provider: {resp}"}
+        else:
+            query_datas.append({"request": prompt, "response": response_data(resp)})
+    if not query_datas:
+        raise HTTPException(
+            status_code = 500,
+            detail = f"all queries failed: {errors[0]['error']}")
+
+    tree = MerkleTree([leaf_hash(query_data) for query_data in query_datas])
+    batch: BatchData = {"merkle_root": "0x" + tree.root.hex(), "leaves": len(query_datas)}
+    signed = sign_query_data(batch, signer)
+
+    results: List[Any] = []
+    index = 0
+    for i in range(len(prompts)):
+        if i in errors:
+            results.append(errors[i])
+            continue
+        item: SignedBatchItem = {
+            "query_data": query_datas[index],
+            "index": index,
+            "proof": tree.proof(index),
+            "batch": batch,
+            "signature": signed["signature"],
+            "recovered_address": signed["recovered_address"],
+        }
+        results.append(item)
+        index += 1
+
+    return {**signed, "results": results}
+
+
+def response_data(resp: Any) -> Any:
+    """
+    The provider's response, as JSON data.
+    """
+    try:
+        with metrics.stage("parse").time():
+            return json.loads(resp.json())
     except json.JSONDecodeError as e:
         raise HTTPException(
             status_code = 500,
             detail = f"invalid JSON from LLM: {resp.to_json()}: {e}"
         ) from e
 
+
+def sign_query(
+        prompt: str,
+        resp: Any,
+        signer: utils.Signer,
+        provider: Optional[str] = None) -> bytes:
+    """
+    Build the query_data for a provider response, and sign it.  The provider
+    that answered is included if given.  Returns the serialized signed
+    response (see enclave.query.signed_response).
+    """
+
     # Prepare data to be signed by the enclave
-    query_data = {
-        "request": request_body.prompt,
-        "response": llm_response,
+    query_data: QueryData = {
+        "request": prompt,
+        "response": response_data(resp),
+    }
+    if provider is not None:
+        query_data["provider"] = provider
+    query_data_serialized, signature = sign_serialized(query_data, signer)
+    return signed_response(query_data_serialized, signature, signer.address)
+
+
+def sign_query_data(query_data: Any, signer: utils.Signer) -> Any:
+    """
+    Sign the serialized query_data.
+    """
+    _, signature = sign_serialized(query_data, signer)
+    return {
+        "query_data": query_data,
+        "signature": signature,
+        "recovered_address": signer.address
     }
-    query_data_serialized = json.dumps(query_data, sort_keys=True, ensure_ascii=False)
+
+
+def sign_serialized(query_data: Any, signer: utils.Signer) -> tuple[str, str]:
+    """
+    Serialize query_data, and sign it.  Returns the serialization and the
+    signature.
+    """
+    with metrics.stage("serialize").time():
+        query_data_serialized = serialize(query_data)
 
     # Uses EIP-191 scheme to produce a signable message.
     # This can be more constrained using EIP-712 (structured data signing).
     # We can use EIP-712 once we know the response format.
     message = encode_defunct(text=query_data_serialized)
-    signed_message = w3.eth.account.sign_message(message, private_key)
-
-    # For debugging, make sure we can recover the correct address.
-    recovered_address = w3.eth.account.recover_message(
-        message,
-        signature=signed_message.signature
-    )
 
-    return {
-        "query_data": query_data,
-        "signature": signed_message.signature.hex(),
-        "recovered_address": recovered_address
-    }
+    # The signer checks (some) signatures by recovering the address from
+    # them.  (See utils.Signer.)
+    signature = signer.sign(message)
+    return query_data_serialized, signature
 
 
 app = FastAPI()
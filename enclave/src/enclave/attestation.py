@@ -0,0 +1,145 @@
+from typing import Any, Optional
+from dataclasses import dataclass
+import os
+import threading
+import time
+
+from core.address import address_to_bytes
+from . import metrics, utils
+from .query import nonce_text
+from .rate_limit import TokenBucket
+
+# Seconds before retrying a failed refresh
+RETRY_INTERVAL = 10.0
+
+
+@dataclass
+class AttestationConfig:
+    """
+    Caching of the attestation served by /enclave/address.  Read from the
+    environment (or .env) by from_env().
+    """
+    # Seconds between refreshes of the cached attestation document.  The
+    # certificate in the document expires 3 hours after it is generated.
+    refresh_interval: float = 3600.0
+
+    # A cached document older than this (if the refresh thread has fallen
+    # behind) is not served
+    max_age: float = 7200.0
+
+    # Fresh attestations for callers supplying a nonce: per second, and at
+    # once
+    nonce_rate: float = 1.0
+    nonce_burst: int = 5
+
+    def __post_init__(self) -> None:
+        if not 0 < self.refresh_interval < self.max_age:
+            raise ValueError("refresh_interval must be positive and less than max_age")
+
+    @classmethod
+    def from_env(cls) -> "AttestationConfig":
+        return cls(
+            refresh_interval=float(
+                os.environ.get("ATTESTATION_REFRESH_INTERVAL", cls.refresh_interval)),
+            max_age=float(os.environ.get("ATTESTATION_MAX_AGE", cls.max_age)),
+            nonce_rate=float(os.environ.get("ATTESTATION_NONCE_RATE", cls.nonce_rate)),
+            nonce_burst=int(os.environ.get("ATTESTATION_NONCE_BURST", cls.nonce_burst)),
+        )
+
+
+class Attestation: # pylint: disable=too-many-instance-attributes
+    """
+    The enclave address and an attestation document for it, generated once
+    and refreshed by a background thread, so that requests are served from
+    memory.
+    """
+
+    def __init__(
+            self,
+            nsm: utils.NSM,
+            signer: utils.Signer,
+            config: Optional[AttestationConfig] = None,
+    ) -> None:
+        self.nsm = nsm
+        self.signer = signer
+        self.config = config or AttestationConfig()
+        self.address = signer.address
+        self.nonce_limiter = TokenBucket(self.config.nonce_rate, self.config.nonce_burst)
+        self._lock = threading.Lock()
+        self._cached: Optional[tuple[float, dict[str, Any]]] = None
+        self._stop = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    def cached(self) -> Optional[dict[str, Any]]:
+        """
+        The cached address and attestation document, unless missing or too
+        old.
+        """
+        with self._lock:
+            cached = self._cached
+        if cached is None or time.monotonic() - cached[0] > self.config.max_age:
+            return None
+        return cached[1]
+
+    def refresh(self) -> dict[str, Any]:
+        """
+        Generate a new attestation document (blocking on the NSM), and cache
+        it.
+        """
+        generated_at = time.monotonic()
+        with metrics.stage("attestation").time():
+            attestation_doc = self.nsm.get_attestation_doc(address_to_bytes(self.address))
+        data = {"address": self.address, "attestation_doc": attestation_doc}
+        with self._lock:
+            if self._cached is None or self._cached[0] < generated_at:
+                self._cached = (generated_at, data)
+        return data
+
+    def fresh(self, nonce: str) -> dict[str, Any]:
+        """
+        A new attestation document, with the nonce signed by the attested
+        address.  The NSM library takes no nonce, so the signature is what
+        shows the document was requested after the nonce was chosen.  What
+        is signed is nonce_text(nonce), not the nonce itself, as the caller
+        must not be able to have any text signed (a query response, say).
+        """
+        return {
+            **self.refresh(),
+            "nonce": nonce,
+            "nonce_signature": self.signer.sign_text(nonce_text(nonce)),
+        }
+
+    def start(self) -> None:
+        """
+        Start the thread that refreshes the cached document.
+        """
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name="attestation", daemon=True)
+                self._refresher.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.is_set():
+            interval = self.config.refresh_interval
+            try:
+                self.refresh()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                print(f"!! refreshing attestation: {e}")
+                interval = min(interval, RETRY_INTERVAL)
+            self._stop.wait(interval)
+
+
+attestation: Optional[Attestation] = None
+
+def get_attestation() -> Attestation:
+    global attestation
+    with utils.init_lock:
+        if attestation is None:
+            attestation = Attestation(
+                utils.get_nsm(), utils.get_signer(), AttestationConfig.from_env())
+            attestation.start()
+        return attestation
@@ -0,0 +1,128 @@
+from typing import Any, Iterable, Mapping, Optional
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+import hashlib
+import os
+import threading
+import time
+
+from .query import serialize
+
+# LlmRequest fields that make up the cache key.  Fields that do not change
+# the response (api_key, stream, keep_alive, cache) are left out.
+KEY_FIELDS = (
+    "provider", "model", "prompt", "suffix", "images", "format", "options", "system",
+    "template", "raw", "context",
+)
+
+
+def request_key(fields: Mapping[str, Any], key_fields: Iterable[str] = KEY_FIELDS) -> str:
+    """
+    Hash of the canonical serialization of the key_fields of a request.
+    """
+    data = {name: fields.get(name) for name in key_fields}
+    if "provider" in data:
+        data["provider"] = str(data["provider"]).lower()
+    return hashlib.sha256(serialize(data).encode()).hexdigest()
+
+
+def is_deterministic(fields: Mapping[str, Any]) -> bool:
+    options = fields.get("options") or {}
+    return bool(options.get("temperature") == 0)
+
+
+@dataclass
+class ResponseCacheConfig:
+    """
+    Bounds on the cache of signed responses.  Read from the environment (or
+    .env) by from_env().
+    """
+    # Upper bound on the size of the cached responses, serialized (0 to
+    # disable the cache)
+    max_bytes: int = 64 * 1024 * 1024
+
+    # Seconds a response is served from the cache
+    ttl: float = 3600.0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCacheConfig":
+        return cls(
+            max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", cls.max_bytes)),
+            ttl=float(os.environ.get("RESPONSE_CACHE_TTL", cls.ttl)),
+        )
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Entries dropped to stay within max_bytes, or because they expired
+    evictions: int = 0
+
+
+class ResponseCache:
+    """
+    LRU cache of signed query responses, by request_key.  Entries expire
+    after config.ttl seconds, and the least recently used are evicted to keep
+    the total size within config.max_bytes.
+    """
+
+    def __init__(self, config: Optional[ResponseCacheConfig] = None) -> None:
+        self.config = config or ResponseCacheConfig()
+        self.stats = CacheStats()
+        # key -> (expiry time, size, signed response)
+        self._entries: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.max_bytes > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                self.stats.evictions += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[2]
+
+    def put(self, key: str, signed: Any) -> None:
+        """
+        Cache a signed response: serialized (bytes), or as data.
+        """
+        size = len(signed) if isinstance(signed, bytes) else len(serialize(signed))
+        if size > self.config.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.config.ttl, size, signed)
+            self._bytes += size
+            while self._bytes > self.config.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def stats_data(self) -> dict[str, int]:
+        with self._lock:
+            return {**asdict(self.stats), "entries": len(self._entries), "bytes": self._bytes}
+
+    def _remove(self, key: str) -> None:
+        self._bytes -= self._entries.pop(key)[1]
+
+
+response_cache: Optional[ResponseCache] = None
+response_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache(ResponseCacheConfig.from_env())
+        return response_cache
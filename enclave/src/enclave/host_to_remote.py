@@ -1,6 +1,8 @@
-from click import command, option
+from click import command, option, Choice
 
 from core.forward import forward_ip_to_ip
+from core.forward_config import ForwardConfig, ENGINES, ENGINE_THREAD
+from core.relay import RELAYS, RELAY_COPY
 from core.defaults import DEFAULT_REMOTE_HOST
 
 
@@ -9,13 +11,19 @@ from core.defaults import DEFAULT_REMOTE_HOST
 @option("--port", "-p", type = int, default = 11434)
 @option("--dest-addr", "-v", default = DEFAULT_REMOTE_HOST)
 @option("--dest-port", "-v", type = int, default = 11434)
+@option("--engine", type = Choice(ENGINES), default = ENGINE_THREAD)
+@option("--relay", type = Choice(RELAYS), default = RELAY_COPY)
+# pylint: disable=too-many-arguments,too-many-positional-arguments
 def main(
         listen_host: str,
         port: int,
         dest_addr: str,
         dest_port: int,
+        engine: str,
+        relay: str,
 ) -> None:
     """
     Bind to 0.0.0.0:<port> and forward to ip <dest_addr>:<dest_port>
     """
-    forward_ip_to_ip(listen_host, port, dest_addr, dest_port)
+    config = ForwardConfig(engine=engine, relay=relay)
+    forward_ip_to_ip(listen_host, port, dest_addr, dest_port, config)
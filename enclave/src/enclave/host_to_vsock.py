@@ -1,7 +1,9 @@
 from typing import Optional
-from click import command, option
+from click import command, option, Choice
 
 from core.forward import forward_ip_to_vsock
+from core.forward_config import ForwardConfig, ENGINES, ENGINE_THREAD
+from core.relay import RELAYS, RELAY_COPY
 from core.defaults import DEFAULT_APP_SERVER_PORT
 
 
@@ -9,12 +11,17 @@ from core.defaults import DEFAULT_APP_SERVER_PORT
 @option("--port", "-p", type = int, default = DEFAULT_APP_SERVER_PORT)
 @option("--vsock-addr", "-v", type = int)
 @option("--vsock-port", "-v", type = int, default = DEFAULT_APP_SERVER_PORT)
+@option("--engine", type = Choice(ENGINES), default = ENGINE_THREAD)
+@option("--relay", type = Choice(RELAYS), default = RELAY_COPY)
 def main(
         port: int,
         vsock_addr: Optional[int],
         vsock_port: int,
+        engine: str,
+        relay: str,
 ) -> None:
     """
     Bind to 0.0.0.0:<port> and forward to enclave vsock port <vsock_port>
     """
-    forward_ip_to_vsock(port, vsock_port, vsock_addr)
+    config = ForwardConfig(engine=engine, relay=relay)
+    forward_ip_to_vsock(port, vsock_port, vsock_addr, config)
@@ -1,25 +1,62 @@
+import os
 import socket
 
 import uvicorn
 from click import command, option
 
 from core.defaults import DEFAULT_APP_SERVER_PORT
+from core.prefork import run_workers
+
+from . import utils
 
 APP = f"{__package__}.app:app"
 
-@command()
-@option("--vsock", "-v", is_flag=True, help="Bind to vsock")
-@option("--port", "-p", type=int, help="Local port to bind to", default=DEFAULT_APP_SERVER_PORT)
-def main(vsock: bool, port: int) -> None:
-    # Bind to vsock or regular socket
+
+def listen_socket(vsock: bool, port: int) -> socket.socket:
     if vsock:
-        print("VSOCK mode")
         # pylint: disable=no-member
         s = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)  # type: ignore
         s.bind((socket.VMADDR_CID_ANY, port))  # type: ignore
-        s.listen()
-        fd = s.fileno()
-        uvicorn.run(APP, fd=fd)
     else:
-        print("IP mode")
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", port))
+    s.listen(socket.SOMAXCONN)
+    return s
+
+
+@command()
+@option("--vsock", "-v", is_flag=True, help="Bind to vsock")
+@option("--port", "-p", type=int, help="Local port to bind to", default=DEFAULT_APP_SERVER_PORT)
+@option(
+    "--workers", "-w",
+    type=int,
+    default=1,
+    help="Server processes, accepting from one listener (0: one per CPU)")
+def main(vsock: bool, port: int, workers: int) -> None:
+    """
+    Run the enclave server.
+
+    With several workers, the signing key is generated (from NSM randomness)
+    before the workers are forked, so that every worker signs with the one
+    attested address.  Workers that exit are restarted, with the same key.
+    The rate limits of the providers are divided between the workers; the
+    response cache, coalescing, metrics and fair queuing are per worker.
+    """
+    workers = workers or os.cpu_count() or 1
+    # Each worker takes its share of the providers' rate limits
+    # (see enclave.scheduler)
+    os.environ["ENCLAVE_WORKERS"] = str(workers)
+
+    # Bind to vsock or regular socket
+    print("VSOCK mode" if vsock else "IP mode")
+    if workers == 1 and not vsock:
         uvicorn.run(APP, host="0.0.0.0", port=port)
+        return
+
+    s = listen_socket(vsock, port)
+    if workers > 1:
+        utils.get_enclave_private_key()
+        print(f"{workers} workers")
+    fd = s.fileno()
+    run_workers(workers, lambda: uvicorn.run(APP, fd=fd))
@@ -0,0 +1,305 @@
+from typing import Any, Generic, Iterator, Optional, Sequence, TypeVar
+from bisect import bisect_left
+import contextlib
+import threading
+import time
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.  The
+# stages range from tens of microseconds (serializing a small response) to
+# tens of seconds (a slow provider).
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class CounterValue: # pylint: disable=too-few-public-methods
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class GaugeValue(CounterValue):
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[None]:
+        """
+        Count the block as in progress while it runs.
+        """
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class HistogramValue:
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        # Observations in each bucket (not cumulative), and above the last
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Observe the seconds taken by the block (also if it raises).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> tuple[list[int], float]:
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+V = TypeVar("V", CounterValue, GaugeValue, HistogramValue)
+
+
+class Metric(Generic[V]):
+    """
+    A metric, with a value for each combination of label values.
+    """
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], V] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> V:
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                value = self._values.setdefault(values, self._new_value())
+        return value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _new_value(self) -> V:
+        raise NotImplementedError
+
+    def _render_value(self, label_values: tuple[str, ...], value: V) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric[CounterValue]):
+    kind = "counter"
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def _render_value(self, label_values: tuple[str, ...], value: CounterValue) -> list[str]:
+        labels = _format_labels(self.labelnames, label_values)
+        return [f"{self.name}{labels} {_format_value(value.value)}"]
+
+
+class Gauge(Metric[GaugeValue]):
+    kind = "gauge"
+
+    def _new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def _render_value(self, label_values: tuple[str, ...], value: GaugeValue) -> list[str]:
+        labels = _format_labels(self.labelnames, label_values)
+        return [f"{self.name}{labels} {_format_value(value.value)}"]
+
+
+class Histogram(Metric[HistogramValue]):
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def _render_value(self, label_values: tuple[str, ...], value: HistogramValue) -> list[str]:
+        counts, total = value.snapshot()
+        names = self.labelnames + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(names, label_values + (_format_value(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+M = TypeVar("M", bound=Metric[Any])
+
+
+class Registry:
+    """
+    The metrics served by /enclave/metrics, in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: list[Metric[Any]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "".join(line + "\n" for metric in self.metrics for line in metric.render())
+
+    def _add(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "enclave_request_seconds",
+    "Time to handle a request (for streams, until the last event)",
+    ["endpoint"])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "enclave_requests_in_flight", "Requests being handled", ["endpoint"])
+
+# Stages of a request:
+#   queue        - waiting for the rate limits of the provider
+#   provider     - the call to the provider
+#   parse        - parsing the provider's response into JSON data
+#   serialize    - canonical serialization of the signed data
+#   sign         - EIP-191 signing
+#   recover      - recovering the signer from a signature, to check it
+#   attestation  - generating an attestation document (NSM)
+STAGE_SECONDS = REGISTRY.histogram(
+    "enclave_stage_seconds", "Time spent in each stage of a request", ["stage"])
+
+PROVIDER_REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "enclave_provider_requests_in_flight", "Calls to the provider in flight", ["provider"])
+PROVIDER_ERRORS = REGISTRY.counter(
+    "enclave_provider_errors_total", "Failed calls to the provider", ["provider"])
+PROVIDER_LATENCY_P95 = REGISTRY.gauge(
+    "enclave_provider_latency_p95_seconds",
+    "Tracked p95 latency of calls to the provider, for hedging (see enclave.routing)",
+    ["provider"])
+PROVIDER_HEDGES = REGISTRY.counter(
+    "enclave_provider_hedges_total", "Hedge calls sent to the provider", ["provider"])
+PROVIDER_FAILOVERS = REGISTRY.counter(
+    "enclave_provider_failovers_total",
+    "Failed calls to the provider retried with another provider",
+    ["provider"])
+RATE_LIMIT_WAITING = REGISTRY.gauge(
+    "enclave_rate_limit_waiting",
+    "Calls waiting for a rate limit budget (see enclave.scheduler)",
+    ["budget"])
+RATE_LIMITED = REGISTRY.counter(
+    "enclave_rate_limited_total", "Calls rejected by a rate limit budget", ["budget"])
+TOKENS = REGISTRY.counter(
+    "enclave_tokens_total",
+    "Tokens used, as reported by the provider (type: prompt or completion)",
+    ["provider", "model", "type"])
+
+
+@contextlib.contextmanager
+def request(endpoint: str) -> Iterator[None]:
+    """
+    Count the request as in flight, and time it.
+    """
+    with REQUESTS_IN_FLIGHT.labels(endpoint).track(), REQUEST_SECONDS.labels(endpoint).time():
+        yield
+
+
+def stage(name: str) -> HistogramValue:
+    return STAGE_SECONDS.labels(name)
+
+
+@contextlib.contextmanager
+def provider_call(provider: str) -> Iterator[None]:
+    """
+    Count the call as in flight, time it, and count it as an error if it
+    raises.
+    """
+    provider = provider.lower()
+    with PROVIDER_REQUESTS_IN_FLIGHT.labels(provider).track(), stage("provider").time():
+        try:
+            yield
+        except Exception:
+            PROVIDER_ERRORS.labels(provider).inc()
+            raise
+
+
+def record_usage(provider: str, model: str, usage: Optional[Any]) -> None:
+    """
+    Count the tokens of the usage field of a provider response (if present).
+    """
+    if usage is None:
+        return
+    provider = provider.lower()
+    TOKENS.labels(provider, model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    TOKENS.labels(provider, model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
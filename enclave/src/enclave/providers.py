@@ -0,0 +1,260 @@
+from typing import Any, Callable, Mapping, Optional, Union
+from dataclasses import dataclass
+import os
+import socket
+import ssl
+import threading
+import weakref
+
+import certifi
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI, DefaultHttpxClient
+
+from . import utils
+
+try:
+    import h2  # type: ignore # pylint: disable=unused-import
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
+
+def _env_int(var: str, default: int) -> int:
+    return int(os.environ.get(var, default))
+
+
+@dataclass
+class ProviderClientConfig:
+    """
+    Connection settings for the clients of every provider.  Read from the
+    environment (or .env) by from_env().
+    """
+    # Connections per provider, in use or idle.  With HTTP/1.1 this bounds
+    # the queries in flight to each provider.
+    max_connections: int = 1000
+
+    # Idle connections kept open per provider
+    max_keepalive_connections: int = 100
+
+    # Seconds an idle connection is kept open
+    keepalive_expiry: float = 60.0
+
+    # Negotiate HTTP/2 with providers that support it (requires the h2
+    # package: pip install enclave[http2], as in the enclave image)
+    http2: bool = True
+
+    @classmethod
+    def from_env(cls) -> "ProviderClientConfig":
+        return cls(
+            max_connections=_env_int("PROVIDER_MAX_CONNECTIONS", cls.max_connections),
+            max_keepalive_connections=_env_int(
+                "PROVIDER_MAX_KEEPALIVE_CONNECTIONS", cls.max_keepalive_connections),
+            keepalive_expiry=float(
+                os.environ.get("PROVIDER_KEEPALIVE_EXPIRY", cls.keepalive_expiry)),
+            http2=os.environ.get("PROVIDER_HTTP2", "1") != "0",
+        )
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+class SessionSavingSocket(ssl.SSLSocket): # pylint: disable=abstract-method
+    """
+    SSLSocket that hands its TLS session back to its ResumingSSLContext when
+    closed.
+    """
+
+    def close(self) -> None:
+        if isinstance(self.context, ResumingSSLContext) and not self._closed: # type: ignore
+            self.context.save_session(self.server_hostname, self.session)
+        super().close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Client SSLContext that resumes TLS sessions.  Python only resumes a
+    session when it is passed to wrap_socket / wrap_bio, which httpx never
+    does, so keep a session for each server and offer it to the next
+    connection.  Sessions are taken from connections as they close
+    (SSLSocket) or, for SSLObjects (which have no close), from any
+    connection still open to the server once a new one is made.
+    """
+
+    sslsocket_class = SessionSavingSocket
+
+    def __new__(cls) -> "ResumingSSLContext": # pylint: disable=signature-differs
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        self._sessions: dict[str, ssl.SSLSession] = {}
+        # Open SSLObjects by server, from wrap_bio
+        self._open: dict[str, weakref.WeakSet[ssl.SSLObject]] = {}
+
+    def save_session(
+            self,
+            server_hostname: Union[str, bytes, None],
+            session: Optional[ssl.SSLSession]) -> None:
+        # TLS 1.3 tickets arrive after the handshake, so only a session that
+        # has been used has a ticket to resume with.
+        if server_hostname is not None and session is not None and session.has_ticket:
+            with self._lock:
+                self._sessions[str(server_hostname)] = session
+
+    def session_for(
+            self,
+            server_hostname: Union[str, bytes, None]) -> Optional[ssl.SSLSession]:
+        if server_hostname is None:
+            return None
+        server_hostname = str(server_hostname)
+        with self._lock:
+            open_conns = list(self._open.get(server_hostname, ()))
+        # A connection still handshaking has no ticket yet, and is skipped
+        for conn in open_conns:
+            self.save_session(server_hostname, conn.session)
+        with self._lock:
+            return self._sessions.get(server_hostname)
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def wrap_socket(
+            self,
+            sock: socket.socket,
+            server_side: bool = False,
+            do_handshake_on_connect: bool = True,
+            suppress_ragged_eofs: bool = True,
+            server_hostname: Union[str, bytes, None] = None,
+            session: Optional[ssl.SSLSession] = None,
+    ) -> ssl.SSLSocket:
+        conn = super().wrap_socket(
+            sock,
+            server_side,
+            do_handshake_on_connect,
+            suppress_ragged_eofs,
+            server_hostname,
+            session or self.session_for(server_hostname))
+        assert isinstance(conn, ssl.SSLSocket)
+        return conn
+
+    def wrap_bio(
+            self,
+            incoming: ssl.MemoryBIO,
+            outgoing: ssl.MemoryBIO,
+            server_side: bool = False,
+            server_hostname: Union[str, bytes, None] = None,
+            session: Optional[ssl.SSLSession] = None,
+    ) -> ssl.SSLObject:
+        conn = super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side,
+            server_hostname,
+            session or self.session_for(server_hostname))
+        if server_hostname is not None:
+            with self._lock:
+                self._open.setdefault(str(server_hostname), weakref.WeakSet()).add(conn)
+        return conn
+
+
+def create_ssl_context() -> ResumingSSLContext:
+    """
+    A ResumingSSLContext trusting the same CAs as httpx's default context.
+    """
+    ctx = ResumingSSLContext()
+    if os.environ.get("SSL_CERT_FILE"):
+        ctx.load_verify_locations(cafile=os.environ["SSL_CERT_FILE"])
+    elif os.environ.get("SSL_CERT_DIR"):
+        ctx.load_verify_locations(capath=os.environ["SSL_CERT_DIR"])
+    else:
+        ctx.load_verify_locations(cafile=certifi.where())
+    return ctx
+
+
+class ProviderClients:
+    """
+    One long-lived OpenAI client (and AsyncOpenAI client) per provider,
+    created on first use.  The clients keep connections to their provider
+    alive between queries, and share one SSLContext so that new connections
+    can resume a TLS session.
+    """
+
+    def __init__(
+            self,
+            config: Optional[ProviderClientConfig] = None,
+            api_keys: Optional[Mapping[str, str]] = None,
+            get_base_url: Callable[[str], str] = utils.get_base_url,
+    ) -> None:
+        self.config = config or ProviderClientConfig()
+        self.api_keys = api_keys if api_keys is not None else utils.API_KEYS
+        self.get_base_url = get_base_url
+        self.ssl_context = create_ssl_context()
+        self._clients: dict[str, OpenAI] = {}
+        self._async_clients: dict[str, AsyncOpenAI] = {}
+        self._lock = threading.Lock()
+
+    def client(self, provider: str) -> OpenAI:
+        provider = provider.lower()
+        with self._lock:
+            client = self._clients.get(provider)
+            if client is None:
+                client = self._clients[provider] = OpenAI(
+                    http_client=DefaultHttpxClient(**self._http_options()),
+                    **self._client_options(provider))
+            return client
+
+    def async_client(self, provider: str) -> AsyncOpenAI:
+        """
+        As client(), for use from the event loop.
+        """
+        provider = provider.lower()
+        with self._lock:
+            client = self._async_clients.get(provider)
+            if client is None:
+                client = self._async_clients[provider] = AsyncOpenAI(
+                    http_client=DefaultAsyncHttpxClient(**self._http_options()),
+                    **self._client_options(provider))
+            return client
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients = list(self._async_clients.values())
+            self._async_clients.clear()
+        for client in clients:
+            await client.close()
+
+    def _client_options(self, provider: str) -> dict[str, Any]:
+        if provider not in self.api_keys:
+            raise ValueError(f"No API key for provider: {provider}")
+        return {
+            "api_key": self.api_keys[provider],
+            "base_url": self.get_base_url(provider),
+        }
+
+    def _http_options(self) -> dict[str, Any]:
+        return {
+            "http2": self.config.http2 and HAS_HTTP2,
+            "limits": self.config.limits(),
+            "verify": self.ssl_context,
+        }
+
+
+provider_clients: Optional[ProviderClients] = None
+provider_clients_lock = threading.Lock()
+
+def get_provider_clients() -> ProviderClients:
+    global provider_clients
+    # FastAPI runs sync dependencies on a thread pool
+    with provider_clients_lock:
+        if provider_clients is None:
+            provider_clients = ProviderClients(ProviderClientConfig.from_env())
+        return provider_clients
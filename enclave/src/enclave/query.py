@@ -1,12 +1,215 @@
-from typing import Any, TypedDict
+from typing import Any, NotRequired, Optional, TypedDict
+import hashlib
+import json
 
 
 class QueryData(TypedDict):
     request: Any
     response: Any
+    # The provider that answered, for a query routed to one of several
+    # providers (see enclave.routing)
+    provider: NotRequired[str]
 
 
 class SignedQueryData(TypedDict):
     query_data: QueryData
     signature: str
     recovered_address: str
+
+
+class TranscriptData(TypedDict):
+    # 0x-prefixed SHA-256 over the serialized chunks, each followed by "\n"
+    digest: str
+    chunks: int
+
+
+class StreamQueryData(TypedDict):
+    request: Any
+    transcript: TranscriptData
+    provider: NotRequired[str]
+
+
+class SignedStreamQueryData(TypedDict):
+    query_data: StreamQueryData
+    signature: str
+    recovered_address: str
+
+
+# Event type of the final, signed event of a streaming query
+SIGNATURE_EVENT = "signature"
+# Event type sent in place of the signature if the provider fails
+ERROR_EVENT = "error"
+
+
+def serialize(data: Any) -> str:
+    """
+    The canonical serialization of data, as signed by the enclave.  Contains
+    no newlines.
+    """
+    return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+
+def _canonical_object(pairs: list[tuple[str, Any]]) -> dict[str, Any]:
+    for (key, _), (next_key, _) in zip(pairs, pairs[1:]):
+        if not key < next_key:
+            raise ValueError(f"Not in canonical form: key {next_key!r} after {key!r}")
+    return dict(pairs)
+
+
+def load_canonical(text: str) -> Any:
+    """
+    Parse serialized data, checking that the keys of every object are unique
+    and sorted, as serialize() writes them.  Data read this way from signed
+    text is the data that was signed, without serializing it again.
+    """
+    return json.loads(text, object_pairs_hook=_canonical_object)
+
+
+# A signed response, serialized, starts with its query_data (the keys are
+# sorted), followed by these keys
+SIGNED_PREFIX = '{"query_data": '
+SIGNED_SUFFIX_KEY = ', "recovered_address": '
+
+# The key of the data signed for a caller's attestation nonce.  No query
+# data has it, so that a nonce signature is never taken for a signed query.
+ATTESTATION_NONCE_KEY = "attestation_nonce"
+
+
+def nonce_text(nonce: str) -> str:
+    """
+    The text signed for an attestation nonce.
+    """
+    return serialize({ATTESTATION_NONCE_KEY: nonce})
+
+
+def is_attestation_nonce(signed_data: Any) -> bool:
+    """
+    Whether signed data is an attestation nonce rather than query data.
+    """
+    return isinstance(signed_data, dict) and ATTESTATION_NONCE_KEY in signed_data
+
+
+def signed_response(query_data_serialized: str, signature: str, address: str) -> bytes:
+    """
+    serialize() of the signed response (a SignedQueryData) for query_data,
+    built around its serialization as signed rather than encoding it again.
+    """
+    return "".join([
+        SIGNED_PREFIX,
+        query_data_serialized,
+        SIGNED_SUFFIX_KEY,
+        serialize(address),
+        ', "signature": ',
+        serialize(signature),
+        "}",
+    ]).encode()
+
+
+def split_signed_response(text: str) -> Optional[tuple[str, str, str]]:
+    """
+    The serialized query_data (as signed), recovered_address and signature
+    of a signed response as sent by the enclave (see signed_response).  None
+    if text is not in that form.
+    """
+    text = text.strip()
+    end = text.rfind(SIGNED_SUFFIX_KEY)
+    if not text.startswith(SIGNED_PREFIX) or end < 0:
+        return None
+    try:
+        rest = json.loads("{" + text[end + 2:])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(rest, dict) or sorted(rest) != ["recovered_address", "signature"]:
+        return None
+    return text[len(SIGNED_PREFIX):end], rest["recovered_address"], rest["signature"]
+
+
+class Transcript:
+    """
+    Running hash over the serialized chunks of a streaming response.
+    """
+
+    def __init__(self) -> None:
+        self._hash = hashlib.sha256()
+        self.chunks = 0
+
+    def update(self, serialized_chunk: str) -> None:
+        self._hash.update(serialized_chunk.encode())
+        self._hash.update(b"\n")
+        self.chunks += 1
+
+    def data(self) -> TranscriptData:
+        return {"digest": "0x" + self._hash.hexdigest(), "chunks": self.chunks}
+
+
+class ProofStep(TypedDict):
+    # 0x-prefixed hash of the sibling node, and whether it is the left child
+    sibling: str
+    left: bool
+
+
+class BatchData(TypedDict):
+    # 0x-prefixed root of the Merkle tree over the query_data of the batch
+    merkle_root: str
+    leaves: int
+
+
+class SignedBatchItem(TypedDict):
+    query_data: QueryData
+    index: int
+    proof: list[ProofStep]
+    batch: BatchData
+    signature: str
+    recovered_address: str
+
+
+def leaf_hash(query_data: Any) -> bytes:
+    # Leaves and nodes are hashed with distinct prefixes, so that a node
+    # cannot be passed off as a leaf.
+    return hashlib.sha256(b"\x00" + serialize(query_data).encode()).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+class MerkleTree:
+    """
+    Merkle tree over leaf hashes.  A node without a sibling is promoted to
+    the next level unchanged.
+    """
+
+    def __init__(self, leaves: list[bytes]) -> None:
+        if not leaves:
+            raise ValueError("no leaves")
+        self.levels = [leaves]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                parents.append(level[-1])
+            self.levels.append(parents)
+
+    @property
+    def root(self) -> bytes:
+        return self.levels[-1][0]
+
+    def proof(self, index: int) -> list[ProofStep]:
+        """
+        The siblings on the path from leaf index to the root.
+        """
+        proof: list[ProofStep] = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                proof.append({"sibling": "0x" + level[sibling].hex(), "left": sibling < index})
+            index //= 2
+        return proof
+
+
+def root_from_proof(leaf: bytes, proof: list[ProofStep]) -> bytes:
+    node = leaf
+    for step in proof:
+        sibling = bytes.fromhex(step["sibling"].removeprefix("0x"))
+        node = node_hash(sibling, node) if step["left"] else node_hash(node, sibling)
+    return node
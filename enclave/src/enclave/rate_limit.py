@@ -0,0 +1,47 @@
+from typing import Optional
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Allows rate events per second on average, and up to burst at once.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, amount: float = 1.0) -> Optional[float]:
+        """
+        Take amount tokens.  If there are not enough, returns the seconds
+        until there will be.  An amount over burst is taken once the bucket
+        is full, putting it into debt.
+        """
+        needed = min(amount, self.burst)
+        with self._lock:
+            self._refill()
+            if self._tokens >= needed:
+                self._tokens -= amount
+                return None
+            return (needed - self._tokens) / self.rate
+
+    def add(self, amount: float) -> None:
+        """
+        Return tokens taken but not used, or (with a negative amount) take
+        more than were acquired.  The bucket may go into debt, which delays
+        later acquisitions.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.burst, self._tokens + amount)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
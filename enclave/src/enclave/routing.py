@@ -0,0 +1,239 @@
+from typing import Awaitable, Callable, Optional, TypeVar
+from collections import deque
+from dataclasses import dataclass, field
+import asyncio
+import os
+import threading
+import time
+
+from . import metrics
+
+# How a query for a routed model is sent to its providers
+#   off       - only to the provider named in the query
+#   failover  - to the next provider of the route if one fails
+#   hedge     - as failover, and also to the next provider if one takes
+#               longer than its p95 latency; the first answer wins
+ROUTING_OFF = "off"
+ROUTING_FAILOVER = "failover"
+ROUTING_HEDGE = "hedge"
+ROUTING_POLICIES = [ROUTING_OFF, ROUTING_FAILOVER, ROUTING_HEDGE]
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Target:
+    """
+    A provider, and the name of the model at that provider.
+    """
+    provider: str
+    model: str
+
+
+def parse_target(spec: str, model: str) -> Target:
+    """
+    Parse "<provider>" or "<provider>/<model>" (the model may contain "/").
+    """
+    provider, _, target_model = spec.strip().partition("/")
+    if not provider:
+        raise ValueError(f"Invalid route target: {spec}")
+    return Target(provider.lower(), target_model or model)
+
+
+def parse_routes(value: str) -> dict[str, tuple[Target, ...]]:
+    """
+    Parse "<model>=<target>,<target>;<model>=...", for example
+    "llama3=together/meta-llama/Llama-3-8b-chat-hf,ollama/llama3:8b".
+    """
+    routes = {}
+    for route in value.split(";"):
+        if not route.strip():
+            continue
+        model, sep, targets = route.partition("=")
+        model = model.strip()
+        if not sep or not model:
+            raise ValueError(f"Invalid route (expected <model>=<targets>): {route}")
+        routes[model] = tuple(parse_target(spec, model) for spec in targets.split(","))
+    return routes
+
+
+@dataclass
+class RoutingConfig:
+    """
+    Routing of queries for models offered by several providers.  Read from
+    the environment (or .env) by from_env().
+    """
+    policy: str = ROUTING_OFF
+
+    # Providers of each model, by the model name in queries
+    routes: dict[str, tuple[Target, ...]] = field(default_factory=dict)
+
+    # Seconds before hedging a call to a provider with fewer than
+    # min_samples latencies
+    hedge_delay: float = 2.0
+
+    # Latencies kept per provider, and needed for its p95 to be used
+    window: int = 200
+    min_samples: int = 20
+
+    def __post_init__(self) -> None:
+        if self.policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy: {self.policy}")
+        if self.hedge_delay < 0:
+            raise ValueError("hedge_delay must not be negative")
+        if self.window < 1 or not 1 <= self.min_samples <= self.window:
+            raise ValueError("min_samples must be between 1 and window")
+
+    @classmethod
+    def from_env(cls) -> "RoutingConfig":
+        return cls(
+            policy=os.environ.get("ROUTING_POLICY", cls.policy),
+            routes=parse_routes(os.environ.get("PROVIDER_ROUTES", "")),
+            hedge_delay=float(os.environ.get("HEDGE_DELAY", cls.hedge_delay)),
+            window=int(os.environ.get("ROUTING_WINDOW", cls.window)),
+            min_samples=int(os.environ.get("ROUTING_MIN_SAMPLES", cls.min_samples)),
+        )
+
+
+class LatencyTracker:
+    """
+    The latencies of the latest calls to a provider.
+    """
+
+    def __init__(self, window: int) -> None:
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+
+class Router:
+    """
+    Sends a query to the providers of its model by the configured policy,
+    tracking the latency of each provider.
+    """
+
+    def __init__(self, config: Optional[RoutingConfig] = None) -> None:
+        self.config = config or RoutingConfig()
+        self._trackers: dict[str, LatencyTracker] = {}
+        self._lock = threading.Lock()
+
+    def targets(self, provider: str, model: str) -> list[Target]:
+        """
+        The providers to try for a query, the one it names first.
+        """
+        requested = Target(provider.lower(), model)
+        route = self.config.routes.get(model)
+        if self.config.policy == ROUTING_OFF or not route:
+            return [requested]
+        for target in route:
+            if target.provider == requested.provider:
+                requested = target
+        return [requested] + [target for target in route if target.provider != requested.provider]
+
+    def tracker(self, provider: str) -> LatencyTracker:
+        with self._lock:
+            tracker = self._trackers.get(provider)
+            if tracker is None:
+                tracker = self._trackers[provider] = LatencyTracker(self.config.window)
+            return tracker
+
+    def observe(self, provider: str, seconds: float) -> None:
+        tracker = self.tracker(provider)
+        tracker.observe(seconds)
+        p95 = tracker.p95()
+        if p95 is not None:
+            metrics.PROVIDER_LATENCY_P95.labels(provider).set(p95)
+
+    def hedge_delay(self, provider: str) -> float:
+        """
+        Seconds to wait for the provider before hedging: its p95 latency,
+        once it has enough samples.
+        """
+        tracker = self.tracker(provider)
+        p95 = tracker.p95() if len(tracker) >= self.config.min_samples else None
+        return self.config.hedge_delay if p95 is None else p95
+
+    async def run(
+            self,
+            targets: list[Target],
+            call: Callable[[Target], Awaitable[T]],
+            hedge: bool = True,
+    ) -> tuple[Target, T]:
+        """
+        Call the targets in turn until one succeeds, and return it and its
+        result.  Under the hedge policy (and with hedge), the next target is
+        also called when the latest one exceeds its hedge_delay(), and the
+        first to succeed wins; the calls still in flight are cancelled.
+        Raises the last error if every call fails.
+        """
+        if len(targets) == 1:
+            return targets[0], await call(targets[0])
+
+        hedge = hedge and self.config.policy == ROUTING_HEDGE
+        remaining = list(targets)
+        # The calls in flight, with their target and start time
+        pending: dict["asyncio.Future[T]", tuple[Target, float]] = {}
+        started: list[tuple[Target, float]] = []
+
+        def start() -> None:
+            target = remaining.pop(0)
+            started.append((target, time.perf_counter()))
+            pending[asyncio.ensure_future(call(target))] = started[-1]
+
+        start()
+        try:
+            while True:
+                timeout = None
+                if hedge and remaining:
+                    # Hedge the latest call
+                    target, start_time = started[-1]
+                    timeout = max(
+                        0.0, self.hedge_delay(target.provider) - (time.perf_counter() - start_time))
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    metrics.PROVIDER_HEDGES.labels(remaining[0].provider).inc()
+                    start()
+                    continue
+                for task in done:
+                    target, start_time = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self.observe(target.provider, time.perf_counter() - start_time)
+                        return target, task.result()
+                    if remaining:
+                        metrics.PROVIDER_FAILOVERS.labels(target.provider).inc()
+                    if not pending:
+                        if not remaining:
+                            raise error
+                        start()
+        finally:
+            for task, (target, start_time) in pending.items():
+                task.cancel()
+                # A lower bound on its latency, which keeps slow providers'
+                # p95 from being underestimated
+                self.observe(target.provider, time.perf_counter() - start_time)
+
+
+router: Optional[Router] = None
+router_lock = threading.Lock()
+
+def get_router() -> Router:
+    global router
+    with router_lock:
+        if router is None:
+            router = Router(RoutingConfig.from_env())
+        return router
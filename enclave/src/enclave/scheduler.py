@@ -0,0 +1,299 @@
+from typing import Any, Optional
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+import asyncio
+import math
+import os
+import threading
+
+from . import metrics
+from .rate_limit import TokenBucket
+
+
+@dataclass(frozen=True)
+class Budget:
+    """
+    The contracted rate limits of a provider (or of one of its models).
+    """
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+def parse_budgets(value: str) -> dict[str, Budget]:
+    """
+    Parse "<provider>[/<model>]=<requests per minute>[:<tokens per minute>];...",
+    for example "openai=500:200000;together/meta-llama/Llama-3-8b-chat-hf=60".
+    Either limit may be left empty.
+    """
+    budgets = {}
+    for entry in value.split(";"):
+        if not entry.strip():
+            continue
+        name, sep, limits = entry.partition("=")
+        provider, _, model = name.strip().partition("/")
+        requests, _, tokens = limits.partition(":")
+        if not sep or not provider or not (requests.strip() or tokens.strip()):
+            raise ValueError(f"Invalid rate limit (expected <provider>=<rpm>[:<tpm>]): {entry}")
+        name = f"{provider.lower()}/{model}" if model else provider.lower()
+        budgets[name] = Budget(
+            float(requests) if requests.strip() else None,
+            float(tokens) if tokens.strip() else None)
+    return budgets
+
+
+@dataclass
+class SchedulerConfig:
+    """
+    Rate limits on the calls to each provider, and the queues of calls
+    waiting for them.  Read from the environment (or .env) by from_env().
+    """
+    # Budgets by provider, or by "<provider>/<model>".  A call is made
+    # within the budgets of both its model and its provider.
+    budgets: dict[str, Budget] = field(default_factory=dict)
+
+    # Seconds of a budget that may be spent at once
+    burst: float = 1.0
+
+    # Tokens reserved for a completion until the provider reports its usage
+    completion_tokens: int = 256
+
+    # Calls that may wait for a budget, and the longest expected wait.
+    # Calls beyond these are rejected (429).
+    max_queue: int = 1000
+    max_wait: float = 30.0
+
+    # Server processes sharing the budgets (see enclave.main)
+    workers: int = 1
+
+    def __post_init__(self) -> None:
+        if self.burst <= 0 or self.max_wait <= 0:
+            raise ValueError("burst and max_wait must be positive")
+        if self.max_queue < 0 or self.workers < 1:
+            raise ValueError("max_queue must not be negative, and workers at least 1")
+
+    @classmethod
+    def from_env(cls) -> "SchedulerConfig":
+        return cls(
+            budgets=parse_budgets(os.environ.get("PROVIDER_RATE_LIMITS", "")),
+            burst=float(os.environ.get("RATE_LIMIT_BURST", cls.burst)),
+            completion_tokens=int(
+                os.environ.get("RATE_LIMIT_COMPLETION_TOKENS", cls.completion_tokens)),
+            max_queue=int(os.environ.get("RATE_LIMIT_MAX_QUEUE", cls.max_queue)),
+            max_wait=float(os.environ.get("RATE_LIMIT_MAX_WAIT", cls.max_wait)),
+            workers=int(os.environ.get("ENCLAVE_WORKERS", cls.workers)),
+        )
+
+    def bucket(self, per_minute: Optional[float]) -> Optional[TokenBucket]:
+        """
+        A bucket for this worker's share of a per-minute limit.
+        """
+        if per_minute is None:
+            return None
+        rate = per_minute / 60 / self.workers
+        return TokenBucket(rate, max(1.0, rate * self.burst))
+
+
+class Overloaded(Exception):
+    """
+    A call was rejected, as it would wait too long for a budget.
+    """
+
+    def __init__(self, budget: str, retry_after: float) -> None:
+        super().__init__(f"rate limit of {budget} exceeded")
+        self.retry_after = retry_after
+
+
+# A call waiting for a budget, and the tokens it needs
+Waiter = tuple["asyncio.Future[None]", int]
+
+# The caller of calls that name none
+DEFAULT_CALLER = ""
+
+
+class Lane:
+    """
+    A budget, and the calls waiting for it by caller.  Calls are admitted as
+    the budget allows, in turn across callers (round robin), so that a
+    caller with many calls waiting does not hold up the others.  A caller
+    is only who it says it is, so the turns are no defence against a caller
+    claiming many names; the bound on all calls waiting still holds.
+    """
+
+    def __init__(self, name: str, budget: Budget, config: SchedulerConfig) -> None:
+        self.name = name
+        self.config = config
+        self.requests = config.bucket(budget.requests_per_minute)
+        self.tokens = config.bucket(budget.tokens_per_minute)
+        # Waiting calls by caller, in the order the callers are served
+        self._queues: OrderedDict[str, deque[Waiter]] = OrderedDict()
+        self.waiting = 0
+        self._dispatcher: Optional["asyncio.Task[None]"] = None
+
+    async def acquire(self, tokens: int, caller: str = DEFAULT_CALLER) -> None:
+        """
+        Wait until the call fits the budget.  Raises Overloaded if it would
+        wait too long.
+        """
+        if not self.waiting and self._try_take(tokens) is None:
+            return
+        wait = self.expected_wait(tokens)
+        if self.waiting >= self.config.max_queue or wait > self.config.max_wait:
+            metrics.RATE_LIMITED.labels(self.name).inc()
+            raise Overloaded(self.name, wait)
+
+        waiter: Waiter = (asyncio.get_running_loop().create_future(), tokens)
+        self._queues.setdefault(caller, deque()).append(waiter)
+        self.waiting += 1
+        metrics.RATE_LIMIT_WAITING.labels(self.name).inc()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            with metrics.stage("queue").time():
+                await waiter[0]
+        except asyncio.CancelledError:
+            if waiter[0].done() and not waiter[0].cancelled():
+                # Admitted just as it was cancelled: return what it took
+                self.refund(tokens, requests=1)
+            else:
+                self._remove(caller, waiter)
+            raise
+
+    def expected_wait(self, tokens: int) -> float:
+        """
+        Roughly the seconds until a call joining the queue would be admitted.
+        """
+        ahead = self.waiting + 1
+        wait = 0.0
+        if self.requests is not None:
+            wait = ahead / self.requests.rate
+        if self.tokens is not None:
+            wait = max(wait, ahead * tokens / self.tokens.rate)
+        return wait
+
+    def refund(self, tokens: int, requests: int = 0) -> None:
+        """
+        Return budget taken but not used (or, if negative, take more).
+        """
+        if self.requests is not None and requests:
+            self.requests.add(requests)
+        if self.tokens is not None and tokens:
+            self.tokens.add(tokens)
+
+    def _try_take(self, tokens: int) -> Optional[float]:
+        if self.requests is not None:
+            retry_after = self.requests.try_acquire()
+            if retry_after is not None:
+                return retry_after
+        if self.tokens is not None:
+            retry_after = self.tokens.try_acquire(tokens)
+            if retry_after is not None:
+                self.refund(0, requests=1)
+                return retry_after
+        return None
+
+    async def _dispatch(self) -> None:
+        while self._queues:
+            caller, queue = next(iter(self._queues.items()))
+            future, tokens = queue[0]
+            if future.done():
+                # Cancelled, and not yet removed by its call
+                self._remove(caller, queue[0])
+                continue
+            retry_after = self._try_take(tokens)
+            if retry_after is not None:
+                await asyncio.sleep(retry_after)
+                continue
+            self._remove(caller, queue[0])
+            # The caller goes to the back of the line
+            if caller in self._queues:
+                self._queues.move_to_end(caller)
+            future.set_result(None)
+
+    def _remove(self, caller: str, waiter: Waiter) -> None:
+        queue = self._queues.get(caller)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[caller]
+        self.waiting -= 1
+        metrics.RATE_LIMIT_WAITING.labels(self.name).dec()
+
+
+@dataclass
+class Ticket:
+    """
+    The budgets a call was admitted by, and the tokens reserved for it.
+    """
+    lanes: list[Lane]
+    tokens: int
+
+    def settle(self, usage: Optional[Any]) -> None:
+        """
+        Charge the tokens of the provider's usage report in place of those
+        reserved (which are kept if there is no report).
+        """
+        used = getattr(usage, "total_tokens", None)
+        if used is not None:
+            for lane in self.lanes:
+                lane.refund(self.tokens - used)
+
+    def cancel(self) -> None:
+        """
+        Return the tokens reserved for a call that failed (it still counts
+        as a request).
+        """
+        for lane in self.lanes:
+            lane.refund(self.tokens)
+
+
+class Scheduler:
+    """
+    The budgets of the providers and models, and the calls waiting for
+    them.  Providers and models without a budget are not limited.
+    """
+
+    def __init__(self, config: Optional[SchedulerConfig] = None) -> None:
+        self.config = config or SchedulerConfig()
+        self.lanes = {
+            name: Lane(name, budget, self.config) for name, budget in self.config.budgets.items()}
+
+    def estimate_tokens(self, prompt: str) -> int:
+        # About 4 characters per token for English text
+        return math.ceil(len(prompt) / 4) + self.config.completion_tokens
+
+    async def acquire(
+            self,
+            provider: str,
+            model: str,
+            prompt: str,
+            caller: str = DEFAULT_CALLER) -> Ticket:
+        """
+        Wait until a call fits the budgets of its model and provider, taking
+        turns with the calls of other callers.  Raises Overloaded if it would
+        wait too long.
+        """
+        provider = provider.lower()
+        lanes = [
+            lane for lane in (self.lanes.get(f"{provider}/{model}"), self.lanes.get(provider))
+            if lane is not None]
+        tokens = self.estimate_tokens(prompt)
+        for i, lane in enumerate(lanes):
+            try:
+                await lane.acquire(tokens, caller)
+            except BaseException:
+                for acquired in lanes[:i]:
+                    acquired.refund(tokens, requests=1)
+                raise
+        return Ticket(lanes, tokens)
+
+
+scheduler: Optional[Scheduler] = None
+scheduler_lock = threading.Lock()
+
+def get_scheduler() -> Scheduler:
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = Scheduler(SchedulerConfig.from_env())
+        return scheduler
@@ -0,0 +1,109 @@
+from typing import Any, Awaitable, Callable, Optional
+from dataclasses import dataclass
+import asyncio
+import os
+import threading
+
+from .cache import KEY_FIELDS
+
+REQUIRED_KEY_FIELDS = ("provider", "model", "prompt")
+
+
+def _env_fields(var: str, default: tuple[str, ...]) -> tuple[str, ...]:
+    value = os.environ.get(var)
+    if value is None:
+        return default
+    return tuple(name.strip() for name in value.split(",") if name.strip())
+
+
+@dataclass
+class SingleFlightConfig:
+    """
+    Coalescing of identical queries in flight.  Read from the environment (or
+    .env) by from_env().
+    """
+    # LlmRequest fields that must match for queries to share a provider call
+    key_fields: tuple[str, ...] = KEY_FIELDS
+
+    # Queries that may wait on one provider call, besides the first (0 to
+    # disable coalescing).  Once a call has this many, the next identical
+    # query makes a new call, which later queries wait on.
+    max_waiters: int = 100
+
+    def __post_init__(self) -> None:
+        # Queries sharing a call share its signed query_data, which holds
+        # the prompt and the response of the model
+        missing = set(REQUIRED_KEY_FIELDS) - set(self.key_fields)
+        if missing:
+            raise ValueError(f"key_fields must include: {', '.join(sorted(missing))}")
+        if self.max_waiters < 0:
+            raise ValueError("max_waiters must not be negative")
+
+    @classmethod
+    def from_env(cls) -> "SingleFlightConfig":
+        return cls(
+            key_fields=_env_fields("COALESCE_KEY_FIELDS", cls.key_fields),
+            max_waiters=int(os.environ.get("COALESCE_MAX_WAITERS", cls.max_waiters)),
+        )
+
+
+@dataclass
+class Flight:
+    task: "asyncio.Task[Any]"
+    waiters: int = 0
+
+
+class SingleFlight:
+    """
+    Table of the calls in flight, by key.  A query for a key that is in
+    flight waits on that call, and gets its result (or exception).
+    """
+
+    def __init__(self, config: Optional[SingleFlightConfig] = None) -> None:
+        self.config = config or SingleFlightConfig()
+        # Calls made, and queries that waited on a call made for another
+        self.calls = 0
+        self.coalesced = 0
+        self._flights: dict[str, Flight] = {}
+
+    async def run(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._flights.get(key)
+        if flight is not None and flight.waiters < self.config.max_waiters:
+            flight.waiters += 1
+            self.coalesced += 1
+        else:
+            # The call runs in its own task, so that it completes for the
+            # waiters even if the query that started it is cancelled.
+            flight = Flight(asyncio.ensure_future(call()))
+            flight.task.add_done_callback(_retrieve_exception)
+            self.calls += 1
+            if self.config.max_waiters > 0:
+                # Replaces a call with no room for more waiters
+                self._flights[key] = flight
+                flight.task.add_done_callback(lambda _: self._done(key, flight))
+        return await asyncio.shield(flight.task)
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _done(self, key: str, flight: Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+def _retrieve_exception(task: "asyncio.Task[Any]") -> None:
+    # A call whose queries were all cancelled has no one to take its
+    # exception, which asyncio would otherwise log as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+
+single_flight: Optional[SingleFlight] = None
+single_flight_lock = threading.Lock()
+
+def get_single_flight() -> SingleFlight:
+    global single_flight
+    with single_flight_lock:
+        if single_flight is None:
+            single_flight = SingleFlight(SingleFlightConfig.from_env())
+        return single_flight
@@ -0,0 +1,25 @@
+from click import command, option
+
+from core.defaults import DEFAULT_APP_SERVER_PORT, DEFAULT_TUNNEL_PORT
+from core.tunnel import TunnelConfig
+from core.tunnel_enclave import forward_tunnel_enclave
+
+
+@command()
+@option("--tunnel-port", type = int, default = DEFAULT_TUNNEL_PORT)
+@option("--app-port", "-p", type = int, default = DEFAULT_APP_SERVER_PORT)
+@option(
+    "--service", "-s",
+    type = int,
+    multiple = True,
+    default = [443, 11434],
+    help="Local port to forward to the same port on the host (repeatable)")
+def main(tunnel_port: int, app_port: int, service: list[int]) -> None:
+    """
+    Accept tunnel channels from the host (forward --tunnel-channels) on vsock
+    <tunnel_port>.  Connections from the host are forwarded to the app on
+    localhost:<app_port>, and connections to localhost:<service> are forwarded
+    to <service> on the host (replacing host_to_vsock).
+    """
+    tunnel = TunnelConfig(port=tunnel_port, app_port=app_port)
+    forward_tunnel_enclave(list(service), tunnel=tunnel)
@@ -2,8 +2,15 @@ from typing import Optional
 import os
 import sys
 import base64
+import random
+import threading
 
 from dotenv import load_dotenv
+from eth_account import Account
+from eth_account.messages import SignableMessage, encode_defunct
+
+from . import metrics
+
 load_dotenv()
 
 try:
@@ -16,15 +23,80 @@ except Exception as e:
 
 enclave_private_key: Optional[str] = None
 
+# FastAPI runs sync dependencies on a thread pool, so concurrent first
+# requests must not each create a key (or NSM).
+init_lock = threading.RLock()
+
 def get_enclave_private_key() -> str:
     global enclave_private_key
-    if enclave_private_key is None:
-        # pylint: disable=redefined-outer-name
-        nsm = get_nsm()
-        private_key_bytes = nsm.get_random()
-        assert len(private_key_bytes) == 32
-        enclave_private_key = "0x" + private_key_bytes.hex()
-    return enclave_private_key
+    with init_lock:
+        if enclave_private_key is None:
+            # pylint: disable=redefined-outer-name
+            nsm = get_nsm()
+            private_key_bytes = nsm.get_random()
+            assert len(private_key_bytes) == 32
+            enclave_private_key = "0x" + private_key_bytes.hex()
+        return enclave_private_key
+
+
+# When Signer checks a signature by recovering the signer from it
+RECOVER_ALWAYS = "always"
+RECOVER_SAMPLED = "sampled"
+RECOVER_OFF = "off"
+RECOVER_MODES = [RECOVER_ALWAYS, RECOVER_SAMPLED, RECOVER_OFF]
+
+
+class Signer:
+    """
+    Signs EIP-191 messages with a key parsed once.  Recovering the signer
+    from a signature costs as much as signing, so the check is made for
+    every signature, a sample of them (sample_rate), or none.
+    """
+
+    def __init__(
+            self,
+            private_key: str,
+            recover: str = RECOVER_SAMPLED,
+            sample_rate: float = 0.01,
+    ) -> None:
+        if recover not in RECOVER_MODES:
+            raise ValueError(f"recover must be one of {RECOVER_MODES}")
+        # pylint: disable=no-value-for-parameter
+        self.account = Account.from_key(private_key)
+        self.address: str = self.account.address
+        self.recover = recover
+        self.sample_rate = sample_rate
+
+    def sign(self, message: SignableMessage) -> str:
+        """
+        Returns the hex signature of message.
+        """
+        with metrics.stage("sign").time():
+            signature = self.account.sign_message(message).signature
+        if self.recover == RECOVER_ALWAYS or \
+                self.recover == RECOVER_SAMPLED and random.random() < self.sample_rate:
+            with metrics.stage("recover").time():
+                # pylint: disable=no-value-for-parameter
+                recovered_address = Account.recover_message(message, signature=signature)
+            if recovered_address != self.address:
+                raise RuntimeError(f"signature recovers {recovered_address}, not {self.address}")
+        return str(signature.hex())
+
+    def sign_text(self, text: str) -> str:
+        return self.sign(encode_defunct(text=text))
+
+
+signer: Optional[Signer] = None
+
+def get_signer() -> Signer:
+    global signer
+    with init_lock:
+        if signer is None:
+            signer = Signer(
+                get_enclave_private_key(),
+                os.environ.get("SIGNATURE_CHECK", RECOVER_SAMPLED),
+                float(os.environ.get("SIGNATURE_CHECK_RATE", "0.01")))
+        return signer
 
 
 def get_env_var_or_exit(var: str) -> str:
@@ -52,8 +124,15 @@ def get_api_key(provider: str) -> str:
 
 def get_base_url(provider: str) -> str:
     """
-    Takes a provider name and returns the corresponding base URL.
+    Takes a provider name and returns the corresponding base URL.  The URL of
+    a provider can be overridden with <PROVIDER>_BASE_URL (for example,
+    OLLAMA_BASE_URL=http://127.0.0.1:8000/v1 to point the ollama slot at a
+    mock provider).
     """
+    override = os.environ.get(f"{provider.upper()}_BASE_URL")
+    if override:
+        return override
+
     provider_urls = {
         "ollama": "http://localhost:11434/v1",
         "openai": "https://api.openai.com/v1",
@@ -111,7 +190,8 @@ nsm: Optional[NSM] = None
 
 def get_nsm() -> NSM:
     global nsm
-    if nsm is None:
-        print("Creating NSM ...")
-        nsm = NSM()
-    return nsm
+    with init_lock:
+        if nsm is None:
+            print("Creating NSM ...")
+            nsm = NSM()
+        return nsm
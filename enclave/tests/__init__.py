@@ -0,0 +1,5 @@
+import os
+
+# enclave.utils exits if the provider keys are not set
+for var in ["OPENAI_API_KEY", "ANTHROPIC_API_KEY", "TOGETHER_API_KEY"]:
+    os.environ.setdefault(var, "test")
@@ -0,0 +1,105 @@
+from unittest import TestCase
+import asyncio
+import time
+
+import httpx
+from eth_account.messages import encode_defunct
+from web3.auto import w3
+
+from enclave import utils
+from enclave.app import app
+from enclave.attestation import Attestation, AttestationConfig, get_attestation
+from enclave.query import is_attestation_nonce, load_canonical, nonce_text, serialize, \
+    split_signed_response, signed_response
+from enclave.utils import Signer
+
+PRIVATE_KEY = "0x" + "11" * 32
+
+
+class CountingNSM(utils.NSM):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.attestations = 0
+
+    def get_attestation_doc(self, public_key: bytes) -> str:
+        self.attestations += 1
+        return f"attestation {self.attestations}"
+
+
+def get(attestation: Attestation, paths: list[str]) -> list[httpx.Response]:
+    app.dependency_overrides[get_attestation] = lambda: attestation
+
+    async def run() -> list[httpx.Response]:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+            return [await c.get(path) for path in paths]
+
+    try:
+        return asyncio.run(run())
+    finally:
+        app.dependency_overrides.clear()
+
+
+class TestAttestation(TestCase):
+
+    def test_cached(self) -> None:
+        nsm = CountingNSM()
+        attestation = Attestation(nsm, Signer(PRIVATE_KEY))
+        responses = get(attestation, ["/enclave/address"] * 10)
+        self.assertEqual(1, nsm.attestations)
+        self.assertEqual(
+            [{"address": attestation.address, "attestation_doc": "attestation 1"}] * 10,
+            [r.json() for r in responses])
+
+    def test_refresh(self) -> None:
+        nsm = CountingNSM()
+        attestation = Attestation(
+            nsm, Signer(PRIVATE_KEY), AttestationConfig(refresh_interval=0.1, max_age=1.0))
+        attestation.start()
+        time.sleep(0.35)
+        attestation.stop()
+        self.assertGreaterEqual(nsm.attestations, 3)
+        doc = get(attestation, ["/enclave/address"])[0].json()["attestation_doc"]
+        self.assertEqual(f"attestation {nsm.attestations}", doc)
+
+    def test_nonce(self) -> None:
+        nsm = CountingNSM()
+        attestation = Attestation(
+            nsm, Signer(PRIVATE_KEY), AttestationConfig(nonce_rate=0.5, nonce_burst=2))
+        responses = get(attestation, [
+            "/enclave/address", "/enclave/address?nonce=abc", "/enclave/address?nonce=def",
+            "/enclave/address?nonce=ghi"])
+        self.assertEqual(3, nsm.attestations)
+
+        fresh = responses[2].json()
+        self.assertEqual("attestation 3", fresh["attestation_doc"])
+        self.assertEqual("def", fresh["nonce"])
+        self.assertEqual(
+            attestation.address,
+            w3.eth.account.recover_message(
+                encode_defunct(text=nonce_text("def")), signature=fresh["nonce_signature"]))
+
+        self.assertEqual(429, responses[3].status_code)
+        self.assertEqual("2", responses[3].headers["Retry-After"])
+
+    def test_nonce_is_not_a_query(self) -> None:
+        """
+        A nonce signature never verifies as a signed query response, even
+        for a nonce chosen to look like query data.
+        """
+        attestation = Attestation(CountingNSM(), Signer(PRIVATE_KEY))
+        forged = serialize({"request": "2 + 2?", "response": "5"})
+        fresh = attestation.fresh(forged)
+
+        query_data, address, signature = split_signed_response(
+            signed_response(forged, fresh["nonce_signature"], attestation.address).decode()) \
+            or ("", "", "")
+        self.assertEqual(forged, query_data)
+        recovered = w3.eth.account.recover_message(
+            encode_defunct(text=query_data), signature=signature)
+        self.assertNotEqual(address, recovered)
+
+        # What is signed is marked as a nonce, which the verifier rejects
+        self.assertTrue(is_attestation_nonce(load_canonical(nonce_text(forged))))
+        self.assertFalse(is_attestation_nonce(load_canonical(forged)))
@@ -0,0 +1,113 @@
+from typing import Any
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+
+import httpx
+
+from enclave import cache as cache_module
+from enclave.app import app
+from enclave.cache import ResponseCache, ResponseCacheConfig, get_response_cache, \
+    is_deterministic, request_key
+from enclave.providers import ProviderClients, get_provider_clients
+from enclave.query import serialize
+
+from .test_providers import Provider
+
+
+def signed(n: int) -> dict[str, Any]:
+    return {"query_data": {"request": str(n), "response": "x" * 80}, "signature": "s"}
+
+
+class TestCache(TestCase):
+
+    def test_request_key(self) -> None:
+        fields = {"provider": "OpenAI", "model": "m", "prompt": "p", "options": {"a": 1, "b": 2}}
+        key = request_key(fields)
+        self.assertEqual(key, request_key({
+            "options": {"b": 2, "a": 1}, "provider": "openai", "model": "m", "prompt": "p",
+            "api_key": "k", "stream": False, "cache": True}))
+        self.assertNotEqual(key, request_key({**fields, "prompt": "q"}))
+        self.assertNotEqual(key, request_key({**fields, "options": {"a": 1}}))
+
+        self.assertFalse(is_deterministic(fields))
+        self.assertTrue(is_deterministic({"options": {"temperature": 0}}))
+        self.assertFalse(is_deterministic({"options": {"temperature": 0.5}}))
+
+    def test_lru_bytes(self) -> None:
+        size = len(serialize(signed(0)))
+        cache = ResponseCache(ResponseCacheConfig(max_bytes=3 * size))
+        for n in range(3):
+            cache.put(str(n), signed(n))
+        self.assertEqual(signed(0), cache.get("0"))
+
+        # "1" is now the least recently used
+        cache.put("3", signed(3))
+        self.assertIsNone(cache.get("1"))
+        self.assertEqual(signed(0), cache.get("0"))
+        self.assertEqual(
+            {"hits": 2, "misses": 1, "evictions": 1, "entries": 3, "bytes": 3 * size},
+            cache.stats_data())
+
+        # Too large to cache
+        cache.put("4", {"response": "x" * 4 * size})
+        self.assertIsNone(cache.get("4"))
+
+    def test_ttl(self) -> None:
+        cache = ResponseCache(ResponseCacheConfig(ttl=10))
+        with patch.object(cache_module.time, "monotonic", return_value=100.0):
+            cache.put("0", signed(0))
+        with patch.object(cache_module.time, "monotonic", return_value=109.0):
+            self.assertEqual(signed(0), cache.get("0"))
+        with patch.object(cache_module.time, "monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("0"))
+        self.assertEqual(0, cache.stats_data()["bytes"])
+
+    def test_query(self) -> None:
+        """
+        Repeated deterministic queries are answered from the cache.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        cache = ResponseCache()
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+        app.dependency_overrides[get_response_cache] = lambda: cache
+        deterministic = {
+            "provider": "mock", "model": "mock", "prompt": "hi", "options": {"temperature": 0}}
+
+        async def run() -> list[httpx.Response]:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                responses = [
+                    await c.post("/enclave/query", json=body) for body in [
+                        deterministic,
+                        deterministic,
+                        {**deterministic, "cache": False},
+                        {**deterministic, "options": {}},
+                        {**deterministic, "options": {}, "cache": True},
+                        {**deterministic, "options": {}, "cache": True},
+                    ]
+                ]
+                responses.append(await c.get("/enclave/cache"))
+            await clients.aclose()
+            return responses
+
+        try:
+            responses = asyncio.run(run())
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual(
+            ["miss", "hit", None, None, "miss", "hit"],
+            [r.headers.get("X-Cache") for r in responses[:-1]])
+        self.assertEqual(responses[0].json(), responses[1].json())
+        # Only the query that called the provider spent time in it
+        self.assertEqual(
+            [["provider", "sign", "total"], ["total"]],
+            [[t.split(";")[0] for t in r.headers["Server-Timing"].split(", ")]
+             for r in responses[:2]])
+        self.assertEqual(4, provider.requests)
+        stats = responses[-1].json()
+        self.assertEqual((2, 2), (stats["hits"], stats["misses"]))
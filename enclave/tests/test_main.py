@@ -0,0 +1,64 @@
+from unittest import TestCase
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+from core.loopback import free_port
+
+WORKERS = 2
+
+
+def children(pid: int) -> list[str]:
+    with open(f"/proc/{pid}/task/{pid}/children", "r", encoding="utf-8") as f:
+        return f.read().split()
+
+
+class TestMain(TestCase):
+
+    def test_workers_share_key(self) -> None:
+        """
+        Every worker, including those restarted, signs with the key generated
+        before they were forked.
+        """
+        port = free_port()
+        proc = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, "-c", "from enclave.main import main; main()",
+             "--workers", str(WORKERS), "--port", str(port)],
+            env=os.environ.copy(),
+            stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 60
+
+        def workers() -> list[str]:
+            while len(children(proc.pid)) < WORKERS and time.monotonic() < deadline:
+                time.sleep(0.1)
+            return children(proc.pid)
+
+        def address() -> str:
+            while True:
+                try:
+                    return str(httpx.get(
+                        f"http://127.0.0.1:{port}/enclave/address").json()["address"])
+                except httpx.TransportError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.2)
+
+        try:
+            first_workers = workers()
+            self.assertEqual(WORKERS, len(first_workers))
+            first_address = address()
+
+            # Replace every worker
+            for pid in first_workers:
+                os.kill(int(pid), signal.SIGKILL)
+            while set(workers()) & set(first_workers) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.assertFalse(set(workers()) & set(first_workers))
+            self.assertEqual(first_address, address())
+        finally:
+            proc.terminate()
+            proc.wait()
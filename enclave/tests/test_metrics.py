@@ -0,0 +1,136 @@
+from typing import Any, AsyncGenerator, AsyncIterator
+from types import SimpleNamespace
+from unittest import TestCase
+import asyncio
+import contextlib
+
+import httpx
+
+from enclave import metrics
+from enclave.app import LlmRequest, app, stream_query
+from enclave.metrics import Registry
+from enclave.providers import ProviderClients, get_provider_clients
+from enclave.utils import Signer
+
+from .test_providers import FAIL, Provider
+
+
+class Stream:
+    """
+    A provider stream (as openai.AsyncStream) of chunks.
+    """
+
+    def __init__(self, chunks: AsyncGenerator[Any, None]) -> None:
+        self.chunks = chunks
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self.chunks
+
+    async def __aenter__(self) -> "Stream":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.chunks.aclose()
+
+
+class TestMetrics(TestCase):
+
+    def test_render(self) -> None:
+        registry = Registry()
+        counter = registry.counter("errors_total", "Errors", ["provider"])
+        gauge = registry.gauge("in_flight", "In flight")
+        histogram = registry.histogram("seconds", "Latency", ["stage"], buckets=[0.1, 1.0])
+
+        counter.labels('a"b').inc()
+        counter.labels('a"b').inc(2)
+        with gauge.labels().track():
+            self.assertEqual(1, gauge.labels().value)
+        for value in [0.05, 0.1, 0.5, 5.0]:
+            histogram.labels("sign").observe(value)
+        with self.assertRaises(ValueError):
+            histogram.labels()
+
+        self.assertEqual(
+            "# HELP errors_total Errors\n"
+            "# TYPE errors_total counter\n"
+            'errors_total{provider="a\\"b"} 3.0\n'
+            "# HELP in_flight In flight\n"
+            "# TYPE in_flight gauge\n"
+            "in_flight 0.0\n"
+            "# HELP seconds Latency\n"
+            "# TYPE seconds histogram\n"
+            'seconds_bucket{stage="sign",le="0.1"} 2\n'
+            'seconds_bucket{stage="sign",le="1.0"} 3\n'
+            'seconds_bucket{stage="sign",le="+Inf"} 4\n'
+            'seconds_sum{stage="sign"} 5.65\n'
+            'seconds_count{stage="sign"} 4\n',
+            registry.render())
+
+    def test_endpoint(self) -> None:
+        """
+        Queries are timed by stage, and provider errors and tokens counted.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"metrics": "key"}, get_base_url=lambda _: provider.base_url)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+        body = {"provider": "metrics", "model": "m", "prompt": "hi", "cache": False}
+
+        async def run() -> httpx.Response:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                for prompt in ["hi", "hi", FAIL]:
+                    await c.post("/enclave/query", json={**body, "prompt": prompt})
+                resp = await c.get("/enclave/metrics")
+            await clients.aclose()
+            return resp
+
+        try:
+            resp = asyncio.run(run())
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain"))
+        lines = set(resp.text.splitlines())
+        self.assertIn('enclave_provider_errors_total{provider="metrics"} 1.0', lines)
+        self.assertIn('enclave_provider_requests_in_flight{provider="metrics"} 0.0', lines)
+        self.assertIn('enclave_tokens_total{provider="metrics",model="m",type="prompt"} 2.0', lines)
+        self.assertIn(
+            'enclave_tokens_total{provider="metrics",model="m",type="completion"} 4.0', lines)
+        self.assertIn('enclave_requests_in_flight{endpoint="query"} 0.0', lines)
+        for stage in ["provider", "parse", "serialize", "sign"]:
+            self.assertIn(f'enclave_stage_seconds_bucket{{stage="{stage}",le="+Inf"}}',
+                          resp.text)
+        self.assertGreaterEqual(sum(metrics.REQUEST_SECONDS.labels("query").snapshot()[0]), 3)
+
+    def test_stream_timed(self) -> None:
+        """
+        A streamed query is timed until its last event is sent, not its
+        first.
+        """
+        in_flight = metrics.REQUESTS_IN_FLIGHT.labels("stream")
+        seconds = metrics.REQUEST_SECONDS.labels("stream")
+
+        async def chunks() -> AsyncGenerator[Any, None]:
+            for content in ["hel", "lo"]:
+                await asyncio.sleep(0.1)
+                yield SimpleNamespace(usage=None, to_dict=lambda c=content: {"content": c})
+
+        async def run() -> int:
+            timer = contextlib.ExitStack()
+            timer.enter_context(metrics.request("stream"))
+            request_body = LlmRequest(provider="p", model="m", prompt="hi", stream=True)
+            events = 0
+            async for _ in stream_query(
+                    request_body, Stream(chunks()), Signer("0x" + "11" * 32), timer=timer):
+                self.assertEqual(1, in_flight.value)
+                events += 1
+            return events
+
+        self.assertEqual(3, asyncio.run(run()))
+        self.assertEqual(0, in_flight.value)
+        counts, total = seconds.snapshot()
+        self.assertEqual(1, sum(counts))
+        self.assertGreaterEqual(total, 0.2)
@@ -0,0 +1,227 @@
+from typing import Any
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+import gc
+import json
+import os
+import ssl
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from enclave import providers
+from enclave.providers import ProviderClientConfig, ProviderClients, ResumingSSLContext
+
+COMPLETION = {
+    "id": "test",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "test",
+    "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": "hello"},
+        "finish_reason": "stop",
+    }],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+}
+
+
+CHUNKS = [
+    {
+        "id": "test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "test",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    }
+    for content in ["hel", "lo\n", "wörld"]
+]
+
+# Prompt the provider rejects
+FAIL = "fail"
+
+
+class Provider:
+    """
+    OpenAI-compatible provider on loopback, counting connections, requests
+    and the greatest number of requests in flight, and keeping the last
+    request.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.last_request: Any = None
+        lock = threading.Lock()
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+                provider.connections += 1
+
+            def do_POST(self) -> None:  # pylint: disable=invalid-name
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with lock:
+                    provider.requests += 1
+                    provider.last_request = request
+                    provider.in_flight += 1
+                    provider.max_in_flight = max(provider.max_in_flight, provider.in_flight)
+                time.sleep(latency)
+                with lock:
+                    provider.in_flight -= 1
+                if request["messages"][0]["content"] == FAIL:
+                    self.send_error(400)
+                    return
+                if request.get("stream"):
+                    self.send_stream()
+                    return
+                body = json.dumps(COMPLETION).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_stream(self) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in CHUNKS:
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                # No Content-Length, so the stream ends with the connection
+                self.close_connection = True
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        ThreadingHTTPServer.request_queue_size = 1024
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def self_signed(directory: str) -> str:
+    """
+    A certificate and key for localhost, in one PEM file.
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.now(timezone.utc)
+    cert = x509.CertificateBuilder() \
+        .subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(minutes=1)).not_valid_after(now + timedelta(hours=1)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+        .sign(key, hashes.SHA256())
+    path = os.path.join(directory, "localhost.pem")
+    with open(path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    return path
+
+
+class TestProviders(TestCase):
+
+    def test_registry(self) -> None:
+        clients = ProviderClients()
+        openai = clients.client("openai")
+        self.assertIs(openai, clients.client("OpenAI"))
+        self.assertIsNot(openai, clients.client("together"))
+        self.assertEqual("https://api.openai.com/v1/", str(openai.base_url))
+        with self.assertRaises(ValueError):
+            clients.client("unknown")
+        clients.close()
+
+    def test_config_from_env(self) -> None:
+        env = {"PROVIDER_MAX_CONNECTIONS": "7", "PROVIDER_HTTP2": "0"}
+        with patch.dict(providers.os.environ, env):
+            config = ProviderClientConfig.from_env()
+        self.assertEqual(7, config.max_connections)
+        self.assertEqual(100, config.max_keepalive_connections)
+        self.assertFalse(config.http2)
+
+    def test_keep_alive(self) -> None:
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"test": "key"}, get_base_url=lambda _: provider.base_url)
+        try:
+            for _ in range(5):
+                resp = clients.client("test").chat.completions.create(
+                    model="test", messages=[{"role": "user", "content": "hi"}])
+                self.assertEqual("hello", resp.choices[0].message.content)
+            self.assertEqual(1, provider.connections)
+        finally:
+            clients.close()
+            provider.close()
+
+    def test_resume_concurrent(self) -> None:
+        """
+        New connections resume a session from any open connection to the
+        server (asyncio connections, as httpx's async client makes), however
+        many were opened at once or have closed since.
+        """
+        handlers: list[asyncio.Future[Any]] = []
+
+        async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            handlers.append(asyncio.current_task()) # type: ignore
+            while data := await reader.read(100):
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        async def connect(port: int, ctx: ssl.SSLContext) -> tuple[asyncio.StreamWriter, bool]:
+            reader, writer = await asyncio.open_connection(
+                "127.0.0.1", port, ssl=ctx, server_hostname="localhost")
+            # The session ticket arrives with the first data from the server
+            writer.write(b"hi")
+            await reader.readexactly(2)
+            return writer, writer.get_extra_info("ssl_object").session_reused
+
+        async def run(pem: str) -> list[bool]:
+            server_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            server_ctx.load_cert_chain(pem)
+            server = await asyncio.start_server(echo, "127.0.0.1", 0, ssl=server_ctx)
+            port = server.sockets[0].getsockname()[1]
+            ctx = ResumingSSLContext()
+            ctx.load_verify_locations(cafile=pem)
+            # Opened at once, so neither has a ticket as the other is made
+            first, second = await asyncio.gather(connect(port, ctx), connect(port, ctx))
+            # The last connection made is gone, and the first still open
+            second[0].close()
+            await second[0].wait_closed()
+            del second
+            gc.collect()
+            rest = await asyncio.gather(*(connect(port, ctx) for _ in range(5)))
+            for writer, _ in [first, *rest]:
+                writer.close()
+                await writer.wait_closed()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            server.close()
+            return [reused for _, reused in rest]
+
+        with TemporaryDirectory() as directory:
+            reused = asyncio.run(run(self_signed(directory)))
+        self.assertEqual([True] * 5, reused)
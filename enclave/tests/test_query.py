@@ -0,0 +1,217 @@
+from unittest import TestCase
+import asyncio
+import json
+import time
+
+import httpx
+from eth_account.messages import encode_defunct
+from web3.auto import w3
+
+from enclave.app import LlmRequest, app, create_completion, stream_query
+from enclave.providers import ProviderClients, get_provider_clients
+from enclave.query import SIGNATURE_EVENT, MerkleTree, Transcript, leaf_hash, \
+    load_canonical, root_from_proof, serialize, signed_response, split_signed_response
+from enclave.utils import Signer
+
+from .test_attestation import PRIVATE_KEY
+from .test_providers import CHUNKS, FAIL, Provider
+
+CONCURRENT_QUERIES = 200
+PROVIDER_LATENCY = 1.0
+
+
+class TestQuery(TestCase):
+
+    def test_concurrent_queries(self) -> None:
+        """
+        Queries to a slow provider overlap within one process.
+        """
+        provider = Provider(latency=PROVIDER_LATENCY)
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+
+        async def run() -> list[httpx.Response]:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                # Distinct prompts, as identical queries share a provider call
+                responses = await asyncio.gather(*(
+                    c.post(
+                        "/enclave/query",
+                        json={"provider": "mock", "model": "mock", "prompt": f"hi {i}"},
+                        timeout=60)
+                    for i in range(CONCURRENT_QUERIES)))
+            await clients.aclose()
+            return responses
+
+        try:
+            start = time.monotonic()
+            responses = asyncio.run(run())
+            elapsed = time.monotonic() - start
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual([200] * CONCURRENT_QUERIES, [r.status_code for r in responses])
+        # Serially, this would take CONCURRENT_QUERIES * PROVIDER_LATENCY
+        self.assertGreater(provider.max_in_flight, CONCURRENT_QUERIES // 2)
+        self.assertLess(elapsed, 10 * PROVIDER_LATENCY)
+
+        signed = responses[0].json()
+        self.assertEqual("hello", signed["query_data"]["response"]["choices"][0]["message"]["content"])
+        message = encode_defunct(text=json.dumps(
+            signed["query_data"], sort_keys=True, ensure_ascii=False))
+        self.assertEqual(
+            signed["recovered_address"],
+            w3.eth.account.recover_message(message, signature=signed["signature"]))
+        # Every response is signed by the same key
+        self.assertEqual(1, len({r.json()["recovered_address"] for r in responses}))
+
+        # The body is the canonical serialization, around the signed text
+        self.assertEqual(serialize(signed), responses[0].text)
+        parts = split_signed_response(responses[0].text)
+        assert parts is not None
+        self.assertEqual(
+            (serialize(signed["query_data"]), signed["recovered_address"], signed["signature"]),
+            parts)
+
+    def test_signed_response(self) -> None:
+        query_data = {"request": "é", "response": {"b": [1, {"d": None, "c": "\n"}], "a": 2.5}}
+        text = serialize(query_data)
+        body = signed_response(text, "0x5ig", "0xadd")
+        signed = {"query_data": query_data, "signature": "0x5ig", "recovered_address": "0xadd"}
+        self.assertEqual(serialize(signed), body.decode())
+        # A verifier's copy may end with a newline
+        self.assertEqual((text, "0xadd", "0x5ig"), split_signed_response(body.decode() + "\n"))
+        self.assertEqual(query_data, load_canonical(text))
+
+        # Any other form is verified by serializing the query_data again
+        self.assertIsNone(split_signed_response(json.dumps(json.loads(body), indent=2)))
+        self.assertIsNone(split_signed_response(text))
+        for text in ['{"b": 1, "a": 2}', '{"a": {"a": 1, "a": 2}}']:
+            with self.assertRaisesRegex(ValueError, "canonical"):
+                load_canonical(text)
+
+    def test_stream(self) -> None:
+        """
+        Chunks are relayed as events, and the final event signs their digest.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+
+        async def run() -> str:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                body = {"provider": "mock", "model": "mock", "prompt": "hi", "stream": True}
+                response = await c.post("/enclave/query", json=body, timeout=60)
+            await clients.aclose()
+            self.assertEqual("text/event-stream; charset=utf-8", response.headers["content-type"])
+            return response.text
+
+        try:
+            events = asyncio.run(run()).split("\n\n")
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        # The chunks, the signature, and "" after the last separator
+        self.assertEqual(len(CHUNKS) + 2, len(events))
+        chunks = [event.removeprefix("data: ") for event in events[:len(CHUNKS)]]
+        self.assertEqual(
+            [c["choices"][0]["delta"]["content"] for c in CHUNKS],
+            [json.loads(c)["choices"][0]["delta"]["content"] for c in chunks])
+
+        transcript = Transcript()
+        for chunk in chunks:
+            transcript.update(chunk)
+        signature_event = events[len(CHUNKS)].split("\n")
+        self.assertEqual(f"event: {SIGNATURE_EVENT}", signature_event[0])
+        signed = json.loads(signature_event[1].removeprefix("data: "))
+        self.assertEqual({"request": "hi", "transcript": transcript.data()}, signed["query_data"])
+        self.assertEqual(len(CHUNKS), signed["query_data"]["transcript"]["chunks"])
+
+        message = encode_defunct(text=serialize(signed["query_data"]))
+        self.assertEqual(
+            signed["recovered_address"],
+            w3.eth.account.recover_message(message, signature=signed["signature"]))
+
+    def test_stream_disconnect(self) -> None:
+        """
+        A stream the client stops reading (as when it disconnects) closes the
+        provider's response, releasing its connection.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        body = LlmRequest(provider="mock", model="mock", prompt="hi", stream=True)
+
+        async def run() -> bool:
+            stream = await create_completion(clients.async_client("mock"), body)
+            events = stream_query(body, stream, Signer(PRIVATE_KEY))
+            await anext(events)
+            # What the server does with the response's iterator on disconnect
+            await events.aclose()
+            closed = stream.response.is_closed
+            await clients.aclose()
+            return bool(closed)
+
+        try:
+            self.assertTrue(asyncio.run(run()))
+        finally:
+            provider.close()
+
+    def test_merkle_proofs(self) -> None:
+        for n in range(1, 20):
+            leaves = [leaf_hash({"request": str(i)}) for i in range(n)]
+            tree = MerkleTree(leaves)
+            for i, leaf in enumerate(leaves):
+                self.assertEqual(tree.root, root_from_proof(leaf, tree.proof(i)))
+                if n > 1:
+                    other = leaves[(i + 1) % n]
+                    self.assertNotEqual(tree.root, root_from_proof(other, tree.proof(i)))
+
+    def test_batch(self) -> None:
+        """
+        One signature covers every result, and each result verifies alone.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+        prompts = [f"prompt {i}" for i in range(10)]
+        prompts[3] = FAIL
+
+        async def run() -> httpx.Response:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                body = {"provider": "mock", "model": "mock", "prompts": prompts}
+                response = await c.post("/enclave/query/batch", json=body, timeout=60)
+            await clients.aclose()
+            return response
+
+        try:
+            response = asyncio.run(run())
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual(200, response.status_code)
+        batch = response.json()
+        self.assertEqual(len(prompts) - 1, batch["query_data"]["leaves"])
+        results = batch["results"]
+        self.assertIn("error", results[3])
+        del results[3]
+        del prompts[3]
+
+        message = encode_defunct(text=serialize(batch["query_data"]))
+        address = w3.eth.account.recover_message(message, signature=batch["signature"])
+        for i, (prompt, item) in enumerate(zip(prompts, results)):
+            self.assertEqual(prompt, item["query_data"]["request"])
+            self.assertEqual(i, item["index"])
+            root = root_from_proof(leaf_hash(item["query_data"]), item["proof"])
+            self.assertEqual(batch["query_data"]["merkle_root"], "0x" + root.hex())
+            message = encode_defunct(text=serialize(item["batch"]))
+            self.assertEqual(
+                address, w3.eth.account.recover_message(message, signature=item["signature"]))
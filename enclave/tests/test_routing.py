@@ -0,0 +1,173 @@
+from typing import Any
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+import json
+
+import httpx
+from eth_account.messages import encode_defunct
+from web3.auto import w3
+
+from enclave import routing
+from enclave.app import app
+from enclave.providers import ProviderClients, get_provider_clients
+from enclave.query import serialize
+from enclave.routing import ROUTING_FAILOVER, ROUTING_HEDGE, LatencyTracker, Router, \
+    RoutingConfig, Target, get_router, parse_routes
+
+from .test_providers import CHUNKS, Provider
+
+ROUTES = {"m": (Target("a", "m-a"), Target("b", "m-b"), Target("c", "m"))}
+
+
+def router(policy: str, **kwargs: Any) -> Router:
+    return Router(RoutingConfig(policy=policy, routes=ROUTES, **kwargs))
+
+
+async def fake_call(delays: dict[str, float], calls: list[str], target: Target) -> str:
+    """
+    Answers after delays[provider] seconds, or fails if it is negative.
+    """
+    calls.append(target.provider)
+    delay = delays[target.provider]
+    await asyncio.sleep(abs(delay))
+    if delay < 0:
+        raise RuntimeError(f"{target.provider} failed")
+    return target.provider
+
+
+def run(r: Router, targets: list[Target], delays: dict[str, float]) -> tuple[str, list[str]]:
+    calls: list[str] = []
+    target, result = asyncio.run(r.run(targets, lambda t: fake_call(delays, calls, t)))
+    assert target.provider == result
+    return result, calls
+
+
+class TestRouting(TestCase):
+
+    def test_parse_routes(self) -> None:
+        self.assertEqual(
+            {
+                "llama3": (
+                    Target("together", "meta-llama/Llama-3-8b"), Target("ollama", "llama3:8b")),
+                "m": (Target("openai", "m"),),
+            },
+            parse_routes("llama3=Together/meta-llama/Llama-3-8b, ollama/llama3:8b; m=openai"))
+        self.assertEqual({}, parse_routes(""))
+        with self.assertRaises(ValueError):
+            parse_routes("together")
+
+        env = {"ROUTING_POLICY": "hedge", "PROVIDER_ROUTES": "m=a,b", "ROUTING_MIN_SAMPLES": "5"}
+        with patch.dict(routing.os.environ, env):
+            config = RoutingConfig.from_env()
+        self.assertEqual(ROUTING_HEDGE, config.policy)
+        self.assertEqual(5, config.min_samples)
+        with self.assertRaises(ValueError):
+            RoutingConfig(policy="fastest")
+
+    def test_targets(self) -> None:
+        r = router(ROUTING_FAILOVER)
+        self.assertEqual(
+            [Target("b", "m-b"), Target("a", "m-a"), Target("c", "m")], r.targets("B", "m"))
+        # A provider outside the route is tried first, with the model as named
+        self.assertEqual(Target("d", "m"), r.targets("d", "m")[0])
+        self.assertEqual([Target("a", "x")], r.targets("a", "x"))
+        # No routing by default
+        self.assertEqual(
+            [Target("a", "m")], Router(RoutingConfig(routes=ROUTES)).targets("a", "m"))
+
+    def test_p95(self) -> None:
+        tracker = LatencyTracker(100)
+        self.assertIsNone(tracker.p95())
+        for i in range(200):
+            tracker.observe(float(i))
+        # Only the latest 100 are kept
+        self.assertEqual(195.0, tracker.p95())
+
+        r = router(ROUTING_HEDGE, hedge_delay=3.0, min_samples=10)
+        for _ in range(9):
+            r.observe("a", 1.0)
+        self.assertEqual(3.0, r.hedge_delay("a"))
+        r.observe("a", 1.0)
+        self.assertEqual(1.0, r.hedge_delay("a"))
+
+    def test_failover(self) -> None:
+        r = router(ROUTING_FAILOVER)
+        targets = r.targets("a", "m")
+        self.assertEqual(("a", ["a"]), run(r, targets, {"a": 0, "b": 0, "c": 0}))
+        self.assertEqual(
+            ("c", ["a", "b", "c"]), run(r, targets, {"a": -0.001, "b": -0.01, "c": 0}))
+        # Not hedged, however slow
+        self.assertEqual(("a", ["a"]), run(r, targets, {"a": 0.1, "b": 0, "c": 0}))
+        with self.assertRaisesRegex(RuntimeError, "c failed"):
+            run(r, targets, {"a": -0.001, "b": -0.001, "c": -0.001})
+
+    def test_hedge(self) -> None:
+        r = router(ROUTING_HEDGE, hedge_delay=0.05, min_samples=1)
+        targets = r.targets("a", "m")
+        # A slow primary is hedged, and the hedge answers first
+        self.assertEqual(("b", ["a", "b"]), run(r, targets, {"a": 1.0, "b": 0, "c": 0}))
+        # The cancelled call counts as at least as slow as it was
+        self.assertGreaterEqual(r.hedge_delay("a"), 0.05)
+        # The primary can still win after the hedge is sent
+        self.assertEqual(("a", ["a", "b"]), run(r, targets[:2], {"a": 0.2, "b": 1.0}))
+
+        # Once b's p95 is known, it is hedged after that long
+        for _ in range(20):
+            r.observe("b", 0.01)
+        self.assertEqual(
+            ("c", ["b", "a", "c"]),
+            run(r, r.targets("b", "m"), {"a": 1.0, "b": 1.0, "c": 0}))
+
+    def test_query(self) -> None:
+        """
+        A slow provider's query is answered by the hedge, and the signed
+        query_data names the provider that answered.
+        """
+        slow, fast = Provider(latency=1.0), Provider()
+        base_urls = {"slow": slow.base_url, "fast": fast.base_url, "down": "http://127.0.0.1:1/v1"}
+        clients = ProviderClients(
+            api_keys={name: "key" for name in base_urls}, get_base_url=base_urls.__getitem__)
+        r = Router(RoutingConfig(
+            policy=ROUTING_HEDGE,
+            routes=parse_routes("m=slow,fast;n=down,fast"),
+            hedge_delay=0.1))
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+        app.dependency_overrides[get_router] = lambda: r
+
+        async def run_queries() -> list[httpx.Response]:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                responses = [
+                    await c.post("/enclave/query", json={
+                        "provider": provider, "model": model, "prompt": "hi", "stream": stream,
+                        "cache": False})
+                    for provider, model, stream in [
+                        ("slow", "m", False), ("fast", "x", False), ("down", "n", True)]
+                ]
+            await clients.aclose()
+            return responses
+
+        try:
+            responses = asyncio.run(run_queries())
+        finally:
+            app.dependency_overrides.clear()
+            slow.close()
+            fast.close()
+
+        hedged, unrouted, failed_over = responses
+        self.assertEqual(200, hedged.status_code)
+        signed = hedged.json()
+        self.assertEqual("fast", signed["query_data"]["provider"])
+        message = encode_defunct(text=serialize(signed["query_data"]))
+        self.assertEqual(
+            signed["recovered_address"],
+            w3.eth.account.recover_message(message, signature=signed["signature"]))
+        self.assertNotIn("provider", unrouted.json()["query_data"])
+
+        # The stream failed over when the connection was refused
+        events = failed_over.text.strip().split("\n\n")
+        self.assertEqual(len(CHUNKS) + 1, len(events))
+        signature_data = json.loads(events[-1].split("data: ", 1)[1])
+        self.assertEqual("fast", signature_data["query_data"]["provider"])
+        self.assertEqual((1, 3), (slow.requests, fast.requests))
@@ -0,0 +1,230 @@
+from typing import Any
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+
+import httpx
+
+from enclave import scheduler as scheduler_module
+from enclave.app import app
+from enclave.providers import ProviderClients, get_provider_clients
+from enclave.rate_limit import TokenBucket
+from enclave.scheduler import Budget, Overloaded, Scheduler, SchedulerConfig, get_scheduler, \
+    parse_budgets
+
+from .test_providers import Provider
+
+
+def scheduler(budgets: str, **kwargs: Any) -> Scheduler:
+    return Scheduler(SchedulerConfig(budgets=parse_budgets(budgets), **kwargs))
+
+
+class TestScheduler(TestCase):
+
+    def test_parse_budgets(self) -> None:
+        self.assertEqual(
+            {
+                "openai": Budget(500, 200000),
+                "together/meta-llama/Llama-3-8b": Budget(60, None),
+                "ollama": Budget(None, 1000),
+            },
+            parse_budgets("OpenAI=500:200000; together/meta-llama/Llama-3-8b=60;ollama=:1000"))
+        for value in ["openai", "openai=", "=60"]:
+            with self.assertRaises(ValueError):
+                parse_budgets(value)
+
+        env = {"PROVIDER_RATE_LIMITS": "openai=600", "ENCLAVE_WORKERS": "4"}
+        with patch.dict(scheduler_module.os.environ, env):
+            config = SchedulerConfig.from_env()
+        # Each of the 4 workers gets 600 / 4 requests per minute
+        bucket = Scheduler(config).lanes["openai"].requests
+        assert bucket is not None
+        self.assertAlmostEqual(2.5, bucket.rate)
+
+    def test_token_bucket_debt(self) -> None:
+        bucket = TokenBucket(10, 5)
+        self.assertIsNone(bucket.try_acquire(3))
+        self.assertAlmostEqual(0.1, bucket.try_acquire(3) or 0, places=2)
+        bucket.add(3)
+        # More than burst is taken from a full bucket, leaving a debt
+        self.assertIsNone(bucket.try_acquire(8))
+        self.assertAlmostEqual(0.4, bucket.try_acquire(1) or 0, places=2)
+
+    def test_queuing(self) -> None:
+        """
+        Waiting calls are admitted in the order they arrived, at the
+        budget's rate.
+        """
+        s = scheduler("p=6000", burst=0.01)
+        admitted: list[int] = []
+
+        async def call(i: int) -> None:
+            await s.acquire("p", "m", "")
+            admitted.append(i)
+
+        async def run() -> float:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            tasks = [asyncio.ensure_future(call(i)) for i in range(7)]
+            await asyncio.gather(*tasks)
+            return loop.time() - start
+
+        elapsed = asyncio.run(run())
+        self.assertEqual(list(range(7)), admitted)
+        # 100 calls per second, the first at once
+        self.assertGreater(elapsed, 0.055)
+        self.assertEqual(0, s.lanes["p"].waiting)
+
+    def test_fair(self) -> None:
+        """
+        A call from one caller is not held up behind a burst from another.
+        """
+        s = scheduler("p=6000", burst=0.01)
+        admitted: list[str] = []
+
+        async def call(caller: str) -> None:
+            await s.acquire("p", "m", "", caller)
+            admitted.append(caller)
+
+        async def run() -> None:
+            tasks = [asyncio.ensure_future(call("a")) for _ in range(10)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.ensure_future(call("b")))
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        # The first call of the burst is admitted at once, then callers
+        # take turns
+        self.assertEqual(["a", "a", "b"] + ["a"] * 8, admitted)
+
+    def test_overloaded(self) -> None:
+        async def run(s: Scheduler, models: list[str]) -> list[BaseException]:
+            tasks = []
+            for model in models:
+                tasks.append(asyncio.ensure_future(s.acquire("p", model, "")))
+                await asyncio.sleep(0)
+            errors = [t.exception() for t in tasks if t.done() and t.exception()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.assertEqual(0, s.lanes["p"].waiting)
+            return errors # type: ignore
+
+        # The fourth call would wait 3 seconds (behind the two waiting, at 1
+        # per second)
+        s = scheduler("p=60;p/m=6000", max_wait=2.5)
+        errors = asyncio.run(run(s, ["m", "m", "x", "x"]))
+        self.assertEqual(1, len(errors))
+        assert isinstance(errors[0], Overloaded)
+        self.assertEqual("rate limit of p exceeded", str(errors[0]))
+        self.assertAlmostEqual(3.0, errors[0].retry_after)
+
+        # The third call is past the queue
+        s = scheduler("p=60", max_queue=1)
+        errors = asyncio.run(run(s, ["m", "m", "m"]))
+        self.assertEqual(1, len(errors))
+        self.assertAlmostEqual(2.0, errors[0].retry_after) # type: ignore
+
+    def test_settle(self) -> None:
+        s = scheduler("p=:6000", completion_tokens=10)
+
+        async def run() -> None:
+            ticket = await s.acquire("p", "m", "x" * 40)
+            self.assertEqual(20, ticket.tokens)
+            ticket.settle(SimpleNamespace(total_tokens=120))
+
+        asyncio.run(run())
+        bucket = s.lanes["p"].tokens
+        assert bucket is not None
+        # 120 of the 100 tokens were used, at 100 per second
+        self.assertAlmostEqual(0.21, bucket.try_acquire(1) or 0, places=2)
+
+        # A failed call's tokens are returned
+        s = scheduler("p=:6000", completion_tokens=10)
+        asyncio.run(s.acquire("p", "m", "")).cancel()
+        bucket = s.lanes["p"].tokens
+        assert bucket is not None
+        self.assertIsNone(bucket.try_acquire(100))
+
+    def test_cancel_admitted(self) -> None:
+        """
+        A call cancelled after it was admitted, but before it resumed,
+        returns the budget it took.
+        """
+        s = scheduler("p=600", burst=0.1)
+        lane = s.lanes["p"]
+
+        async def run() -> None:
+            await s.acquire("p", "m", "")
+            task = asyncio.ensure_future(s.acquire("p", "m", ""))
+            await asyncio.sleep(0)
+            self.assertEqual(1, lane.waiting)
+            while lane.waiting:
+                await asyncio.sleep(0)
+            # Admitted, and not yet resumed
+            self.assertFalse(task.done())
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.assertTrue(task.cancelled())
+
+        asyncio.run(run())
+        assert lane.requests is not None
+        self.assertIsNone(lane.requests.try_acquire())
+
+    def test_stream_usage(self) -> None:
+        """
+        A streamed query asks the provider to report its usage, to settle
+        the tokens reserved for it.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+
+        async def run() -> httpx.Response:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                response = await c.post("/enclave/query", json={
+                    "provider": "mock", "model": "mock", "prompt": "hi", "stream": True})
+            await clients.aclose()
+            return response
+
+        try:
+            response = asyncio.run(run())
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"include_usage": True}, provider.last_request["stream_options"])
+
+    def test_query(self) -> None:
+        """
+        A query beyond the provider's rate limit is rejected with 429 and
+        Retry-After.
+        """
+        provider = Provider()
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        s = scheduler("mock=60", max_wait=0.5)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+        app.dependency_overrides[get_scheduler] = lambda: s
+
+        async def run() -> list[httpx.Response]:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                body = {"provider": "mock", "model": "mock", "prompt": "hi", "cache": False}
+                responses = [await c.post("/enclave/query", json=body) for _ in range(2)]
+            await clients.aclose()
+            return responses
+
+        try:
+            responses = asyncio.run(run())
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual([200, 429], [r.status_code for r in responses])
+        self.assertEqual("1", responses[1].headers["Retry-After"])
+        self.assertEqual(1, provider.requests)
@@ -0,0 +1,124 @@
+from typing import Any
+from unittest import TestCase
+import asyncio
+import gc
+
+import httpx
+
+from enclave.app import app
+from enclave.cache import ResponseCache, ResponseCacheConfig, get_response_cache
+from enclave.providers import ProviderClients, get_provider_clients
+from enclave.single_flight import SingleFlight, SingleFlightConfig, get_single_flight
+
+from .test_providers import Provider
+
+CONCURRENT_QUERIES = 50
+
+BODY = {"provider": "mock", "model": "mock", "prompt": "hi", "options": {"temperature": 0}}
+
+
+class TestSingleFlight(TestCase):
+
+    def _query(
+            self,
+            flights: SingleFlight,
+            bodies: list[dict[str, Any]],
+    ) -> tuple[Provider, list[httpx.Response]]:
+        """
+        Send the queries concurrently to a slow provider.  Returns the
+        provider, for its counts, and the responses.
+        """
+        provider = Provider(latency=0.5)
+        clients = ProviderClients(
+            api_keys={"mock": "key"}, get_base_url=lambda _: provider.base_url)
+        app.dependency_overrides[get_provider_clients] = lambda: clients
+        app.dependency_overrides[get_single_flight] = lambda: flights
+        # Not served from the cache, which would hide the coalescing
+        app.dependency_overrides[get_response_cache] = \
+            lambda: ResponseCache(ResponseCacheConfig(max_bytes=0))
+
+        async def run() -> list[httpx.Response]:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://enclave") as c:
+                responses = await asyncio.gather(*(
+                    c.post("/enclave/query", json=body, timeout=60) for body in bodies))
+            await clients.aclose()
+            return responses
+
+        try:
+            responses = asyncio.run(run())
+        finally:
+            app.dependency_overrides.clear()
+            provider.close()
+
+        self.assertEqual([200] * len(bodies), [r.status_code for r in responses])
+        self.assertEqual(0, flights.in_flight())
+        return provider, responses
+
+    def test_one_provider_call(self) -> None:
+        flights = SingleFlight()
+        provider, responses = self._query(flights, [BODY] * CONCURRENT_QUERIES)
+        self.assertEqual(1, provider.requests)
+        self.assertEqual(CONCURRENT_QUERIES - 1, flights.coalesced)
+        self.assertEqual(1, len({r.json()["signature"] for r in responses}))
+
+    def test_max_waiters(self) -> None:
+        flights = SingleFlight(SingleFlightConfig(max_waiters=9))
+        provider, _ = self._query(flights, [BODY] * CONCURRENT_QUERIES)
+        self.assertEqual(CONCURRENT_QUERIES // 10, provider.requests)
+
+    def test_key_fields(self) -> None:
+        bodies = [
+            {**BODY, "system": str(i % 2)}
+            for i in range(10)
+        ]
+        provider, _ = self._query(SingleFlight(), bodies)
+        self.assertEqual(2, provider.requests)
+
+        config = SingleFlightConfig(key_fields=("provider", "model", "prompt"))
+        provider, _ = self._query(SingleFlight(config), bodies)
+        self.assertEqual(1, provider.requests)
+
+        # Opted out
+        provider, _ = self._query(SingleFlight(config), [{**b, "cache": False} for b in bodies])
+        self.assertEqual(10, provider.requests)
+
+        with self.assertRaises(ValueError):
+            SingleFlightConfig(key_fields=("provider", "model"))
+
+    def test_sampled(self) -> None:
+        """
+        Queries that sample are only coalesced if they ask to be, so that
+        each otherwise gets its own completion.
+        """
+        for options in [None, {"temperature": 0.7}]:
+            body = {**BODY, "options": options}
+            provider, _ = self._query(SingleFlight(), [body] * 5)
+            self.assertEqual(5, provider.requests)
+            provider, _ = self._query(SingleFlight(), [{**body, "cache": True}] * 5)
+            self.assertEqual(1, provider.requests)
+
+    def test_exception_retrieved(self) -> None:
+        """
+        The exception of a call whose queries were all cancelled is not
+        reported as never retrieved.
+        """
+        errors: list[dict[str, Any]] = []
+
+        async def fail() -> None:
+            await asyncio.sleep(0.01)
+            raise RuntimeError("provider failed")
+
+        async def run() -> None:
+            loop = asyncio.get_running_loop()
+            loop.set_exception_handler(lambda _, context: errors.append(context))
+            flights = SingleFlight()
+            query = asyncio.ensure_future(flights.run("key", fail))
+            await asyncio.sleep(0)
+            query.cancel()
+            await asyncio.sleep(0.05)
+            self.assertEqual(0, flights.in_flight())
+            gc.collect()
+
+        asyncio.run(run())
+        self.assertEqual([], errors)
@@ -0,0 +1,54 @@
+from unittest import TestCase
+from unittest.mock import patch
+import os
+
+from eth_account.messages import encode_defunct
+from web3.auto import w3
+
+from enclave import utils
+from enclave.utils import Signer
+
+PRIVATE_KEY = "0x" + "22" * 32
+
+
+class TestSigner(TestCase):
+
+    def test_sign(self) -> None:
+        message = encode_defunct(text="hello")
+        expected = w3.eth.account.sign_message(message, PRIVATE_KEY).signature.hex()
+        for recover in utils.RECOVER_MODES:
+            signer = Signer(PRIVATE_KEY, recover)
+            self.assertEqual(expected, signer.sign(message))
+            self.assertEqual(expected, signer.sign_text("hello"))
+            self.assertEqual(
+                signer.address, w3.eth.account.recover_message(message, signature=expected))
+        with self.assertRaises(ValueError):
+            Signer(PRIVATE_KEY, "sometimes")
+
+    def test_recover(self) -> None:
+        wrong = "0x" + "00" * 20
+        with patch.object(utils.Account, "recover_message", return_value=wrong) as recover:
+            Signer(PRIVATE_KEY, utils.RECOVER_OFF).sign_text("hello")
+            self.assertEqual(0, recover.call_count)
+
+            signer = Signer(PRIVATE_KEY, utils.RECOVER_SAMPLED, sample_rate=0.5)
+            with patch.object(utils.random, "random", return_value=0.6):
+                signer.sign_text("hello")
+            self.assertEqual(0, recover.call_count)
+            with patch.object(utils.random, "random", return_value=0.4):
+                with self.assertRaises(RuntimeError):
+                    signer.sign_text("hello")
+            self.assertEqual(1, recover.call_count)
+
+            with self.assertRaises(RuntimeError):
+                Signer(PRIVATE_KEY, utils.RECOVER_ALWAYS).sign_text("hello")
+
+
+class TestBaseUrl(TestCase):
+
+    def test_override(self) -> None:
+        self.assertEqual("http://localhost:11434/v1", utils.get_base_url("Ollama"))
+        with patch.dict(os.environ, {"OLLAMA_BASE_URL": "http://127.0.0.1:8000/v1"}):
+            self.assertEqual("http://127.0.0.1:8000/v1", utils.get_base_url("Ollama"))
+        with self.assertRaises(ValueError):
+            utils.get_base_url("mock")
@@ -1,5 +1,7 @@
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
+from dataclasses import dataclass
 import base64
+import hashlib
 
 from OpenSSL import crypto # type: ignore
 import cbor2 # type: ignore
@@ -8,105 +10,284 @@ from cose import EC2, CoseAlgorithms, CoseEllipticCurves
 from Crypto.Util.number import long_to_bytes
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
 from cryptography.x509 import load_der_x509_certificate
 
 
-# pylint: disable=too-many-locals
-def verify_attestation_doc(
-        attestation_doc: str,
-        pcrs: Optional[list[Any]]=None,
-        root_cert_pem: Optional[Any]=None) -> None:
+class AttestationError(Exception):
+    pass
+
+
+def decode_attestation_doc(attestation_doc: bytes) -> tuple[list[Any], dict[str, Any]]:
     """
-    Verify the attestation document
-    If invalid, raise an exception
+    The COSE_Sign1 structure of an attestation document, and its decoded
+    payload.
     """
-    pcrs = pcrs or []
-
     # Decode CBOR attestation document
     data = cbor2.loads(attestation_doc)
 
     # Load and decode document payload
-    doc = data[2]
-    doc_obj = cbor2.loads(doc)
+    doc_obj = cbor2.loads(data[2])
+    return data, doc_obj
 
+
+def check_pcrs(doc_obj: dict[str, Any], pcrs: list[Any]) -> None:
     # Get PCRs from attestation document
     document_pcrs_arr = doc_obj["pcrs"]
 
-    # Part 1: Validating PCRs
     for index, pcr in enumerate(pcrs):
         # Attestation document doesn't have specified PCR, raise exception
         if index not in document_pcrs_arr or document_pcrs_arr[index] is None:
-            # pylint: disable=broad-exception-raised
-            raise Exception(f"Wrong PCR{index}")
+            raise AttestationError(f"Wrong PCR{index}")
 
         # Get PCR hexcode
         doc_pcr = document_pcrs_arr[index].hex()
 
         # Check if PCR match
         if pcr != doc_pcr:
-            # pylint: disable=broad-exception-raised
-            raise Exception(f"Wrong PCR{index}\nEnclaves PCR{index}: {doc_pcr}")
+            raise AttestationError(f"Wrong PCR{index}\nEnclaves PCR{index}: {doc_pcr}")
 
-    # Part 2: Validating signature
 
-    # Get signing certificate from attestation document
-    cert = crypto.load_certificate(crypto.FILETYPE_ASN1, doc_obj["certificate"])
+def certificate_key(certificate: bytes) -> EC2:
+    """
+    The COSE key of the signing certificate of a document.
+    """
+    cert = crypto.load_certificate(crypto.FILETYPE_ASN1, certificate)
 
     # Get the key parameters from the cert public key
     cert_public_numbers = cert.get_pubkey().to_cryptography_key().public_numbers()
-    x = cert_public_numbers.x
-    y = cert_public_numbers.y
-    _curve = cert_public_numbers.curve
-
-    x = long_to_bytes(x)
-    y = long_to_bytes(y)
+    x = long_to_bytes(cert_public_numbers.x)
+    y = long_to_bytes(cert_public_numbers.y)
 
     # Create the EC2 key from public key parameters
-    key = EC2(alg=CoseAlgorithms.ES384, x=x, y=y, crv=CoseEllipticCurves.P_384)
+    return EC2(alg=CoseAlgorithms.ES384, x=x, y=y, crv=CoseEllipticCurves.P_384)
+
 
+def check_signature(data: list[Any], key: EC2) -> None:
     # Get the protected header from attestation document
     phdr = cbor2.loads(data[0])
 
     # Construct the Sign1 message
-    msg = cose.Sign1Message(phdr=phdr, uhdr=data[1], payload=doc)
+    msg = cose.Sign1Message(phdr=phdr, uhdr=data[1], payload=data[2])
     msg.signature = data[3]
 
     # Verify the signature using the EC2 key
     if not msg.verify_signature(key):
-        # pylint: disable=broad-exception-raised
-        raise Exception("Wrong signature")
+        raise AttestationError("Wrong signature")
+
+
+def certificate_public_key(certificate: bytes) -> ec.EllipticCurvePublicKey:
+    public_key = load_der_x509_certificate(certificate, default_backend()).public_key()
+    if not isinstance(public_key, ec.EllipticCurvePublicKey):
+        raise AttestationError("Signing certificate does not have an EC key")
+    return public_key
+
+
+def check_signature_der(data: list[Any], public_key: ec.EllipticCurvePublicKey) -> None:
+    """
+    As check_signature, verifying the COSE_Sign1 signature with OpenSSL in
+    place of the (pure Python) ecdsa package used by cose.
+    """
+    sig_structure = cbor2.dumps(["Signature1", data[0], b"", data[2]])
+    signature = data[3]
+    half = len(signature) // 2
+    der_signature = encode_dss_signature(
+        int.from_bytes(signature[:half], "big"), int.from_bytes(signature[half:], "big"))
+    try:
+        public_key.verify(der_signature, sig_structure, ec.ECDSA(hashes.SHA384()))
+    except InvalidSignature as e:
+        raise AttestationError("Wrong signature") from e
+
+
+def create_store(root_cert: Any, cabundle: list[bytes]) -> Any:
+    """
+    An X509Store of the root certificate, and the CA bundle of a document.
+    """
+    store = crypto.X509Store()
+    store.add_cert(root_cert)
+
+    # Except the first certificate, which is the root certificate
+    for _cert_binary in cabundle[1:]:
+        _cert = crypto.load_certificate(crypto.FILETYPE_ASN1, _cert_binary)
+        store.add_cert(_cert)
+    return store
+
+
+def check_chain(store: Any, certificate: bytes) -> None:
+    """
+    Validate the signing certificate against store.  If the cert is invalid,
+    raises an exception.
+    """
+    cert = crypto.load_certificate(crypto.FILETYPE_ASN1, certificate)
+    store_ctx = crypto.X509StoreContext(store, cert)
+    try:
+        store_ctx.verify_certificate()
+    except crypto.X509StoreContextError as exc:
+        if str(exc) == "certificate has expired":
+            cert = load_der_x509_certificate(certificate, default_backend())
+            # _print_cert_expired_msg(cert)
+        else:
+            raise exc
+
+
+def verify_attestation_doc(
+        attestation_doc: str,
+        pcrs: Optional[list[Any]]=None,
+        root_cert_pem: Optional[Any]=None) -> None:
+    """
+    Verify the attestation document
+    If invalid, raise an exception
+    """
+    pcrs = pcrs or []
+    data, doc_obj = decode_attestation_doc(attestation_doc) # type: ignore
+
+    # Part 1: Validating PCRs
+    check_pcrs(doc_obj, pcrs)
+
+    # Part 2: Validating signature
+    check_signature(data, certificate_key(doc_obj["certificate"]))
 
     # Part 3: Validating signing certificate PKI
     if root_cert_pem is not None:
-        # Create an X509Store object for the CA bundles
-        store = crypto.X509Store()
+        # Create the CA cert object from PEM string
+        root_cert = crypto.load_certificate(crypto.FILETYPE_PEM, root_cert_pem)
+        check_chain(create_store(root_cert, doc_obj["cabundle"]), doc_obj["certificate"])
 
-        # Create the CA cert object from PEM string, and store into X509Store
-        _cert = crypto.load_certificate(crypto.FILETYPE_PEM, root_cert_pem)
-        store.add_cert(_cert)
 
-        # Get the CA bundle from attestation document and store into X509Store
-        # Except the first certificate, which is the root certificate
-        for _cert_binary in doc_obj["cabundle"][1:]:
-            _cert = crypto.load_certificate(crypto.FILETYPE_ASN1, _cert_binary)
-            store.add_cert(_cert)
-
-        # Get the X509Store context
-        store_ctx = crypto.X509StoreContext(store, cert)
-
-        # Validate the certificate
-        # If the cert is invalid, it will raise exception
-        try:
-            store_ctx.verify_certificate()
-        except crypto.X509StoreContextError as exc:
-            if str(exc) == "certificate has expired":
-                cert = load_der_x509_certificate(
-                    doc_obj["certificate"], default_backend()
-                )
-                # _print_cert_expired_msg(cert)
-            else:
-                raise exc
+def measurements_pcrs(
+        measurements_data: Any,
+        indices: Iterable[int] = (0,)) -> dict[int, str]:
+    """
+    The PCRs of a measurements file (as written by nitro-cli build-enclave).
+    """
+    return {i: measurements_data["Measurements"][f"PCR{i}"] for i in indices}
+
+
+class MeasurementIndex:
+    """
+    Allow-list of PCR sets, one per enclave build.  Sets are indexed by
+    their values, so a document is matched with one lookup for each
+    distinct combination of PCR indices (usually one), however many sets
+    there are.
+    """
+
+    def __init__(self) -> None:
+        # PCR indices -> values of those PCRs -> name of the set
+        self._index: dict[tuple[int, ...], dict[tuple[str, ...], str]] = {}
+
+    def add(self, name: str, pcrs: dict[int, str]) -> None:
+        indices = tuple(sorted(pcrs))
+        values = tuple(pcrs[i].lower() for i in indices)
+        self._index.setdefault(indices, {})[values] = name
+
+    def match(self, document_pcrs: dict[int, Optional[bytes]]) -> Optional[str]:
+        """
+        The name of the set matching the PCRs of a document, if any.
+        """
+        for indices, sets in self._index.items():
+            try:
+                values = tuple(document_pcrs[i].hex() for i in indices) # type: ignore
+            except (KeyError, AttributeError):
+                continue
+            name = sets.get(values)
+            if name is not None:
+                return name
+        return None
+
+    def __len__(self) -> int:
+        return sum(len(sets) for sets in self._index.values())
+
+
+@dataclass
+class VerifiedAttestation:
+    # The "public_key" field of the document, and the name of the PCR set it
+    # matched
+    public_key: bytes
+    measurements: Optional[str]
+
+
+class AttestationVerifier: # pylint: disable=too-few-public-methods
+    """
+    Verifies attestation documents, caching the work that documents share:
+    the parsed root certificate, a store of the CA bundle for each bundle
+    (they rarely differ within a region), the key of each signing
+    certificate, and the result of validating each certificate chain.
+    Signatures are verified with OpenSSL (check_signature_der).
+    """
+
+    def __init__(
+            self,
+            root_cert_pem: Optional[str] = None,
+            measurements: Optional[MeasurementIndex] = None,
+            max_cached: int = 1024,
+    ) -> None:
+        self.root_cert = None if root_cert_pem is None else \
+            crypto.load_certificate(crypto.FILETYPE_PEM, root_cert_pem)
+        self.measurements = measurements
+        self.max_cached = max_cached
+        self._stores: dict[bytes, Any] = {}
+        self._keys: dict[bytes, ec.EllipticCurvePublicKey] = {}
+        # (CA bundle digest, certificate digest) -> error, or None if valid
+        self._chains: dict[tuple[bytes, bytes], Optional[Exception]] = {}
+
+    def verify(self, attestation_doc: bytes) -> VerifiedAttestation:
+        """
+        Verify the attestation document, and match it against the
+        measurements (if any).  If invalid, raises an exception.
+        """
+        data, doc_obj = decode_attestation_doc(attestation_doc)
+
+        name = None
+        if self.measurements is not None:
+            name = self.measurements.match(doc_obj["pcrs"])
+            if name is None:
+                raise AttestationError("PCRs match none of the measurements")
+
+        certificate = doc_obj["certificate"]
+        certificate_digest = hashlib.sha256(certificate).digest()
+        key = self._keys.get(certificate_digest)
+        if key is None:
+            key = self._cache(
+                self._keys, certificate_digest, certificate_public_key(certificate))
+        check_signature_der(data, key)
+
+        if self.root_cert is not None:
+            self._check_chain(doc_obj["cabundle"], certificate, certificate_digest)
+
+        return VerifiedAttestation(doc_obj["public_key"], name)
+
+    def _check_chain(
+            self,
+            cabundle: list[bytes],
+            certificate: bytes,
+            certificate_digest: bytes) -> None:
+        bundle_digest = hashlib.sha256(b"".join(cabundle)).digest()
+        if (bundle_digest, certificate_digest) not in self._chains:
+            store = self._stores.get(bundle_digest)
+            if store is None:
+                store = self._cache(
+                    self._stores, bundle_digest, create_store(self.root_cert, cabundle))
+            error: Optional[Exception] = None
+            try:
+                check_chain(store, certificate)
+            except crypto.X509StoreContextError as e:
+                error = e
+            self._cache(self._chains, (bundle_digest, certificate_digest), error)
+
+        error = self._chains[(bundle_digest, certificate_digest)]
+        if error is not None:
+            raise error
+
+    def _cache(self, cache: dict[Any, Any], key: Any, value: Any) -> Any:
+        if len(cache) >= self.max_cached:
+            # Drop the oldest entry
+            del cache[next(iter(cache))]
+        cache[key] = value
+        return value
 
 
 def _print_cert_expired_msg(cert: Any) -> None:
@@ -0,0 +1,134 @@
+from typing import Any, Callable, Iterable, Iterator, Optional
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import itertools
+import json
+import os
+import sys
+import time
+
+# Records sent to a worker at once, and chunks in flight per worker.  Only
+# this many records are held in memory, however many are verified.
+CHUNK_SIZE = 256
+CHUNKS_PER_WORKER = 2
+
+# (name, JSON text) of a record
+Record = tuple[str, str]
+# Returns the signer of a record's JSON text, and the recovered_address the
+# record claims, or raises if it is invalid
+Verify = Callable[[str], tuple[str, Optional[str]]]
+
+
+def read_records(path: str) -> Iterator[Record]:
+    """
+    The records of a JSONL file ('-' for stdin), named <path>:<line>, or the
+    .json files in a directory (or a single .json file), named by path.  The
+    files of a directory are read as it lists them, in no particular order,
+    so that a directory of any size is not held in memory.
+    """
+    if os.path.isdir(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        yield (entry.path, f.read())
+        return
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            yield (path, f.read())
+        return
+
+    with nullcontext(sys.stdin) if path == "-" else open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                yield (f"{path}:{line_number}", line)
+
+
+def verify_record(record: Record, verify: Verify, address: Optional[str]) -> dict[str, Any]:
+    name, text = record
+    try:
+        recovered_address, claimed_address = verify(text)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        return {"record": name, "status": "error", "error": f"{type(e).__name__}: {e}"}
+
+    expected = address or claimed_address or recovered_address
+    status = "ok" if expected.lower() == recovered_address.lower() else "mismatch"
+    return {"record": name, "status": status, "address": recovered_address}
+
+
+def apply_chunk(fn: Callable[[Any], Any], chunk: list[Any]) -> list[Any]:
+    return [fn(item) for item in chunk]
+
+
+def map_ordered(
+        fn: Callable[[Any], Any],
+        items: Iterator[Any],
+        workers: Optional[int] = None,
+        initializer: Optional[Callable[..., None]] = None,
+        initargs: tuple[Any, ...] = (),
+) -> Iterator[Any]:
+    """
+    fn of each of items, computed across a process pool and yielded in
+    order.  fn must be picklable (a module level function, or a partial of
+    one).
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs) as executor:
+        in_flight: deque[Future[list[Any]]] = deque()
+        chunks = iter(lambda: list(itertools.islice(items, CHUNK_SIZE)), [])
+        for chunk in chunks:
+            in_flight.append(executor.submit(apply_chunk, fn, chunk))
+            if len(in_flight) >= workers * CHUNKS_PER_WORKER:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def verify_records(
+        records: Iterator[Record],
+        verify: Verify,
+        address: Optional[str],
+        workers: Optional[int] = None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Verify records across a process pool, yielding the results in order.
+    verify must be picklable.
+    """
+    return map_ordered(partial(verify_record, verify=verify, address=address), records, workers)
+
+
+def write_results(results: Iterable[dict[str, Any]], statuses: list[str], noun: str) -> None:
+    """
+    Write a JSON line per result to stdout, and the number of results of
+    each status, and per second, to stderr.
+    """
+    counts = dict.fromkeys(statuses, 0)
+    start = time.monotonic()
+    for result in results:
+        counts[result["status"]] += 1
+        print(json.dumps(result))
+    elapsed = time.monotonic() - start
+
+    total = sum(counts.values())
+    print(
+        f"{total} {noun} in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.0f} {noun}/s): "
+        + ", ".join(f"{count} {status}" for status, count in counts.items()),
+        file=sys.stderr)
+
+
+def verify_bulk(
+        path: str,
+        verify: Verify,
+        address: Optional[str],
+        workers: Optional[int] = None,
+) -> None:
+    """
+    Verify the records at path, writing a JSON line per record to stdout,
+    and a summary to stderr.
+    """
+    write_results(
+        verify_records(read_records(path), verify, address, workers),
+        ["ok", "mismatch", "error"],
+        "records")
@@ -1,11 +1,21 @@
+from typing import Callable, Optional
 import threading
 
-from click import command, option
-from core.forward import forward_ip_to_vsock, forward_vsock_to_ip, \
-    forward_vsock_https, forward_ip_https
-from core.defaults import DEFAULT_APP_SERVER_PORT, DEFAULT_REMOTE_HOST
+from click import command, option, Choice
+from core.forward import forward_ip_to_backends, forward_ip_to_vsock, forward_ip_https, \
+    listen_vsock, serve_connections_to_ip, serve_https_connections_to_ip
+from core.balancer import BALANCE_POLICIES, Backend, Balancer, BalancerConfig, parse_backend
+from core.forward_config import ForwardConfig, ENGINES, ENGINE_THREAD
+from core.relay import RELAYS, RELAY_COPY
+from core.destinations import HostTable, load_host_table
+from core.admission import AdmissionConfig, POLICIES, POLICY_QUEUE, DEFAULT_BACKLOG
+from core.prefork import run_workers
+from core.upstream import UpstreamConfig
+from core.tunnel import TunnelConfig
+from core.tunnel_host import forward_tunnel_host
+from core.defaults import DEFAULT_APP_SERVER_PORT, DEFAULT_REMOTE_HOST, DEFAULT_TUNNEL_PORT
 
-from .utils import get_enclave_cid
+from .utils import get_enclave_cid, get_enclave_cids
 
 OLLAMA_PORT = 11434
 
@@ -18,11 +28,102 @@ OLLAMA_PORT = 11434
     default = OLLAMA_PORT,
     help="vsock port to listen for connections from enclave")
 @option("--proxy-dest-host", default = DEFAULT_REMOTE_HOST)
+@option(
+    "--engine",
+    type = Choice(ENGINES),
+    default = ENGINE_THREAD,
+    help="Forwarding engine (one thread per connection, or a single event loop)")
+@option(
+    "--relay",
+    type = Choice(RELAYS),
+    default = RELAY_COPY,
+    help="How the thread engine copies data between sockets")
+@option(
+    "--hosts-file",
+    help="File listing the hosts the enclave may connect to (JSON list or one per line)")
+@option("--backlog", type = int, default = DEFAULT_BACKLOG, help="Listen backlog")
+@option(
+    "--max-connections",
+    type = int,
+    help="Connections handled at once, per forwarder (default: unlimited)")
+@option(
+    "--queue-size",
+    type = int,
+    default = 0,
+    help="Connections waiting for a handler when --max-connections is reached")
+@option(
+    "--admission-policy",
+    type = Choice(POLICIES),
+    default = POLICY_QUEUE,
+    help="When the queue is full: stop accepting (queue), or close new connections (reject)")
+@option(
+    "--report-interval",
+    type = float,
+    default = AdmissionConfig.report_interval,
+    help="Seconds between reports of active/queued connections, if changed (0 to disable)")
+@option(
+    "--workers",
+    type = int,
+    default = 1,
+    help="Number of forwarding processes (restarted if they exit)")
+@option(
+    "--upstream-pool",
+    type = int,
+    default = 0,
+    help="Connected sockets kept ready for each remote host (0 to disable)")
+@option(
+    "--dns-ttl",
+    type = float,
+    default = 0.0,
+    help="Seconds to cache DNS lookups of remote hosts (0 to disable)")
+@option(
+    "--tunnel-channels",
+    type = int,
+    default = 0,
+    help="Multiplex all connections over this many persistent vsock channels"
+    " (requires enclave_tunnel in the enclave; 0 to disable)")
+@option(
+    "--tunnel-port",
+    type = int,
+    default = DEFAULT_TUNNEL_PORT,
+    help="vsock port on which the enclave accepts tunnel channels")
+@option(
+    "--balance",
+    type = Choice(BALANCE_POLICIES),
+    help="Spread connections to the app across all running enclaves, health checked")
+@option(
+    "--backend",
+    "backends",
+    multiple = True,
+    help="With --balance, forward to these in place of the running enclaves:"
+    " <cid>, vsock:<cid>:<port> or <host>:<port> (repeatable)")
+@option(
+    "--health-interval",
+    type = float,
+    default = 5.0,
+    help="Seconds between health checks of each enclave, with --balance")
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
 def main(
         server_port: int,
         proxy_port: int,
         proxy_dest_host: str,
         dev: bool,
+        engine: str,
+        relay: str,
+        hosts_file: Optional[str],
+        backlog: int,
+        max_connections: Optional[int],
+        queue_size: int,
+        admission_policy: str,
+        report_interval: float,
+        workers: int,
+        upstream_pool: int,
+        dns_ttl: float,
+        tunnel_channels: int,
+        tunnel_port: int,
+        balance: Optional[str],
+        backends: tuple[str, ...],
+        health_interval: float,
 ) -> None:
     """
     Perform all forwarding for the enclave.
@@ -35,39 +136,105 @@ def main(
     performed:
       0:443 -> <external>:443      (https connections from enclave)
     (for use with the docker version).
+
+    With --workers N, N processes each run all of the above.  TCP listeners
+    use SO_REUSEPORT and the vsock listeners are shared, so connections are
+    spread across the processes.
+
+    With --tunnel-channels N, the same forwarding is performed over N
+    long-lived vsock connections to enclave_tunnel in the enclave, instead of
+    a vsock connection per TCP connection.
+
+    With --balance, incoming connections are spread across every running
+    enclave (rediscovered periodically), and enclaves whose /enclave/address
+    fails health checks are ejected until they pass again.
     """
 
+    known_hosts = load_host_table(hosts_file) if hosts_file else HostTable()
+    admission = AdmissionConfig(
+        backlog=backlog,
+        max_connections=max_connections,
+        queue_size=queue_size,
+        policy=admission_policy,
+        report_interval=report_interval,
+    )
+    config = ForwardConfig(
+        engine=engine,
+        relay=relay,
+        known_hosts=known_hosts,
+        admission=admission,
+        reuse_port=workers > 1,
+        upstream=UpstreamConfig(pool_size=upstream_pool, dns_ttl=dns_ttl),
+    )
+
     if dev:
 
         # :443 -> external hosts (https)
-        forward_ip_https(443, 443)
+        run_workers(workers, lambda: forward_ip_https(443, 443, config))
 
-    else:
+    elif tunnel_channels > 0:
 
         enclave_cid = get_enclave_cid()
-
-        # Local server port to vsock with the same port in the enclave
-        local_to_enclave = threading.Thread(
-            target=forward_ip_to_vsock,
-            args=[server_port, server_port, enclave_cid],
+        tunnel = TunnelConfig(
+            port=tunnel_port,
+            app_port=server_port,
+            num_channels=tunnel_channels,
         )
+        run_workers(workers, lambda: forward_tunnel_host(
+            enclave_cid, proxy_dest_host, proxy_port, config, tunnel))
 
-        # vsock:443 -> external hosts (https)
-        enclave_to_external = threading.Thread(
-            target = forward_vsock_https,
-            args=[443, 443],
-        )
+    else:
 
-        # vsock:11434 -> localhost:11434
-        enclave_to_provider = threading.Thread(
-            target=forward_vsock_to_ip,
-            args=[proxy_port, proxy_dest_host, proxy_port]
-        )
+        app_cid = None if balance else get_enclave_cid()
+
+        # vsock has no SO_REUSEPORT, so the vsock listeners are created before
+        # forking and shared by all workers.
+        https_socket = listen_vsock(443, config)
+        print("Forward (https) (vsock):443 -> <host>:443")
+        provider_socket = listen_vsock(proxy_port, config)
+        print(f"Forward (vsock):{proxy_port} -> {proxy_dest_host}:{proxy_port}")
+
+        def forward_app() -> None:
+            if balance:
+                balancer = create_balancer(balance, backends, server_port, health_interval)
+                forward_ip_to_backends(server_port, balancer, config)
+            else:
+                forward_ip_to_vsock(server_port, server_port, app_cid, config)
+
+        def worker() -> None:
+            run_threads([
+                # Local server port to vsock with the same port in the enclave(s)
+                forward_app,
+
+                # vsock:443 -> external hosts (https)
+                lambda: serve_https_connections_to_ip(https_socket, 443, config),
+
+                # vsock:11434 -> localhost:11434
+                lambda: serve_connections_to_ip(
+                    provider_socket, proxy_dest_host, proxy_port, config),
+            ])
+
+        run_workers(workers, worker)
+
+
+def create_balancer(
+        policy: str,
+        backends: tuple[str, ...],
+        port: int,
+        health_interval: float) -> Balancer:
+    """
+    A Balancer over the given backends, or over the running enclaves.
+    """
+    config = BalancerConfig(policy=policy, health_interval=health_interval)
+    if backends:
+        static = [parse_backend(spec, port) for spec in backends]
+        return Balancer(lambda: static, config)
+    return Balancer(lambda: [Backend.vsock(cid, port) for cid in get_enclave_cids()], config)
 
-        local_to_enclave.start()
-        enclave_to_external.start()
-        enclave_to_provider.start()
 
-        local_to_enclave.join()
-        enclave_to_external.join()
-        enclave_to_provider.join()
+def run_threads(targets: list[Callable[[], None]]) -> None:
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
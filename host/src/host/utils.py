@@ -6,10 +6,18 @@ def get_enclave_cid() -> int:
     """
     Determine CID of Current Enclave
     """
+    return get_enclave_cids()[0]
+
+
+def get_enclave_cids() -> list[int]:
+    """
+    CIDs of all running enclaves
+    """
     with subprocess.Popen(
         ["/bin/nitro-cli", "describe-enclaves"], stdout=subprocess.PIPE
     ) as proc:
         output = json.loads(proc.communicate()[0].decode())
-        enclave_cid = output[0]["EnclaveCID"]
-        assert isinstance(enclave_cid, int)
-        return enclave_cid
+    enclave_cids = [
+        enclave["EnclaveCID"] for enclave in output if enclave.get("State", "RUNNING") == "RUNNING"]
+    assert all(isinstance(cid, int) for cid in enclave_cids)
+    return enclave_cids
@@ -1,42 +1,108 @@
-from typing import Any
+from typing import Any, Optional
 import base64
 import json
+import os
 from click import command, option
 
 from core.address import address_from_bytes
 
-from .attestation_verifier import verify_attestation_doc, get_public_key
+from .attestation_verifier import AttestationVerifier, MeasurementIndex, \
+    measurements_pcrs, verify_attestation_doc, get_public_key
+from .bulk_verify import Record, map_ordered, read_records, write_results
 
 def read_root_pem(root_pem_file: str) -> Any:
     with open(root_pem_file, "r", encoding="utf-8") as file:
         return file.read()
 
 
+def read_measurements(measurements_files: tuple[str, ...]) -> MeasurementIndex:
+    index = MeasurementIndex()
+    for measurements in measurements_files:
+        with open(measurements, "r", encoding="utf-8") as f:
+            index.add(measurements, measurements_pcrs(json.load(f)))
+    return index
+
+
+# The verifier of each worker process of verify_many, so that its caches
+# serve every document the worker verifies
+verifier: Optional[AttestationVerifier] = None
+
+def init_verifier(root_cert_pem: str, measurements_files: tuple[str, ...]) -> None:
+    global verifier
+    verifier = AttestationVerifier(root_cert_pem, read_measurements(measurements_files))
+
+
+def verify_record(record: Record) -> dict[str, Any]:
+    name, text = record
+    assert verifier is not None
+    try:
+        attestation_doc = base64.b64decode(json.loads(text)["attestation_doc"])
+        verified = verifier.verify(attestation_doc)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        return {"attestation": name, "status": "error", "error": f"{type(e).__name__}: {e}"}
+    return {
+        "attestation": name,
+        "status": "ok",
+        "address": address_from_bytes(verified.public_key),
+        "measurements": verified.measurements,
+    }
+
+
+def verify_many(
+        paths: tuple[str, ...],
+        measurements_files: tuple[str, ...],
+        root_cert_pem: str,
+        workers: Optional[int],
+) -> None:
+    """
+    Verify the attestation files (or directories of them) in parallel,
+    writing a JSON line per file to stdout, and a summary to stderr.
+    """
+    records = (record for path in paths for record in read_records(path))
+    write_results(
+        map_ordered(
+            verify_record, records, workers, init_verifier, (root_cert_pem, measurements_files)),
+        ["ok", "error"],
+        "attestations")
+
+
 @command()
-@option("--measurements", required=True, help="Path to the measurements file")
-@option("--attestation", required=True, help="Path to the attestation file")
+@option("--measurements", required=True, multiple=True,
+        help="Path to the measurements file.  Repeat to allow any of several enclave builds")
+@option("--attestation", required=True, multiple=True,
+        help="Path to the attestation file.  Repeat, or give a directory of .json files,"
+        " to verify many")
 @option("--root-certificate", "-r", default="sample_data/root.pem", help="Root public key")
+@option("--workers", "-w", type=int, help="Processes verifying many (default: CPU count)")
 def main(
-        measurements: str,
-        attestation: str,
-        root_certificate: str) -> None:
-    with open(measurements, "r", encoding="utf-8") as f:
-        measurements_data = json.load(f)
+        measurements: tuple[str, ...],
+        attestation: tuple[str, ...],
+        root_certificate: str,
+        workers: Optional[int]) -> None:
+    """
+    Verify an attestation and output the (attested) enclave address.  With
+    several attestations, output a JSON line for each.
+    """
+    root_cert_pem = read_root_pem(root_certificate)
+    if len(attestation) > 1 or os.path.isdir(attestation[0]):
+        verify_many(attestation, measurements, root_cert_pem, workers)
+        return
 
-    with open(attestation, "r", encoding="utf-8") as f:
+    with open(attestation[0], "r", encoding="utf-8") as f:
         attestation_data = json.load(f)
+    attestation_doc = base64.b64decode(attestation_data["attestation_doc"])
 
-    pcrs = [
-        measurements_data["Measurements"]["PCR0"]
-    ]
-    attestation_doc = attestation_data["attestation_doc"]
-
-    root_cert_pem = read_root_pem(root_certificate)
-    attestation_doc = base64.b64decode(attestation_doc)
-
-    verify_attestation_doc(
-        attestation_doc=attestation_doc, pcrs=pcrs, root_cert_pem=root_cert_pem
-    )
+    if len(measurements) == 1:
+        with open(measurements[0], "r", encoding="utf-8") as f:
+            measurements_data = json.load(f)
+        pcrs = [
+            measurements_data["Measurements"]["PCR0"]
+        ]
+        verify_attestation_doc(
+            attestation_doc=attestation_doc, pcrs=pcrs, root_cert_pem=root_cert_pem # type: ignore
+        )
+    else:
+        AttestationVerifier(root_cert_pem, read_measurements(measurements)).verify(attestation_doc)
 
     # The "public_key" field is the Ethereum address used for signing
     public_key_bytes = get_public_key(attestation_doc)
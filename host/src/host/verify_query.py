@@ -1,35 +1,178 @@
-from typing import Optional
+from typing import Any, Iterable, Iterator, Optional
+from functools import partial
 import json
 
-from click import command, option
+from click import UsageError, command, option
 from web3.auto import w3
 from eth_account.messages import encode_defunct
 
-from enclave.query import SignedQueryData
+from enclave.query import ERROR_EVENT, SIGNATURE_EVENT, SignedBatchItem, \
+    SignedStreamQueryData, Transcript, is_attestation_nonce, leaf_hash, load_canonical, \
+    root_from_proof, serialize, split_signed_response
+
+from .bulk_verify import verify_bulk
+
+
+def read_events(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    The (event type, data) of each server-sent event in lines.
+    """
+    event = "message"
+    data: list[str] = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield (event, "\n".join(data))
+            event = "message"
+            data = []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            value = line[len("data:"):]
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield (event, "\n".join(data))
+
+
+def read_stream(lines: Iterable[str]) -> SignedStreamQueryData:
+    """
+    Check the chunks of a saved streaming query against the digest in its
+    signature event, and return the signed data from that event.
+    """
+    transcript = Transcript()
+    signed_query: Optional[SignedStreamQueryData] = None
+    for event, data in read_events(lines):
+        if signed_query is not None:
+            raise RuntimeError("Events after the signature")
+        if event == SIGNATURE_EVENT:
+            signed_query = json.loads(data)
+        elif event == ERROR_EVENT:
+            raise RuntimeError(f"Stream failed: {json.loads(data)}")
+        else:
+            transcript.update(data)
+
+    if signed_query is None:
+        raise RuntimeError("No signature (incomplete stream?)")
+    if signed_query["query_data"]["transcript"] != transcript.data():
+        raise RuntimeError(
+            f"Transcript mismatch! Signed: {signed_query['query_data']['transcript']},"
+            f" Actual: {transcript.data()}")
+    return signed_query
+
+
+def check_batch_item(item: SignedBatchItem) -> None:
+    """
+    Check that the query_data of one result of a batch query is in the batch
+    whose Merkle root was signed.
+    """
+    if "error" in item:
+        raise RuntimeError(f"Query failed: {item['error']}") # type: ignore
+    root = root_from_proof(leaf_hash(item["query_data"]), item["proof"])
+    if "0x" + root.hex() != item["batch"]["merkle_root"]:
+        raise RuntimeError(
+            f"Proof mismatch! Signed root: {item['batch']['merkle_root']},"
+            f" Actual: 0x{root.hex()}")
+
+
+def check_not_nonce(signed_data: Any) -> None:
+    """
+    Reject the signature on an attestation nonce (see enclave.attestation),
+    which is not a query response.
+    """
+    if is_attestation_nonce(signed_data):
+        raise RuntimeError("Signed data is an attestation nonce, not a query response")
+
+
+def recover_address(query_data: Any, signature: str) -> str:
+    check_not_nonce(query_data)
+    return recover_text_address(serialize(query_data), signature)
+
+
+def recover_text_address(text: str, signature: str) -> str:
+    message = encode_defunct(text=text)
+    return str(w3.eth.account.recover_message(message, signature=signature))
+
+
+def signer_address(signed_query: Any, batch: bool) -> str:
+    """
+    The address that signed a query response.
+    """
+    # A batch signature covers the Merkle root of the batch
+    if batch:
+        check_batch_item(signed_query)
+        signed_data = signed_query["batch"]
+    else:
+        signed_data = signed_query["query_data"]
+    return recover_address(signed_data, signed_query["signature"])
+
+
+def verify_text(text: str, batch: bool) -> tuple[str, Optional[str]]:
+    """
+    The address that signed a saved query response, and the
+    recovered_address it claims.  A response saved as the enclave sent it is
+    checked over its query_data as it stands, which must be in canonical
+    form.  Any other response, or one whose text was changed since (say,
+    re-encoded), is parsed and its query_data serialized again.
+    """
+    try:
+        parts = None if batch else split_signed_response(text)
+        if parts is not None:
+            query_data, claimed_address, signature = parts
+            check_not_nonce(load_canonical(query_data))
+            recovered_address = recover_text_address(query_data, signature)
+            if recovered_address.lower() == claimed_address.lower():
+                return recovered_address, claimed_address
+    except ValueError:
+        # Not in canonical form
+        pass
+    signed_query = json.loads(text)
+    return signer_address(signed_query, batch), signed_query.get("recovered_address")
+
 
 @command()
-@option("--query", "-q", required=True, help = "The json file generated by the query")
+@option("--query", "-q", help = "The json file generated by the query")
 @option("--address", "-a", help = "The expected signer address")
-def main(query: str, address: Optional[str]) -> None:
+@option("--stream", is_flag=True,
+        help = "The file is the saved event stream of a streaming query")
+@option("--batch", is_flag=True,
+        help = "The file is one of the results of a batch query")
+@option("--bulk", "-b",
+        help = "Verify every record of a JSONL file ('-' for stdin), or every .json"
+        " file in a directory, in place of --query")
+@option("--workers", "-w", type=int, help = "Processes for --bulk (default: CPU count)")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def main(
+        query: Optional[str],
+        address: Optional[str],
+        stream: bool,
+        batch: bool,
+        bulk: Optional[str],
+        workers: Optional[int],
+) -> None:
     """
     Verify the signature on a query response.  Output the address of the
     signer.
+
+    With --bulk, output a JSON line for each record: its status (ok,
+    mismatch or error) and signer address.  A record is a mismatch if the
+    signer is not --address (or, without --address, the record's
+    recovered_address).
     """
+    if (query is None) == (bulk is None):
+        raise UsageError("Give one of --query and --bulk")
+    if bulk is not None:
+        if stream:
+            raise UsageError("--stream is not supported with --bulk")
+        verify_bulk(bulk, partial(verify_text, batch=batch), address, workers)
+        return
 
+    assert query is not None
     with open(query, "r", encoding="utf-8") as f:
-        signed_query: SignedQueryData = json.load(f)
-
-    query_data_serialized = json.dumps(
-        signed_query["query_data"],
-        sort_keys=True,
-        ensure_ascii=False
-    )
-    message = encode_defunct(text=query_data_serialized)
-
-    recovered_address = w3.eth.account.recover_message(
-        message,
-        signature=signed_query["signature"]
-    )
+        if stream:
+            recovered_address = signer_address(read_stream(f), batch)
+        else:
+            recovered_address, _ = verify_text(f.read(), batch)
     if address:
         if address.lower() != recovered_address.lower():
             raise RuntimeError(
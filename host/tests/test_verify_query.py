@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+from eth_account import Account
+from eth_account.messages import encode_defunct
+
+from enclave.query import serialize, signed_response
+from host.verify_query import verify_text
+
+PRIVATE_KEY = "0x" + "11" * 32
+
+
+class Signer:
+    """
+    Signs as the enclave does (enclave.utils.Signer, which needs the
+    provider keys set to import).
+    """
+
+    def __init__(self, private_key: str) -> None:
+        # pylint: disable=no-value-for-parameter
+        self.account = Account.from_key(private_key)
+        self.address = str(self.account.address)
+
+    def sign_text(self, text: str) -> str:
+        return str(self.account.sign_message(encode_defunct(text=text)).signature.hex())
+
+
+class TestVerifyQuery(TestCase):
+
+    def setUp(self) -> None:
+        self.signer = Signer(PRIVATE_KEY)
+        self.query_data = {"request": {"prompt": "hi", "model": "mock"}, "response": "hello"}
+
+    def test_as_sent(self) -> None:
+        serialized = serialize(self.query_data)
+        text = signed_response(
+            serialized, self.signer.sign_text(serialized), self.signer.address).decode()
+        self.assertEqual(
+            (self.signer.address, self.signer.address), verify_text(text, batch=False))
+
+    def test_not_canonical(self) -> None:
+        """
+        A response whose query_data was re-encoded, with its keys out of
+        order, is verified over its query_data serialized again.
+        """
+        signature = self.signer.sign_text(serialize(self.query_data))
+        query_data = '{"response": "hello", "request": {"prompt": "hi", "model": "mock"}}'
+        text = signed_response(query_data, signature, self.signer.address).decode()
+        self.assertEqual(
+            (self.signer.address, self.signer.address), verify_text(text, batch=False))